@@ -0,0 +1,167 @@
+"""
+ffmpeg helpers for the dictation transcription pipeline.
+
+Recordings are first normalized to small mono 16 kHz Opus files with the
+leading and trailing silence trimmed, then long ones are cut on silences
+into segments that can be transcribed concurrently. All functions are
+blocking (they run ffmpeg/ffprobe as subprocesses), so async callers should
+run them in a thread.
+"""
+import os
+import re
+import subprocess
+from time import monotonic
+from typing import List, Optional, Tuple
+
+FFMPEG_BINARY = os.getenv("FFMPEG_BINARY", "ffmpeg")
+FFPROBE_BINARY = os.getenv("FFPROBE_BINARY", "ffprobe")
+
+# silencedetect thresholds: quieter than SILENCE_NOISE_DB for at least SILENCE_MIN_SECONDS
+SILENCE_NOISE_DB = int(os.getenv("SILENCE_NOISE_DB", "-35"))
+SILENCE_MIN_SECONDS = float(os.getenv("SILENCE_MIN_SECONDS", "0.5"))
+
+# Whisper works at 16 kHz mono, so anything more is upload overhead
+AUDIO_SAMPLE_RATE = int(os.getenv("AUDIO_SAMPLE_RATE", "16000"))
+AUDIO_OPUS_BITRATE = os.getenv("AUDIO_OPUS_BITRATE", "24k")
+# Leading/trailing audio quieter than this is trimmed during preprocessing
+TRIM_SILENCE_DB = int(os.getenv("TRIM_SILENCE_DB", "-50"))
+
+SILENCE_START_RE = re.compile(r"silence_start: (-?[\d.]+)")
+SILENCE_END_RE = re.compile(r"silence_end: (-?[\d.]+)")
+
+
+class AudioProcessingError(Exception):
+    pass
+
+
+class AudioToolMissingError(AudioProcessingError):
+    """ffmpeg or ffprobe is not installed."""
+
+
+def _run(args: List[str]) -> subprocess.CompletedProcess:
+    try:
+        result = subprocess.run(args, capture_output=True, text=True)
+    except FileNotFoundError:
+        raise AudioToolMissingError(f"{args[0]} is not installed")
+    if result.returncode != 0:
+        raise AudioProcessingError(f"{os.path.basename(args[0])} failed: {result.stderr.strip()[-500:]}")
+    return result
+
+
+def _opus_args() -> List[str]:
+    return ["-vn", "-ac", "1", "-ar", str(AUDIO_SAMPLE_RATE), "-c:a", "libopus", "-b:a", AUDIO_OPUS_BITRATE]
+
+
+def preprocess_audio(path: str, out_path: str) -> dict:
+    """
+    Downmixes to mono, resamples to AUDIO_SAMPLE_RATE, trims leading and
+    trailing silence and encodes to Opus at AUDIO_OPUS_BITRATE. Returns
+    {"seconds", "input_bytes", "output_bytes", "saved_bytes",
+    "lead_in_seconds"}; lead_in_seconds is how much audio was cut from the
+    start, so times in the output map back to the recording by adding it.
+    """
+    kept = 0.1
+    trim = f"silenceremove=start_periods=1:start_threshold={TRIM_SILENCE_DB}dB:start_silence={kept}"
+    started = monotonic()
+    result = _run([
+        FFMPEG_BINARY, "-hide_banner", "-nostats", "-y", "-i", path,
+        # silencedetect only logs (at info level) to measure the leading silence;
+        # silenceremove only trims the start, so run it again on the reversed audio for the tail
+        "-af", f"silencedetect=noise={TRIM_SILENCE_DB}dB:d={kept},{trim},areverse,{trim},areverse",
+        *_opus_args(),
+        out_path,
+    ])
+    lead_in = 0.0
+    start = SILENCE_START_RE.search(result.stderr)
+    end = SILENCE_END_RE.search(result.stderr)
+    if start and end and float(start.group(1)) <= 0.01:
+        lead_in = max(0.0, float(end.group(1)) - kept)
+    input_bytes = os.path.getsize(path)
+    output_bytes = os.path.getsize(out_path)
+    return {
+        "seconds": round(monotonic() - started, 3),
+        "input_bytes": input_bytes,
+        "output_bytes": output_bytes,
+        "saved_bytes": input_bytes - output_bytes,
+        "lead_in_seconds": round(lead_in, 3),
+    }
+
+
+def probe_duration(path: str) -> Optional[float]:
+    """Duration in seconds, or None when the container does not record one."""
+    result = _run([
+        FFPROBE_BINARY, "-v", "error",
+        "-show_entries", "format=duration",
+        "-of", "default=noprint_wrappers=1:nokey=1",
+        path,
+    ])
+    try:
+        return float(result.stdout.strip())
+    except ValueError:
+        return None
+
+
+def detect_silences(path: str, noise_db: int = SILENCE_NOISE_DB,
+                    min_seconds: float = SILENCE_MIN_SECONDS) -> List[Tuple[float, float]]:
+    """Returns (start, end) of each silent stretch, in seconds."""
+    result = _run([
+        FFMPEG_BINARY, "-hide_banner", "-nostats", "-i", path,
+        "-af", f"silencedetect=noise={noise_db}dB:d={min_seconds}",
+        "-f", "null", "-",
+    ])
+    silences = []
+    start = None
+    for line in result.stderr.splitlines():
+        match = SILENCE_START_RE.search(line)
+        if match:
+            start = max(0.0, float(match.group(1)))
+            continue
+        match = SILENCE_END_RE.search(line)
+        if match and start is not None:
+            silences.append((start, float(match.group(1))))
+            start = None
+    return silences
+
+
+def plan_segments(duration: float, silences: List[Tuple[float, float]],
+                  target_seconds: float, max_seconds: float) -> List[Tuple[float, float]]:
+    """
+    Splits [0, duration] into segments of at most max_seconds, cutting in
+    the middle of the silence closest to target_seconds into each segment.
+    Falls back to a hard cut at max_seconds when a stretch has no silence.
+    """
+    cuts = sorted((start + end) / 2 for start, end in silences)
+    segments = []
+    segment_start = 0.0
+    while duration - segment_start > max_seconds:
+        window = [c for c in cuts if segment_start < c <= segment_start + max_seconds]
+        if window:
+            cut = min(window, key=lambda c: abs(c - (segment_start + target_seconds)))
+        else:
+            cut = segment_start + max_seconds
+        segments.append((segment_start, cut))
+        segment_start = cut
+    segments.append((segment_start, duration))
+    return segments
+
+
+def extract_segment(path: str, start: float, end: float, out_path: str):
+    """Writes [start, end) of the recording to out_path with the preprocessing encoder settings."""
+    _run([
+        FFMPEG_BINARY, "-v", "error", "-y",
+        "-ss", f"{start:.3f}", "-t", f"{end - start:.3f}",
+        "-i", path,
+        *_opus_args(),
+        out_path,
+    ])
+
+
+def extract_tail(path: str, start: float, out_path: str):
+    """Writes everything after start seconds to out_path; works on a recording that is still growing."""
+    _run([
+        FFMPEG_BINARY, "-v", "error", "-y",
+        "-ss", f"{start:.3f}",
+        "-i", path,
+        *_opus_args(),
+        out_path,
+    ])
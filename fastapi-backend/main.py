@@ -1,25 +1,35 @@
 import os
+import asyncio
+import contextlib
+import bisect
+import heapq
+import threading
+from collections import Counter
+from time import monotonic
 import uuid
 import base64
+import hashlib
 import logging
 import pdfplumber
 import boto3
+from boto3.s3.transfer import TransferConfig
 import io
 import datetime
 import json
+import re
 from typing import Optional, List, Dict, Any
 from datetime import date, time
 import datetime
 import os
 import tempfile
+import shutil
 import subprocess
-import requests
-from fastapi import FastAPI, Request, File, UploadFile, HTTPException, status, Query, APIRouter
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, Request, File, UploadFile, HTTPException, status, Query, APIRouter, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, StreamingResponse, RedirectResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy import create_engine, text
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import AsyncOpenAI
 from reportlab.lib.pagesizes import letter
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib import colors
@@ -31,8 +41,20 @@ from reportlab.platypus import (
 from reportlab.lib.colors import HexColor
 from reportlab.lib.units import inch, cm
 from pydantic import BaseModel, Field
-from weasyprint import HTML
 from typing import List
+from audio import (
+    AudioProcessingError, AudioToolMissingError, preprocess_audio, probe_duration, detect_silences,
+    plan_segments, extract_segment, extract_tail,
+)
+from structured_output import (
+    StructuredOutputError, PRESCRIPTION_SCHEMA, VOICE_HISTORY_SCHEMA, VOICE_PRESCRIPTION_SCHEMA,
+    empty_from_schema, coerce_to_schema, parse_json_output,
+)
+from storage import S3StorageBackend, LocalStorageBackend, CachedStorageBackend, PresignedUrlCache
+from pagination import encode_cursor, decode_cursor
+from receipts import (
+    render_receipt, render_receipts, shutdown_receipt_pool, receipt_content_version
+)
 from prompts import (
     CONTEXTS,
     FIXED_PROMPT_IMAGE,
@@ -73,7 +95,149 @@ app.add_middleware(
 )
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
-client = OpenAI(api_key=OPENAI_API_KEY)
+
+# LLM scheduling limits. LLM_MODEL_CONCURRENCY is a comma separated list of
+# model=limit pairs, e.g. "o1=2,gpt-4=4". LLM_MAX_QUEUE=0 means unbounded.
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "0"))
+LLM_MODEL_CONCURRENCY = os.getenv("LLM_MODEL_CONCURRENCY", "o1=2,gpt-4=4,gpt-4o=6")
+
+def parse_model_limits(spec: str) -> Dict[str, int]:
+    limits = {}
+    for part in (spec or "").split(","):
+        if "=" not in part:
+            continue
+        model, limit = part.split("=", 1)
+        try:
+            limits[model.strip()] = max(1, int(limit))
+        except ValueError:
+            logger.warning(f"Ignoring invalid LLM model limit: {part}")
+    return limits
+
+# Model and provider mode for JSON-returning calls: "json_schema" (strict
+# structured outputs), "json_object" (JSON mode) or "off" (prompt only).
+# Both provider modes need a model that supports them, hence gpt-4o.
+STRUCTURED_OUTPUT_MODEL = os.getenv("STRUCTURED_OUTPUT_MODEL", "gpt-4o")
+STRUCTURED_OUTPUT_MODE = os.getenv("STRUCTURED_OUTPUT_MODE", "json_schema").lower()
+
+class LLMGateway:
+    """
+    Shared async entry point for every OpenAI call.
+    Requests wait (FIFO) for a per-model slot and then a global slot, so a
+    burst of slow o1 image analyses cannot starve the other models or block
+    the event loop.
+    """
+
+    def __init__(self, api_key: str, max_concurrency: int, model_limits: Dict[str, int], max_queue: int = 0):
+        self.client = AsyncOpenAI(api_key=api_key)
+        self.max_concurrency = max_concurrency
+        self.model_limits = model_limits
+        self.max_queue = max_queue
+        self._global = asyncio.Semaphore(max_concurrency)
+        self._models: Dict[str, asyncio.Semaphore] = {}
+        self.waiting = 0
+        self.in_flight: Dict[str, int] = {}
+        self.json_outputs = {"ok": 0, "repaired": 0, "failed": 0}
+
+    def _model_semaphore(self, model: str) -> asyncio.Semaphore:
+        if model not in self._models:
+            limit = self.model_limits.get(model, self.max_concurrency)
+            self._models[model] = asyncio.Semaphore(limit)
+        return self._models[model]
+
+    @contextlib.asynccontextmanager
+    async def slot(self, model: str):
+        if self.max_queue and self.waiting >= self.max_queue:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="AI service is busy, please retry shortly."
+            )
+        model_sem = self._model_semaphore(model)
+        queued_at = monotonic()
+        self.waiting += 1
+        try:
+            await model_sem.acquire()
+            try:
+                await self._global.acquire()
+            except BaseException:
+                model_sem.release()
+                raise
+        finally:
+            self.waiting -= 1
+
+        waited = monotonic() - queued_at
+        if waited > 1:
+            logger.info(f"LLM call for {model} waited {waited:.1f}s in queue")
+        self.in_flight[model] = self.in_flight.get(model, 0) + 1
+        try:
+            yield
+        finally:
+            self.in_flight[model] -= 1
+            self._global.release()
+            model_sem.release()
+
+    async def chat(self, model: str, messages: list, **kwargs) -> str:
+        async with self.slot(model):
+            response = await self.client.chat.completions.create(model=model, messages=messages, **kwargs)
+        return (response.choices[0].message.content or "").strip()
+
+    async def chat_json(self, model: str, messages: list, schema: dict, name: str, **kwargs) -> dict:
+        """
+        Chat call whose reply must be a JSON object matching schema. Asks the
+        provider for structured output (STRUCTURED_OUTPUT_MODE), repairs
+        near-valid JSON locally instead of calling again and coerces the
+        result to the schema. Raises StructuredOutputError if the reply
+        can't be recovered.
+        """
+        if STRUCTURED_OUTPUT_MODE == "json_schema":
+            kwargs["response_format"] = {
+                "type": "json_schema",
+                "json_schema": {"name": name, "schema": schema, "strict": True},
+            }
+        elif STRUCTURED_OUTPUT_MODE == "json_object":
+            kwargs["response_format"] = {"type": "json_object"}
+        content = await self.chat(model, messages, **kwargs)
+        try:
+            data, repaired = parse_json_output(content)
+        except StructuredOutputError:
+            self.json_outputs["failed"] += 1
+            logger.warning(f"Unrecoverable JSON from {model} for {name}: {content[:300]!r}")
+            raise
+        self.json_outputs["repaired" if repaired else "ok"] += 1
+        if repaired:
+            logger.info(f"Repaired JSON from {model} for {name}")
+        return coerce_to_schema(data, schema)
+
+    async def stream_chat(self, model: str, messages: list, **kwargs):
+        """Yields content deltas; the scheduling slot is held for the whole stream."""
+        async with self.slot(model):
+            stream = await self.client.chat.completions.create(
+                model=model, messages=messages, stream=True, **kwargs
+            )
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+
+    async def audio_translation(self, file, model: str = "whisper-1", **kwargs):
+        """Whisper translation to English; file is a (filename, fileobj, content_type) tuple."""
+        async with self.slot(model):
+            return await self.client.audio.translations.create(model=model, file=file, **kwargs)
+
+    def stats(self) -> dict:
+        return {
+            "max_concurrency": self.max_concurrency,
+            "model_limits": self.model_limits,
+            "waiting": self.waiting,
+            "in_flight": {m: n for m, n in self.in_flight.items() if n},
+            "json_outputs": dict(self.json_outputs),
+        }
+
+llm_gateway = LLMGateway(
+    api_key=OPENAI_API_KEY,
+    max_concurrency=LLM_MAX_CONCURRENCY,
+    model_limits=parse_model_limits(LLM_MODEL_CONCURRENCY),
+    max_queue=LLM_MAX_QUEUE,
+)
 
 DATABASE_URI = os.getenv("DATABASE_URI", "")
 engine = create_engine(
@@ -85,6 +249,38 @@ engine = create_engine(
     max_overflow=10
 )
 
+# DDL for tables owned by this API. Each feature appends its statements and
+# they are applied (idempotently) once on startup.
+SCHEMA_STATEMENTS: List[str] = []
+
+@contextlib.contextmanager
+def write_transaction(conn=None):
+    """Reuses the caller's transaction when given one, otherwise opens a new one."""
+    if conn is not None:
+        yield conn
+        return
+    with engine.begin() as new_conn:
+        yield new_conn
+
+# Arbitrary application-wide key for pg_advisory_xact_lock
+SCHEMA_LOCK_KEY = 72310451
+
+@app.on_event("startup")
+def apply_schema_statements():
+    # Workers starting together take turns: the advisory lock is held by a
+    # separate transaction for the whole run, so concurrent CREATE OR REPLACE
+    # FUNCTION / trigger statements from other workers never race.
+    # One transaction per statement so a single failure (e.g. missing
+    # privileges for CREATE EXTENSION) does not roll back the others.
+    with engine.begin() as lock_conn:
+        lock_conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": SCHEMA_LOCK_KEY})
+        for statement in SCHEMA_STATEMENTS:
+            try:
+                with engine.begin() as conn:
+                    conn.execute(text(statement))
+            except Exception as e:
+                logger.error(f"Error applying schema statement: {e}")
+
 aws_access_key_id = os.getenv("AWS_ACCESS_KEY_ID")
 aws_secret_access_key = os.getenv("AWS_SECRET_ACCESS_KEY")
 aws_region = os.getenv("AWS_REGION")
@@ -108,47 +304,230 @@ def get_content_type(filename):
     else:
         return "application/octet-stream"
 
-def upload_to_s3(file_bytes, filename):
-    unique_filename = f"{uuid.uuid4()}_{filename}"
-    content_type = get_content_type(filename)
-    s3_client.put_object(
-        Bucket=bucket_name,
-        Key=unique_filename,
-        Body=file_bytes,
-        ContentType=content_type,
-        ACL='private'
-    )
-    return f"https://{bucket_name}.s3.{aws_region}.amazonaws.com/{unique_filename}"
+# Uploads larger than the threshold go as multipart uploads with parts sent in parallel
+S3_MULTIPART_THRESHOLD_BYTES = int(os.getenv("S3_MULTIPART_THRESHOLD_BYTES", str(8 * 1024 * 1024)))
+S3_MULTIPART_CHUNK_BYTES = max(5 * 1024 * 1024, int(os.getenv("S3_MULTIPART_CHUNK_BYTES", str(8 * 1024 * 1024))))
+S3_UPLOAD_CONCURRENCY = int(os.getenv("S3_UPLOAD_CONCURRENCY", "4"))
+
+s3_transfer_config = TransferConfig(
+    multipart_threshold=S3_MULTIPART_THRESHOLD_BYTES,
+    multipart_chunksize=S3_MULTIPART_CHUNK_BYTES,
+    max_concurrency=S3_UPLOAD_CONCURRENCY,
+)
+
+# "s3" (default) or "local". Local storage keeps objects under LOCAL_STORAGE_DIR
+# and serves them from /api/storage, for single-box runs without AWS.
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "s3").lower()
+LOCAL_STORAGE_DIR = os.getenv("LOCAL_STORAGE_DIR", "local_storage")
+STORAGE_PUBLIC_BASE_URL = os.getenv("STORAGE_PUBLIC_BASE_URL", "http://localhost:8000")
+STORAGE_SIGNING_SECRET = os.getenv("STORAGE_SIGNING_SECRET", "")
+# Setting STORAGE_CACHE_DIR puts an on-node cache of hot documents in front of S3
+STORAGE_CACHE_DIR = os.getenv("STORAGE_CACHE_DIR", "")
+STORAGE_CACHE_MAX_BYTES = int(os.getenv("STORAGE_CACHE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+STORAGE_CACHE_MAX_OBJECT_BYTES = int(os.getenv("STORAGE_CACHE_MAX_OBJECT_BYTES", str(50 * 1024 * 1024)))
+
+def create_storage_backend():
+    if STORAGE_BACKEND == "local":
+        secret = STORAGE_SIGNING_SECRET
+        if not secret:
+            logger.warning("STORAGE_SIGNING_SECRET is not set; local file links will only work on this process")
+            secret = uuid.uuid4().hex
+        return LocalStorageBackend(LOCAL_STORAGE_DIR, STORAGE_PUBLIC_BASE_URL, secret)
+    backend = S3StorageBackend(s3_client, bucket_name, aws_region, s3_transfer_config)
+    if STORAGE_CACHE_DIR:
+        # Cache URLs are never handed out, so the cache tier needs no real secret
+        cache = LocalStorageBackend(STORAGE_CACHE_DIR, STORAGE_PUBLIC_BASE_URL, uuid.uuid4().hex)
+        backend = CachedStorageBackend(backend, cache, STORAGE_CACHE_MAX_OBJECT_BYTES, STORAGE_CACHE_MAX_BYTES)
+    return backend
+
+storage = create_storage_backend()
+
+def upload_to_s3(file_bytes, filename, key=None):
+    """
+    Uploads to the configured storage backend under a random unique key, or
+    under `key` when the caller owns the naming. Returns the object URL.
+    """
+    unique_filename = key or f"{uuid.uuid4()}_{filename}"
+    storage.put_bytes(unique_filename, file_bytes, get_content_type(filename))
+    return storage.url_for(unique_filename)
+
+def upload_fileobj_to_s3(fileobj, filename, key=None) -> dict:
+    """
+    Streams a seekable file object to S3 without reading it into memory
+    (multipart above S3_MULTIPART_THRESHOLD_BYTES). Returns
+    {"url", "key", "etag", "checksum", "size", "content_hash"}; checksum is the
+    SHA-256 of the content and content_hash matches get_s3_content_hash.
+    """
+    object_key = key or f"{uuid.uuid4()}_{filename}"
+    fileobj.seek(0)
+    sha256 = hashlib.sha256()
+    for chunk in iter(lambda: fileobj.read(S3_STREAM_CHUNK_SIZE), b""):
+        sha256.update(chunk)
+    size = fileobj.tell()
+    checksum = sha256.hexdigest()
+    fileobj.seek(0)
+    info = storage.put_fileobj(object_key, fileobj, get_content_type(filename), {"sha256": checksum})
+    fileobj.seek(0)
+    return {
+        "url": storage.url_for(object_key),
+        "key": object_key,
+        "etag": info["etag"],
+        "checksum": checksum,
+        "size": size,
+        "content_hash": f"{info['etag']}:{info['size']}",
+    }
+
+async def upload_documents_to_s3(files: Dict[str, Optional[UploadFile]]) -> Dict[str, dict]:
+    """
+    Uploads the given form files to S3 concurrently, streaming from the
+    spooled UploadFile. Missing files are skipped; results are keyed like
+    the input.
+    """
+    present = {name: f for name, f in files.items() if f}
+    results = await asyncio.gather(*(
+        asyncio.to_thread(upload_fileobj_to_s3, f.file, f.filename) for f in present.values()
+    ))
+    return dict(zip(present.keys(), results))
+
+def upload_summary(uploads: Dict[str, dict]) -> Dict[str, dict]:
+    """ETag/checksum details of each upload, for the API response."""
+    return {
+        name: {k: info[k] for k in ("etag", "checksum", "size", "content_hash")}
+        for name, info in uploads.items()
+    }
+
+# A cached URL is reused while it has at least this long left before it expires
+PRESIGNED_URL_MIN_REMAINING_SECONDS = int(os.getenv("PRESIGNED_URL_MIN_REMAINING_SECONDS", "900"))
+PRESIGNED_URL_CACHE_SIZE = int(os.getenv("PRESIGNED_URL_CACHE_SIZE", "10000"))
+
+presigned_url_cache = PresignedUrlCache(PRESIGNED_URL_CACHE_SIZE, PRESIGNED_URL_MIN_REMAINING_SECONDS)
 
 def generate_presigned_url(s3_url, expiration=3600):
     if not s3_url:
         return None
     try:
-        object_key = s3_url.split('/')[-1]
-        presigned_url = s3_client.generate_presigned_url(
-            'get_object',
-            Params={'Bucket': bucket_name, 'Key': object_key},
-            ExpiresIn=expiration
-        )
+        object_key = storage.key_from_url(s3_url)
+        if not object_key:
+            return None
+        cached = presigned_url_cache.get(object_key, expiration)
+        if cached:
+            return cached
+        presigned_url = storage.presign(object_key, expiration)
+        presigned_url_cache.put(object_key, presigned_url, expiration)
         return presigned_url
     except Exception as e:
         logger.error(f"Error generating presigned URL: {e}")
         return None
 
 def download_from_s3(s3_url: str) -> Optional[bytes]:
-    if not s3_url or "amazonaws.com" not in s3_url:
+    object_key = storage.key_from_url(s3_url)
+    if not object_key:
         return None
     try:
-        parts = s3_url.split("/")
-        object_key = parts[-1]
-        response = s3_client.get_object(Bucket=bucket_name, Key=object_key)
-        return response["Body"].read()
+        return storage.get_bytes(object_key)
     except Exception as e:
         logger.error(f"Error downloading from S3: {e}")
         return None
 
+def delete_from_s3(s3_url: str):
+    object_key = storage.key_from_url(s3_url)
+    if not object_key:
+        return
+    try:
+        storage.delete(object_key)
+    except Exception as e:
+        logger.error(f"Error deleting from S3: {e}")
+
+S3_STREAM_CHUNK_SIZE = int(os.getenv("S3_STREAM_CHUNK_SIZE", str(1024 * 1024)))
+# Spooled downloads stay in memory up to this size and move to a temp file above it
+S3_SPOOL_MAX_MEMORY_BYTES = int(os.getenv("S3_SPOOL_MAX_MEMORY_BYTES", str(8 * 1024 * 1024)))
+
+def iter_s3_object(s3_url: str, chunk_size: int = S3_STREAM_CHUNK_SIZE, byte_range: Optional[tuple] = None):
+    """
+    Yields a stored object (or an inclusive (start, end) byte range of it;
+    end=None reads to the end) in chunks of at most chunk_size bytes.
+    Yields nothing for URLs the storage backend does not own.
+    """
+    object_key = storage.key_from_url(s3_url)
+    if not object_key:
+        return
+    yield from storage.iter_chunks(object_key, chunk_size, byte_range)
+
+def spool_s3_object(s3_url: str, byte_range: Optional[tuple] = None):
+    """
+    Streams an S3 object into a SpooledTemporaryFile rewound to the start,
+    so large objects land on disk instead of in worker memory. Returns None
+    if the object is missing or empty; the caller closes the file.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=S3_SPOOL_MAX_MEMORY_BYTES)
+    try:
+        for chunk in iter_s3_object(s3_url, byte_range=byte_range):
+            spool.write(chunk)
+    except Exception as e:
+        logger.error(f"Error streaming from S3: {e}")
+        spool.close()
+        return None
+    if spool.tell() == 0:
+        spool.close()
+        return None
+    spool.seek(0)
+    return spool
+
+def iter_base64(fileobj, chunk_size: int = S3_STREAM_CHUNK_SIZE):
+    """
+    Base64-encodes a file object chunk by chunk. Chunks are cut on 3-byte
+    boundaries so the encoded pieces concatenate to the same result as
+    encoding the whole file at once.
+    """
+    pending = b""
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            break
+        data = pending + chunk
+        cut = len(data) - len(data) % 3
+        pending = data[cut:]
+        if cut:
+            yield base64.b64encode(data[:cut]).decode("ascii")
+    if pending:
+        yield base64.b64encode(pending).decode("ascii")
+
+def encode_data_url(fileobj, mime_type: str = "image/jpeg") -> str:
+    """Builds a base64 data URL directly from a file object, without a raw bytes copy."""
+    out = io.StringIO()
+    out.write(f"data:{mime_type};base64,")
+    for piece in iter_base64(fileobj):
+        out.write(piece)
+    return out.getvalue()
+
+def image_data_url(image: str, mime_type: str = "image/jpeg") -> str:
+    """Accepts either a ready data URL or bare base64 image data."""
+    if image.startswith("data:"):
+        return image
+    return f"data:{mime_type};base64,{image}"
+
+def get_s3_content_hash(s3_url: str) -> Optional[str]:
+    """
+    Returns a content fingerprint for an S3 object (its ETag plus size)
+    without downloading the body. None if the object can't be inspected.
+    """
+    object_key = storage.key_from_url(s3_url)
+    if not object_key:
+        return None
+    try:
+        head = storage.head(object_key)
+        if not head["etag"]:
+            return None
+        return f"{head['etag']}:{head['size']}"
+    except Exception as e:
+        logger.error(f"Error reading S3 object metadata: {e}")
+        return None
+
 def extract_text_from_pdf_bytes(pdf_bytes: bytes) -> str:
-    with pdfplumber.open(io.BytesIO(pdf_bytes)) as pdf:
+    return extract_text_from_pdf_file(io.BytesIO(pdf_bytes))
+
+def extract_text_from_pdf_file(fileobj) -> str:
+    with pdfplumber.open(fileobj) as pdf:
         all_text = ""
         for page in pdf.pages:
             page_text = page.extract_text()
@@ -428,21 +807,20 @@ def create_prescription_pdf(prescription_data: Dict[str, Any], patient_name="Unk
 
 
 
-def analyze_medical_image(image_data_b64, custom_prompt: str = None):
+async def analyze_medical_image(image_data_b64, custom_prompt: str = None):
     prompt_to_use = custom_prompt if custom_prompt is not None else FIXED_PROMPT_IMAGE
-    response = client.chat.completions.create(
+    return await llm_gateway.chat(
         model="o1",
         messages=[{
             "role": "user",
             "content": [
                 {"type": "text", "text": prompt_to_use},
-                {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_data_b64}"}}
+                {"type": "image_url", "image_url": {"url": image_data_url(image_data_b64)}}
             ]
         }]
     )
-    return response.choices[0].message.content.strip()
 
-def analyze_lab_report_text(lab_report_text: str) -> str:
+async def analyze_lab_report_text(lab_report_text: str) -> str:
     messages = [
         {"role": "system", "content": "You are an expert physician with a strong background in laboratory medicine."},
         {
@@ -468,15 +846,14 @@ def analyze_lab_report_text(lab_report_text: str) -> str:
             ),
         }
     ]
-    response = client.chat.completions.create(
+    return await llm_gateway.chat(
         model="gpt-4o",
         messages=messages,
         max_tokens=2048,
         # temperature=0.5
     )
-    return response.choices[0].message.content.strip()
 
-def analyze_prescription_text_or_image(content, is_pdf=False) -> str:
+async def analyze_prescription_text_or_image(content, is_pdf=False) -> str:
     if is_pdf:
         messages = [
             {
@@ -498,13 +875,12 @@ def analyze_prescription_text_or_image(content, is_pdf=False) -> str:
                 )
             }
         ]
-        response = client.chat.completions.create(
+        return await llm_gateway.chat(
             model="gpt-4o",
             messages=messages,
             max_tokens=1500,
             # temperature=0.5
         )
-        return response.choices[0].message.content.strip()
     else:
         prompt_for_prescription_image = (
             "You are a medical assistant with expertise in interpreting handwritten or image-based prescriptions. "
@@ -519,19 +895,18 @@ def analyze_prescription_text_or_image(content, is_pdf=False) -> str:
             "Provide your response in a concise, organized manner without adding unnecessary disclaimers. "
             "If certain parts of the prescription are illegible, state 'Illegible' rather than guessing."
         )
-        response = client.chat.completions.create(
+        return await llm_gateway.chat(
             model="o1",
             messages=[{
                 "role": "user",
                 "content": [
                     {"type": "text", "text": prompt_for_prescription_image},
-                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{content}"}}
+                    {"type": "image_url", "image_url": {"url": image_data_url(content)}}
                 ]
             }]
         )
-        return response.choices[0].message.content.strip()
 
-def get_medical_advice(
+def build_medical_advice_messages(
     department: str,
     chief_complaint: str,
     history_presenting_illness: str,
@@ -626,15 +1001,20 @@ Avoid disclaimers about needing further specialist follow-up.
         },
         {"role": "user", "content": prompt_text}
     ]
+    return messages
 
+async def get_medical_advice(*args, **kwargs) -> str:
+    messages = build_medical_advice_messages(*args, **kwargs)
     try:
-        response = client.chat.completions.create(model="gpt-4", messages=messages)
-        return response.choices[0].message.content.strip()
+        return await llm_gateway.chat(model="gpt-4", messages=messages)
+    except HTTPException:
+        # Gateway overload (queue full / timeout) must reach the client as a 503
+        raise
     except Exception as e:
         logging.error(f"Error generating medical advice: {e}")
         return "Error generating medical advice. Please try again later."
 
-def generate_prescription(diagnosis, tests, treatments, patient_info: dict = None) -> dict:
+async def generate_prescription(diagnosis, tests, treatments, patient_info: dict = None) -> dict:
 
     # Safely extract patient fields
     if not patient_info:
@@ -704,7 +1084,7 @@ Proposed Treatments: {", ".join(treatments)}
 
 Please provide your response as valid JSON with the keys:
 - 'diagnosis'
-- 'drugs' (array of medication entries or strings)
+- 'drugs' (array of objects with 'name', 'strength', 'frequency', 'duration')
 - 'instructions'
 - 'tests' (array of test strings)
 - 'follow_up'
@@ -715,25 +1095,28 @@ Please provide your response as valid JSON with the keys:
             {"role": "system", "content": "You are ChatGPT, a helpful medical assistant."},
             {"role": "user", "content": prompt}
         ]
-        response = client.chat.completions.create(
-            model="gpt-4",
+        return await llm_gateway.chat_json(
+            model=STRUCTURED_OUTPUT_MODEL,
             messages=messages,
+            schema=PRESCRIPTION_SCHEMA,
+            name="prescription",
             max_tokens=1800,
-            # temperature=0.7
         )
-        gpt_content = response.choices[0].message.content.strip()
-        
-        # Attempt to parse GPT's JSON output
-        prescription = json.loads(gpt_content)
-        return prescription
 
+    except StructuredOutputError as e:
+        # Unrecoverable model JSON is an upstream failure, not an empty result
+        raise HTTPException(status_code=502, detail=f"Model returned unusable output: {e}")
+    except HTTPException:
+        # Gateway overload (queue full / timeout) must reach the client as a 503
+        raise
     except Exception as e:
         logger.error(f"generate_prescription error: {e}")
-        # Fallback if GPT fails or sends invalid JSON
+        # Fallback if the provider call fails; instructions is a string like
+        # in PRESCRIPTION_SCHEMA (the old fallback used an empty list)
         return {
             "diagnosis": diagnosis,
             "drugs": [],
-            "instructions": [],
+            "instructions": "",
             "tests": tests,
             "follow_up": "Follow up with your doctor."
         }
@@ -746,15 +1129,15 @@ def is_image_file(url: str) -> bool:
     url_lower = url.lower()
     return url_lower.endswith(".png") or url_lower.endswith(".jpg") or url_lower.endswith(".jpeg")
 
-def analyze_lab_report_image(image_b64: str) -> str:
+async def analyze_lab_report_image(image_b64: str) -> str:
     prompt_for_lab_image = (
         "You have been provided an IMAGE of a lab report. "
         "Identify key lab values or findings that can be discerned visually, "
         "and provide a concise medical interpretation. Avoid disclaimers."
     )
-    return analyze_medical_image(image_b64, custom_prompt=prompt_for_lab_image)
+    return await analyze_medical_image(image_b64, custom_prompt=prompt_for_lab_image)
 
-def analyze_medical_imaging_pdf(text_content: str) -> str:
+async def analyze_medical_imaging_pdf(text_content: str) -> str:
     messages = [
         {"role": "system", "content": "You are a medical imaging specialist."},
         {"role": "user", "content": (
@@ -763,18 +1146,256 @@ def analyze_medical_imaging_pdf(text_content: str) -> str:
             f"{text_content}"
         )}
     ]
-    response = client.chat.completions.create(
+    return await llm_gateway.chat(
         model="gpt-4o",
         messages=messages,
         max_tokens=2048,
         # temperature=0.5
     )
-    return response.choices[0].message.content.strip()
 
-def insert_patient_complaints(patient_id: int, version_id: int, complaint_details: list):
+CARDIOLOGY_IMAGING_PROMPTS = {
+    "ECG/EKG": PROMPT_ECG,
+    "Echocardiography (ECHO)": PROMPT_ECHOCARDIOGRAPHY,
+    "Cardiac MRI": PROMPT_CARDIAC_MRI,
+    "CT Coronary Angiography": PROMPT_CT_CORONARY_ANGIO,
+}
+
+NEUROLOGY_IMAGING_PROMPTS = {
+    "MRI_SPINE": PROMPT_MRI_SPINE,
+    "MRI_HEAD": PROMPT_MRI_HEAD,
+    "CT_HEAD": PROMPT_CT_HEAD,
+    "PET_BRAIN": PROMPT_PET_BRAIN,
+    "SPECT_BRAIN": PROMPT_SPECT_BRAIN,
+    "DSA_BRAIN": PROMPT_DSA_BRAIN,
+    "Carotid_Doppler": PROMPT_CAROTID_DOPPLER,
+    "TRANSCRANIAL_DOPPLER": PROMPT_TRANSCRANIAL_DOPPLER,
+    "MYELOGRAPHY": PROMPT_MYELOGRAPHY,
+}
+
+def select_imaging_prompt(department: str, cardiology_imaging_type: str = "", neurology_imaging_type: str = "") -> str:
+    """
+    Picks the modality-specific imaging prompt for the department,
+    falling back to FIXED_PROMPT_IMAGE.
+    """
+    if department == "Cardiology" and cardiology_imaging_type:
+        return CARDIOLOGY_IMAGING_PROMPTS.get(cardiology_imaging_type, FIXED_PROMPT_IMAGE)
+    if department == "Neurology" and neurology_imaging_type:
+        return NEUROLOGY_IMAGING_PROMPTS.get(neurology_imaging_type, FIXED_PROMPT_IMAGE)
+    return FIXED_PROMPT_IMAGE
+
+# Persistent cache of document analyses, keyed by S3 content fingerprint,
+# analysis function and prompt. Bump ANALYSIS_CACHE_VERSION when the fixed
+# prompts inside the analyze_* functions change.
+ANALYSIS_CACHE_ENABLED = os.getenv("ANALYSIS_CACHE_ENABLED", "true").lower() == "true"
+ANALYSIS_CACHE_TTL_HOURS = int(os.getenv("ANALYSIS_CACHE_TTL_HOURS", "720"))
+ANALYSIS_CACHE_MAX_ENTRIES = int(os.getenv("ANALYSIS_CACHE_MAX_ENTRIES", "5000"))
+ANALYSIS_CACHE_VERSION = "1"
+
+SCHEMA_STATEMENTS.append("""
+    CREATE TABLE IF NOT EXISTS document_analysis_cache (
+        cache_key TEXT PRIMARY KEY,
+        analysis_function TEXT NOT NULL,
+        content_hash TEXT NOT NULL,
+        prompt_hash TEXT NOT NULL,
+        analysis_text TEXT NOT NULL,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        last_accessed_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    )
+""")
+SCHEMA_STATEMENTS.append("""
+    CREATE INDEX IF NOT EXISTS idx_document_analysis_cache_accessed
+    ON document_analysis_cache (last_accessed_at)
+""")
+
+def make_analysis_cache_key(content_hash: str, analysis_function: str, prompt: str = "") -> str:
+    prompt_hash = hashlib.sha256((prompt or "").encode("utf-8")).hexdigest()
+    raw = "|".join([ANALYSIS_CACHE_VERSION, analysis_function, prompt_hash, content_hash])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def analysis_cache_get(cache_key: str) -> Optional[str]:
+    query = text("""
+        UPDATE document_analysis_cache
+        SET last_accessed_at = now()
+        WHERE cache_key = :key
+          AND created_at > now() - make_interval(hours => :ttl)
+        RETURNING analysis_text
+    """)
+    try:
+        with engine.begin() as conn:
+            row = conn.execute(query, {"key": cache_key, "ttl": ANALYSIS_CACHE_TTL_HOURS}).fetchone()
+        return row[0] if row else None
+    except Exception as e:
+        logger.warning(f"Analysis cache read failed: {e}")
+        return None
+
+def analysis_cache_put(cache_key: str, content_hash: str, analysis_function: str, prompt: str, analysis_text: str):
+    upsert_query = text("""
+        INSERT INTO document_analysis_cache
+        (cache_key, analysis_function, content_hash, prompt_hash, analysis_text)
+        VALUES (:key, :func, :chash, :phash, :atext)
+        ON CONFLICT (cache_key) DO UPDATE
+        SET analysis_text = EXCLUDED.analysis_text,
+            created_at = now(),
+            last_accessed_at = now()
+    """)
+    expire_query = text("""
+        DELETE FROM document_analysis_cache
+        WHERE created_at <= now() - make_interval(hours => :ttl)
+    """)
+    trim_query = text("""
+        DELETE FROM document_analysis_cache
+        WHERE cache_key IN (
+            SELECT cache_key FROM document_analysis_cache
+            ORDER BY last_accessed_at DESC
+            OFFSET :max_entries
+        )
+    """)
+    try:
+        with engine.begin() as conn:
+            conn.execute(upsert_query, {
+                "key": cache_key,
+                "func": analysis_function,
+                "chash": content_hash,
+                "phash": hashlib.sha256((prompt or "").encode("utf-8")).hexdigest(),
+                "atext": analysis_text
+            })
+            conn.execute(expire_query, {"ttl": ANALYSIS_CACHE_TTL_HOURS})
+            conn.execute(trim_query, {"max_entries": ANALYSIS_CACHE_MAX_ENTRIES})
+    except Exception as e:
+        logger.warning(f"Analysis cache write failed: {e}")
+
+async def cached_document_analysis(url: str, analysis_function: str, prompt: str, compute, use_cache: bool = True) -> str:
+    """
+    Returns the cached analysis for (content of url, analysis_function, prompt)
+    or runs compute() and stores its result. use_cache=False skips the lookup
+    but still refreshes the stored entry.
+    """
+    if not ANALYSIS_CACHE_ENABLED:
+        return await compute()
+
+    content_hash = await asyncio.to_thread(get_s3_content_hash, url)
+    if not content_hash:
+        return await compute()
+
+    cache_key = make_analysis_cache_key(content_hash, analysis_function, prompt)
+    if use_cache:
+        cached = await asyncio.to_thread(analysis_cache_get, cache_key)
+        if cached is not None:
+            logger.info(f"Analysis cache hit for {analysis_function} ({url})")
+            return cached
+
+    result = await compute()
+    if result:
+        await asyncio.to_thread(analysis_cache_put, cache_key, content_hash, analysis_function, prompt, result)
+    return result
+
+def load_document_input(url: str, is_pdf: bool) -> Optional[str]:
+    """
+    Downloads a document and returns its PDF text or image data URL, or None
+    if it is missing. The spooled download is closed before returning, so it
+    is not held open during the model call.
+    """
+    document = spool_s3_object(url)
+    if document is None:
+        return None
+    with document:
+        if is_pdf:
+            return extract_text_from_pdf_file(document)
+        return encode_data_url(document)
+
+async def analyze_lab_report_document(url: str, use_cache: bool = True) -> str:
+    """Download one lab report (PDF or image) and analyze it."""
+    if is_pdf_file(url):
+        analysis_function = "analyze_lab_report_text"
+    elif is_image_file(url):
+        analysis_function = "analyze_lab_report_image"
+    else:
+        return ""
+
+    async def compute():
+        content = await asyncio.to_thread(load_document_input, url, is_pdf_file(url))
+        if content is None:
+            return ""
+        if is_pdf_file(url):
+            return await analyze_lab_report_text(content)
+        return await analyze_lab_report_image(content)
+
+    return await cached_document_analysis(url, analysis_function, "", compute, use_cache)
+
+async def analyze_medical_imaging_document(url: str, custom_prompt: str, use_cache: bool = True) -> str:
+    """Download one imaging study (PDF report or image) and analyze it."""
+    if is_pdf_file(url):
+        analysis_function, prompt = "analyze_medical_imaging_pdf", ""
+    else:
+        analysis_function, prompt = "analyze_medical_image", custom_prompt
+
+    async def compute():
+        content = await asyncio.to_thread(load_document_input, url, is_pdf_file(url))
+        if content is None:
+            return ""
+        if is_pdf_file(url):
+            return await analyze_medical_imaging_pdf(content)
+        return await analyze_medical_image(content, custom_prompt=custom_prompt)
+
+    return await cached_document_analysis(url, analysis_function, prompt, compute, use_cache)
+
+async def analyze_previous_prescription_document(url: str, use_cache: bool = True) -> str:
+    """Download a previous prescription (PDF or image) and summarize it."""
+    is_pdf = url.lower().endswith(".pdf")
+    analysis_function = "analyze_prescription_text" if is_pdf else "analyze_prescription_image"
+
+    async def compute():
+        content = await asyncio.to_thread(load_document_input, url, is_pdf)
+        if content is None:
+            return ""
+        return await analyze_prescription_text_or_image(content, is_pdf=is_pdf)
+
+    return await cached_document_analysis(url, analysis_function, "", compute, use_cache)
+
+def document_analysis_jobs(
+    row,
+    include_lab_report: bool = True,
+    include_medical_imaging: bool = True,
+    include_prescription: bool = True,
+    use_cache: bool = True,
+) -> Dict[str, Any]:
+    """
+    Builds one analysis coroutine per document attached to the patient row,
+    keyed by analysis type ("lab_report", "medical_imaging", "previous_prescription").
+    """
+    jobs = {}
+    if row["lab_report_url"] and include_lab_report:
+        jobs["lab_report"] = analyze_lab_report_document(row["lab_report_url"], use_cache=use_cache)
+
+    if row["medical_imaging_url"] and include_medical_imaging:
+        custom_prompt = select_imaging_prompt(
+            row.get("department", ""),
+            row.get("cardiology_imaging_type", ""),
+            row.get("neurology_imaging_type", ""),
+        )
+        jobs["medical_imaging"] = analyze_medical_imaging_document(row["medical_imaging_url"], custom_prompt, use_cache=use_cache)
+
+    if row["previous_prescription_url"] and include_prescription:
+        jobs["previous_prescription"] = analyze_previous_prescription_document(row["previous_prescription_url"], use_cache=use_cache)
+    return jobs
+
+async def run_document_analyses(row, **options) -> Dict[str, str]:
+    """
+    Fan-out stage for /api/advice: downloads and analyzes the lab report,
+    medical image and previous prescription concurrently through llm_gateway.
+    Returns {"lab_report": ..., "medical_imaging": ..., "previous_prescription": ...}.
+    """
+    jobs = document_analysis_jobs(row, **options)
+    results = await asyncio.gather(*jobs.values())
+    analyses = {"lab_report": "", "medical_imaging": "", "previous_prescription": ""}
+    analyses.update(zip(jobs.keys(), results))
+    return analyses
+
+def insert_patient_complaints(patient_id: int, version_id: int, complaint_details: list, conn=None):
     """
     Insert each row from 'chief_complaint_details' (or a derived list) into
     the patient_chief_complaints table, linking them to both patient_id and version_id.
+    All rows go in a single executemany call.
     """
     if not complaint_details:
         return
@@ -783,16 +1404,19 @@ def insert_patient_complaints(patient_id: int, version_id: int, complaint_detail
         (patient_id, version_id, complaint, frequency, severity, duration)
         VALUES (:pid, :vid, :c, :f, :s, :d)
     """)
-    with engine.begin() as conn:
-        for row in complaint_details:
-            conn.execute(query, {
-                "pid": patient_id,
-                "vid": version_id,
-                "c": row.get("complaint",""),
-                "f": row.get("frequency",""),
-                "s": row.get("severity",""),
-                "d": row.get("duration","")
-            })
+    params = [
+        {
+            "pid": patient_id,
+            "vid": version_id,
+            "c": row.get("complaint",""),
+            "f": row.get("frequency",""),
+            "s": row.get("severity",""),
+            "d": row.get("duration","")
+        }
+        for row in complaint_details
+    ]
+    with write_transaction(conn) as tx:
+        tx.execute(query, params)
 
 def insert_patient_version(
     patient_id: int,
@@ -840,7 +1464,8 @@ def insert_patient_version(
     neurology_imaging_type: str = None,
     uhid: str = None,
     guardian_name: str = None,
-    consultant_doctor: str = None
+    consultant_doctor: str = None,
+    conn=None
 ):
     logger.info(f"Inserting new version row for patient {patient_id}.")
     if lmp == "":
@@ -949,8 +1574,8 @@ def insert_patient_version(
         RETURNING id
     """)
 
-    with engine.begin() as conn:
-        result = conn.execute(version_query, {
+    with write_transaction(conn) as tx:
+        result = tx.execute(version_query, {
             'pid': patient_id,
             'pname': name,
             'page': age,
@@ -1044,8 +1669,14 @@ def update_patient_info(
     medical_advice: str = None,
     uhid: str = None,
     guardian_name: str = None,
-    consultant_doctor: str = None
+    consultant_doctor: str = None,
+    complaint_details: list = None,
+    conn=None
 ):
+    """
+    Updates patient_info, then writes the new version row and its complaint
+    rows in the same transaction. Returns the new version id.
+    """
     logger.info(f"Updating patient_info ID: {patient_id}")
     if lmp == "":
         lmp = None
@@ -1099,8 +1730,8 @@ def update_patient_info(
         WHERE id = :pid
     """)
 
-    with engine.begin() as conn:
-        conn.execute(update_query, {
+    with write_transaction(conn) as tx:
+        tx.execute(update_query, {
             'pid': patient_id,
             'pname': name,
             'page': age,
@@ -1145,51 +1776,53 @@ def update_patient_info(
             'cdoctor': consultant_doctor or "",
         })
 
-    # Now insert a new version row (and return its ID)
-    new_version_id = insert_patient_version(
-        patient_id=patient_id,
-        name=name,
-        age=age,
-        gender=gender,
-        contact_number=contact_number,
-        department=department or "",
-        chief_complaint=chief_complaint or "",
-        history_presenting_illness=history_presenting_illness or "",
-        past_history=past_history or "",
-        personal_history=personal_history or "",
-        family_history=family_history or "",
-        obg_history=obg_history or "",
-        lab_report_url=lab_report_url,
-        medical_imaging_url=medical_imaging_url,
-        previous_prescription_url=previous_prescription_url,
-        cardiology_imaging_type=cardiology_imaging_type or "",
-        neurology_imaging_type=neurology_imaging_type or "",
-        medical_advice=medical_advice,
-        blood_group=blood_group,
-        preferred_language=preferred_language,
-        email=email,
-        address=address,
-        city=city,
-        pin=pin,
-        referred_by=referred_by,
-        channel=channel,
-        bp=bp,
-        pulse=pulse,
-        height=height,
-        weight=weight,
-        head_round=head_round,
-        temperature=temperature,
-        bmi=bmi,
-        spo2=spo2,
-        lmp=lmp,
-        edd=edd,
-        allergies=allergies,
-        medication_history=medication_history,
-        surgical_history=surgical_history,
-        uhid=uhid,
-        guardian_name=guardian_name,
-        consultant_doctor=consultant_doctor
-    )
+        # Now insert a new version row (and return its ID)
+        new_version_id = insert_patient_version(
+            patient_id=patient_id,
+            name=name,
+            age=age,
+            gender=gender,
+            contact_number=contact_number,
+            department=department or "",
+            chief_complaint=chief_complaint or "",
+            history_presenting_illness=history_presenting_illness or "",
+            past_history=past_history or "",
+            personal_history=personal_history or "",
+            family_history=family_history or "",
+            obg_history=obg_history or "",
+            lab_report_url=lab_report_url,
+            medical_imaging_url=medical_imaging_url,
+            previous_prescription_url=previous_prescription_url,
+            cardiology_imaging_type=cardiology_imaging_type or "",
+            neurology_imaging_type=neurology_imaging_type or "",
+            medical_advice=medical_advice,
+            blood_group=blood_group,
+            preferred_language=preferred_language,
+            email=email,
+            address=address,
+            city=city,
+            pin=pin,
+            referred_by=referred_by,
+            channel=channel,
+            bp=bp,
+            pulse=pulse,
+            height=height,
+            weight=weight,
+            head_round=head_round,
+            temperature=temperature,
+            bmi=bmi,
+            spo2=spo2,
+            lmp=lmp,
+            edd=edd,
+            allergies=allergies,
+            medication_history=medication_history,
+            surgical_history=surgical_history,
+            uhid=uhid,
+            guardian_name=guardian_name,
+            consultant_doctor=consultant_doctor,
+            conn=tx
+        )
+        insert_patient_complaints(patient_id, new_version_id, complaint_details, conn=tx)
 
     return new_version_id
 
@@ -1282,7 +1915,8 @@ def update_patient_final_choices(
                 edd=row.get("edd"),
                 allergies=row.get("allergies", ""),
                 medication_history=row.get("medication_history", ""),
-                surgical_history=row.get("surgical_history", "")
+                surgical_history=row.get("surgical_history", ""),
+                conn=conn
             )
             return
 
@@ -1348,18 +1982,60 @@ def update_patient_final_choices(
                 edd=row.get("edd"),
                 allergies=row.get("allergies", ""),
                 medication_history=row.get("medication_history", ""),
-                surgical_history=row.get("surgical_history", "")
+                surgical_history=row.get("surgical_history", ""),
+                conn=conn
             )
 
+# Trigram indexes back the substring (ILIKE '%...%') name/contact filters and
+# the similarity ranking used by /api/search.
+SCHEMA_STATEMENTS.append("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+SCHEMA_STATEMENTS.append("""
+    CREATE INDEX IF NOT EXISTS idx_patient_info_name_trgm
+    ON patient_info USING gin (patient_name gin_trgm_ops)
+""")
+SCHEMA_STATEMENTS.append("""
+    CREATE INDEX IF NOT EXISTS idx_patient_info_contact_trgm
+    ON patient_info USING gin (contact_number gin_trgm_ops)
+""")
+
+SEARCH_DEFAULT_LIMIT = 50
+SEARCH_MAX_LIMIT = 200
+
+def decode_search_cursor(cursor: str):
+    try:
+        return decode_cursor(cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
 def search_patients(
     patient_id=None,
     name=None,
     age=None,
     gender=None,
-    contact=None
+    contact=None,
+    limit: int = None,
+    cursor: str = None
 ):
-    query = "SELECT * FROM patient_info WHERE 1=1"
+    """
+    Returns (records, next_cursor). Records carry only the columns the search
+    screens display and are ordered by name similarity, then newest id.
+    Pagination is keyset-based on (score, id); pass next_cursor back as
+    cursor to get the following page. Without limit or cursor every match is
+    returned (the original unpaged behaviour) and next_cursor is None.
+    """
     params = {}
+    if name:
+        score_expr = "ROUND(similarity(patient_name, :name_raw)::numeric, 6)"
+        params["name_raw"] = name
+    else:
+        score_expr = "0::numeric"
+
+    query = f"""
+        SELECT id, patient_name, age, gender, contact_number, department, uhid,
+               {score_expr} AS score
+        FROM patient_info
+        WHERE 1=1
+    """
 
     if patient_id is not None:
         query += " AND id = :pid"
@@ -1380,9 +2056,28 @@ def search_patients(
         query += " AND contact_number ILIKE :contact"
         params["contact"] = f"%{contact}%"
 
+    query = f"SELECT * FROM ({query}) ranked"
+    if cursor:
+        params["cursor_score"], params["cursor_id"] = decode_search_cursor(cursor)
+        query += " WHERE (score, id) < (:cursor_score, :cursor_id)"
+
+    query += " ORDER BY score DESC, id DESC"
+    paged = bool(limit or cursor)
+    if paged:
+        limit = max(1, min(limit or SEARCH_DEFAULT_LIMIT, SEARCH_MAX_LIMIT))
+        query += " LIMIT :limit"
+        params["limit"] = limit + 1
+
     with engine.connect() as conn:
-        result = conn.execute(text(query), params).mappings().all()
-        return [dict(r) for r in result]
+        rows = [dict(r) for r in conn.execute(text(query), params).mappings().all()]
+
+    next_cursor = None
+    if paged and len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]["score"], rows[-1]["id"])
+    for row in rows:
+        row.pop("score", None)
+    return rows, next_cursor
 
 def get_patient_versions(patient_id: int):
     sel_query = text("""
@@ -1400,6 +2095,93 @@ def get_version_by_id(version_id: int):
         row = conn.execute(sel_query, {'vid': version_id}).mappings().first()
         return dict(row) if row else None
 
+# Per-document analyses produced by /api/advice, linked to the version they
+# were generated for so later steps (prescription generation) can reuse them.
+SCHEMA_STATEMENTS.append("""
+    CREATE TABLE IF NOT EXISTS patient_version_analyses (
+        id SERIAL PRIMARY KEY,
+        patient_id INTEGER NOT NULL,
+        version_id INTEGER NOT NULL REFERENCES patient_info_versions(id) ON DELETE CASCADE,
+        analysis_type TEXT NOT NULL,
+        source_url TEXT,
+        analysis_text TEXT NOT NULL,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        UNIQUE (version_id, analysis_type)
+    )
+""")
+SCHEMA_STATEMENTS.append("""
+    CREATE INDEX IF NOT EXISTS idx_patient_version_analyses_patient
+    ON patient_version_analyses (patient_id, created_at DESC)
+""")
+
+# analysis_type -> patient_info column holding the analyzed document
+ANALYSIS_SOURCE_COLUMNS = {
+    "lab_report": "lab_report_url",
+    "medical_imaging": "medical_imaging_url",
+    "previous_prescription": "previous_prescription_url",
+}
+
+def save_version_analyses(patient_id: int, version_id: int, row, analyses: Dict[str, str]):
+    """
+    Stores the non-empty analyses (keyed by analysis_type) for a version,
+    recording which document URL each one was computed from.
+    """
+    params = []
+    for analysis_type, analysis_text in analyses.items():
+        if not analysis_text:
+            continue
+        params.append({
+            "pid": patient_id,
+            "vid": version_id,
+            "atype": analysis_type,
+            "url": row.get(ANALYSIS_SOURCE_COLUMNS[analysis_type]),
+            "atext": analysis_text
+        })
+    if not params:
+        return
+    insert_query = text("""
+        INSERT INTO patient_version_analyses
+        (patient_id, version_id, analysis_type, source_url, analysis_text)
+        VALUES (:pid, :vid, :atype, :url, :atext)
+        ON CONFLICT (version_id, analysis_type) DO UPDATE
+        SET source_url = EXCLUDED.source_url,
+            analysis_text = EXCLUDED.analysis_text,
+            created_at = now()
+    """)
+    with engine.begin() as conn:
+        conn.execute(insert_query, params)
+
+def get_latest_patient_analyses(patient_id: int, row) -> Dict[str, str]:
+    """
+    Latest stored analysis per document type for a patient, limited to
+    analyses of the documents currently attached to the patient row.
+    """
+    query = text("""
+        SELECT DISTINCT ON (analysis_type) analysis_type, source_url, analysis_text
+        FROM patient_version_analyses
+        WHERE patient_id = :pid
+        ORDER BY analysis_type, created_at DESC
+    """)
+    with engine.connect() as conn:
+        rows = conn.execute(query, {"pid": patient_id}).mappings().all()
+    analyses = {}
+    for r in rows:
+        column = ANALYSIS_SOURCE_COLUMNS.get(r["analysis_type"])
+        if column and r["source_url"] and r["source_url"] == row.get(column):
+            analyses[r["analysis_type"]] = r["analysis_text"]
+    return analyses
+
+def get_version_analyses(version_id: int):
+    query = text("""
+        SELECT analysis_type, source_url, analysis_text, created_at
+        FROM patient_version_analyses
+        WHERE version_id = :vid
+        ORDER BY analysis_type
+    """)
+    with engine.connect() as conn:
+        rows = conn.execute(query, {"vid": version_id}).mappings().all()
+    return [dict(r) for r in rows]
+
 @app.post("/api/patient")
 async def create_patient(
     request: Request,
@@ -1437,7 +2219,6 @@ async def create_patient(
         surgical_history = form_data.get("surgical_history", "")
 
         extracted_text = None
-        lab_report_url = None
         if lab_report_file:
             filename = lab_report_file.filename.lower()
             if not (filename.endswith(".pdf") or filename.endswith(".png") or filename.endswith(".jpg") or filename.endswith(".jpeg")):
@@ -1445,22 +2226,8 @@ async def create_patient(
                     status_code=status.HTTP_400_BAD_REQUEST,
                     detail="lab_report_file must be a PDF or image (png/jpg/jpeg)."
                 )
-            pdf_bytes = await lab_report_file.read()
-            lab_report_url = upload_to_s3(pdf_bytes, lab_report_file.filename)
-            if filename.endswith(".pdf"):
-                extracted_text = extract_text_from_pdf_bytes(pdf_bytes)
 
-        medical_imaging_url = None
-        image_data_b64 = None
-        if medical_imaging_file:
-            file_bytes = await medical_imaging_file.read()
-            medical_imaging_url = upload_to_s3(file_bytes, medical_imaging_file.filename)
-            if medical_imaging_file.filename.lower().endswith((".png", ".jpg", ".jpeg")):
-                image_data_b64 = base64.b64encode(file_bytes).decode("utf-8")
-
-        previous_prescription_url = None
         if previous_prescription_file:
-            pres_bytes = await previous_prescription_file.read()
             if not (previous_prescription_file.filename.lower().endswith(".pdf") or
                     previous_prescription_file.filename.lower().endswith(".png") or
                     previous_prescription_file.filename.lower().endswith(".jpg") or
@@ -1469,7 +2236,23 @@ async def create_patient(
                     status_code=status.HTTP_400_BAD_REQUEST,
                     detail="previous_prescription_file must be a PDF or image (png/jpg/jpeg)."
                 )
-            previous_prescription_url = upload_to_s3(pres_bytes, previous_prescription_file.filename)
+
+        uploads = await upload_documents_to_s3({
+            "lab_report": lab_report_file,
+            "medical_imaging": medical_imaging_file,
+            "previous_prescription": previous_prescription_file,
+        })
+        lab_report_url = uploads["lab_report"]["url"] if "lab_report" in uploads else None
+        medical_imaging_url = uploads["medical_imaging"]["url"] if "medical_imaging" in uploads else None
+        previous_prescription_url = uploads["previous_prescription"]["url"] if "previous_prescription" in uploads else None
+
+        if lab_report_file and lab_report_file.filename.lower().endswith(".pdf"):
+            extracted_text = await asyncio.to_thread(extract_text_from_pdf_file, lab_report_file.file)
+
+        image_data_b64 = None
+        if medical_imaging_file and medical_imaging_file.filename.lower().endswith((".png", ".jpg", ".jpeg")):
+            medical_imaging_file.file.seek(0)
+            image_data_b64 = "".join(iter_base64(medical_imaging_file.file))
 
         lmp = form_data.get("lmp", "")
         edd = form_data.get("edd", "")
@@ -1619,57 +2402,59 @@ async def create_patient(
             })
             new_id = result.fetchone()[0]
 
-        new_version_id = insert_patient_version(
-            patient_id=new_id,
-            name=form_data["name"],
-            age=form_data["age"],
-            gender=form_data["gender"],
-            contact_number=form_data["contact_number"],
-            department=form_data.get("department", ""),
-            chief_complaint=form_data.get("chief_complaint", ""),
-            history_presenting_illness=form_data.get("history_presenting_illness", ""),
-            past_history=form_data.get("past_history", ""),
-            personal_history=form_data.get("personal_history", ""),
-            family_history=form_data.get("family_history", ""),
-            obg_history=obg_val,
-            lab_report_url=lab_report_url,
-            medical_imaging_url=medical_imaging_url,
-            previous_prescription_url=previous_prescription_url,
-            cardiology_imaging_type=cardiology_imaging_type,
-            neurology_imaging_type=neurology_imaging_type,
-            blood_group=form_data.get("blood_group", ""),
-            preferred_language=form_data.get("preferred_language", ""),
-            email=form_data.get("email", ""),
-            address=form_data.get("address", ""),
-            city=form_data.get("city", ""),
-            pin=form_data.get("pin", ""),
-            referred_by=form_data.get("referred_by", ""),
-            channel=form_data.get("channel", ""),
-            bp=form_data.get("bp", ""),
-            pulse=form_data.get("pulse", ""),
-            height=form_data.get("height", ""),
-            weight=form_data.get("weight", ""),
-            head_round=form_data.get("head_round", ""),
-            temperature=form_data.get("temperature", ""),
-            bmi=form_data.get("bmi", ""),
-            spo2=form_data.get("spo2", ""),
-            lmp=lmp,
-            edd=edd,
-            allergies=allergies,
-            medication_history=medication_history,
-            surgical_history=surgical_history,
-            uhid=uhid,
-            guardian_name=guardian_name,
-            consultant_doctor=consultant_doctor
-        )
+            new_version_id = insert_patient_version(
+                patient_id=new_id,
+                name=form_data["name"],
+                age=form_data["age"],
+                gender=form_data["gender"],
+                contact_number=form_data["contact_number"],
+                department=form_data.get("department", ""),
+                chief_complaint=form_data.get("chief_complaint", ""),
+                history_presenting_illness=form_data.get("history_presenting_illness", ""),
+                past_history=form_data.get("past_history", ""),
+                personal_history=form_data.get("personal_history", ""),
+                family_history=form_data.get("family_history", ""),
+                obg_history=obg_val,
+                lab_report_url=lab_report_url,
+                medical_imaging_url=medical_imaging_url,
+                previous_prescription_url=previous_prescription_url,
+                cardiology_imaging_type=cardiology_imaging_type,
+                neurology_imaging_type=neurology_imaging_type,
+                blood_group=form_data.get("blood_group", ""),
+                preferred_language=form_data.get("preferred_language", ""),
+                email=form_data.get("email", ""),
+                address=form_data.get("address", ""),
+                city=form_data.get("city", ""),
+                pin=form_data.get("pin", ""),
+                referred_by=form_data.get("referred_by", ""),
+                channel=form_data.get("channel", ""),
+                bp=form_data.get("bp", ""),
+                pulse=form_data.get("pulse", ""),
+                height=form_data.get("height", ""),
+                weight=form_data.get("weight", ""),
+                head_round=form_data.get("head_round", ""),
+                temperature=form_data.get("temperature", ""),
+                bmi=form_data.get("bmi", ""),
+                spo2=form_data.get("spo2", ""),
+                lmp=lmp,
+                edd=edd,
+                allergies=allergies,
+                medication_history=medication_history,
+                surgical_history=surgical_history,
+                uhid=uhid,
+                guardian_name=guardian_name,
+                consultant_doctor=consultant_doctor,
+                conn=conn
+            )
 
-        insert_patient_complaints(new_id, new_version_id, chief_complaint_list)
+            insert_patient_complaints(new_id, new_version_id, chief_complaint_list, conn=conn)
 
         return {
             "message": "Patient info saved successfully",
             "patient_id": new_id,
             "extracted_lab_text": extracted_text or "",
-            "image_data_b64": image_data_b64 or ""
+            "image_data_b64": image_data_b64 or "",
+            "uploads": upload_summary(uploads),
         }
 
     except HTTPException as he:
@@ -1684,12 +2469,18 @@ async def create_patient(
 @app.put("/api/patient/{patient_id}")
 async def api_update_patient(patient_id: int, payload: dict):
     try:
+        chief_str = payload.get("chief_complaint_details","[]")
+        try:
+            complaint_list = json.loads(chief_str)
+        except:
+            complaint_list = []
+
         allergies = payload.get("allergies", "")
         medication_history = payload.get("medication_history", "")
         surgical_history = payload.get("surgical_history", "")
         neurology_imaging_type = payload.get("neurology_imaging_type", "")
 
-        new_version_id = update_patient_info(
+        update_patient_info(
             patient_id=patient_id,
             name=payload["name"],
             age=payload["age"],
@@ -1709,16 +2500,10 @@ async def api_update_patient(patient_id: int, payload: dict):
             neurology_imaging_type=neurology_imaging_type,
             allergies=allergies,
             medication_history=medication_history,
-            surgical_history=surgical_history
+            surgical_history=surgical_history,
+            complaint_details=complaint_list
         )
 
-        chief_str = payload.get("chief_complaint_details","[]")
-        try:
-            complaint_list = json.loads(chief_str)
-        except:
-            complaint_list = []
-        insert_patient_complaints(patient_id, new_version_id, complaint_list)
-
         return {"message": "Patient updated successfully."}
     except KeyError as ke:
         raise HTTPException(status_code=400, detail=f"Missing field: {ke}")
@@ -1735,17 +2520,27 @@ async def api_search(
     name: Optional[str] = Query(None),
     age: Optional[int] = Query(None),
     gender: Optional[str] = Query(None),
-    contact: Optional[str] = Query(None)
+    contact: Optional[str] = Query(None),
+    limit: Optional[int] = Query(None, ge=1, le=SEARCH_MAX_LIMIT),
+    cursor: Optional[str] = Query(None)
 ):
+    """
+    Pass limit (and then next_cursor as cursor) to page through the results;
+    without either, all matches are returned as before.
+    """
     try:
-        records = search_patients(
+        records, next_cursor = search_patients(
             patient_id=patient_id,
             name=name,
             age=age,
             gender=gender,
-            contact=contact
+            contact=contact,
+            limit=limit,
+            cursor=cursor
         )
-        return {"count": len(records), "records": records}
+        return {"count": len(records), "records": records, "next_cursor": next_cursor}
+    except HTTPException as he:
+        raise he
     except Exception as e:
         logger.exception("Error searching patients")
         raise HTTPException(
@@ -1809,40 +2604,49 @@ async def update_patient_with_files(
         if not existing:
             raise HTTPException(status_code=404, detail="No patient found with that ID")
 
+        chief_str = form_data.get("chief_complaint_details","[]")
+        try:
+            complaint_list = json.loads(chief_str)
+        except:
+            complaint_list = []
+
         allergies = form_data.get("allergies", "")
         medication_history = form_data.get("medication_history", "")
         surgical_history = form_data.get("surgical_history", "")
         neurology_imaging_type = form_data.get("neurology_imaging_type", "")
 
-        lab_report_url = existing["lab_report_url"]
         if lab_report_file:
             filename = lab_report_file.filename.lower()
             if not (filename.endswith(".pdf") or filename.endswith(".png") or filename.endswith(".jpg") or filename.endswith(".jpeg")):
                 raise HTTPException(status_code=400, detail="lab_report_file must be PDF/PNG/JPG/JPEG")
-            pdf_bytes = await lab_report_file.read()
-            lab_report_url = upload_to_s3(pdf_bytes, lab_report_file.filename)
 
-        medical_imaging_url = existing["medical_imaging_url"]
         if medical_imaging_file:
-            img_bytes = await medical_imaging_file.read()
             if not (medical_imaging_file.filename.lower().endswith(".pdf") or
                     medical_imaging_file.filename.lower().endswith(".png") or
                     medical_imaging_file.filename.lower().endswith(".jpg") or
                     medical_imaging_file.filename.lower().endswith(".jpeg")):
                 raise HTTPException(status_code=400, detail="medical_imaging_file must be PDF/PNG/JPG/JPEG")
-            medical_imaging_url = upload_to_s3(img_bytes, medical_imaging_file.filename)
 
-        previous_prescription_url = existing["previous_prescription_url"]
         if previous_prescription_file:
-            pres_bytes = await previous_prescription_file.read()
             if not (previous_prescription_file.filename.lower().endswith(".pdf") or
                     previous_prescription_file.filename.lower().endswith(".png") or
                     previous_prescription_file.filename.lower().endswith(".jpg") or
                     previous_prescription_file.filename.lower().endswith(".jpeg")):
                 raise HTTPException(status_code=400, detail="previous_prescription_file must be PDF/PNG/JPG/JPEG")
-            previous_prescription_url = upload_to_s3(pres_bytes, previous_prescription_file.filename)
 
-        new_version_id = update_patient_info(
+        uploads = await upload_documents_to_s3({
+            "lab_report": lab_report_file,
+            "medical_imaging": medical_imaging_file,
+            "previous_prescription": previous_prescription_file,
+        })
+        lab_report_url = uploads["lab_report"]["url"] if "lab_report" in uploads else existing["lab_report_url"]
+        medical_imaging_url = uploads["medical_imaging"]["url"] if "medical_imaging" in uploads else existing["medical_imaging_url"]
+        previous_prescription_url = (
+            uploads["previous_prescription"]["url"] if "previous_prescription" in uploads
+            else existing["previous_prescription_url"]
+        )
+
+        update_patient_info(
             patient_id=patient_id,
             name=form_data.get("name", existing["patient_name"]),
             age=form_data.get("age", existing["age"]),
@@ -1862,17 +2666,14 @@ async def update_patient_with_files(
             neurology_imaging_type=neurology_imaging_type,
             allergies=allergies,
             medication_history=medication_history,
-            surgical_history=surgical_history
+            surgical_history=surgical_history,
+            complaint_details=complaint_list
         )
 
-        chief_str = form_data.get("chief_complaint_details","[]")
-        try:
-            complaint_list = json.loads(chief_str)
-        except:
-            complaint_list = []
-        insert_patient_complaints(patient_id, new_version_id, complaint_list)
-
-        return {"message": "Patient updated successfully (new version created)."}
+        return {
+            "message": "Patient updated successfully (new version created).",
+            "uploads": upload_summary(uploads),
+        }
     except HTTPException as he:
         raise he
     except Exception as e:
@@ -1935,116 +2736,122 @@ def parse_final_choices(row):
 
     return final_diagnosis_list, final_tests_list, final_treatment_list
 
-@app.post("/api/prescription/generate")
-async def api_generate_prescription(data: dict):
+async def produce_prescription(data: dict) -> dict:
     """
     Creates a prescription by calling generate_prescription with either final choices
     (if they exist) or fallback to whatever is stored from SavePatientInfo.
     If no final choices exist, also uses all possible fields from the DB row
     (department, vitals, etc.) to build GPT context.
     """
-    try:
-        input_diagnosis = data.get("diagnosis", "")
-        input_tests = data.get("tests", [])
-        input_treatments = data.get("treatments", [])
-        input_patient_info = data.get("patient_info", {})
-        
-        pid = None
-        if "patient_id" in data:
-            pid = data["patient_id"]
-        elif input_patient_info and "patient_id" in input_patient_info:
-            pid = input_patient_info["patient_id"]
-        
-        row = None
-        if pid:
-            query = text("SELECT * FROM patient_info WHERE id = :pid")
-            with engine.connect() as conn:
-                row = conn.execute(query, {"pid": pid}).mappings().first()
-        
-        final_dx_list = []
-        final_tests_list = []
-        final_treatment_list = []
-        
-        if row:
-            dx_list, tests_list, treat_list = parse_final_choices(row)
-            final_dx_list = dx_list
-            final_tests_list = tests_list
-            final_treatment_list = treat_list
-        
-        has_final_choices = (len(final_dx_list) > 0 or len(final_tests_list) > 0 or len(final_treatment_list) > 0)
-        
-        full_patient_info = {}
-        
-        if row:
-            full_patient_info = {
-                "name": row.get("patient_name", ""),
-                "age": row.get("age", ""),
-                "gender": row.get("gender", ""),
-                "department": row.get("department", ""),
-                "chief_complaint": row.get("chief_complaint", ""),
-                "history_presenting_illness": row.get("history_of_presenting_illness", ""),
-                "past_history": row.get("past_history", ""),
-                "personal_history": row.get("personal_history", ""),
-                "family_history": row.get("family_history", ""),
-                "obg_history": row.get("obg_history", ""),
-                "allergies": row.get("allergies", ""),
-                "medication_history": row.get("medication_history", ""),
-                "surgical_history": row.get("surgical_history", ""),
-                "bp": row.get("bp", ""),
-                "pulse": row.get("pulse", ""),
-                "temperature": row.get("temperature", ""),
-                "bmi": row.get("bmi", ""),
-                "spo2": row.get("spo2", ""),
-                "image_analysis_text": "",
-                "lab_analysis_text": "",
-                "prescription_analysis_text": "",
-            }
-        else:
-            full_patient_info = {
-                "name": input_patient_info.get("name", ""),
-                "age": input_patient_info.get("age", ""),
-                "gender": input_patient_info.get("gender", ""),
-                "department": input_patient_info.get("department", ""),
-                "chief_complaint": input_patient_info.get("chief_complaint", ""),
-                "history_presenting_illness": input_patient_info.get("history_presenting_illness", ""),
-                "past_history": input_patient_info.get("past_history", ""),
-                "personal_history": input_patient_info.get("personal_history", ""),
-                "family_history": input_patient_info.get("family_history", ""),
-                "obg_history": input_patient_info.get("obg_history", ""),
-                "allergies": input_patient_info.get("allergies", ""),
-                "medication_history": input_patient_info.get("medication_history", ""),
-                "surgical_history": input_patient_info.get("surgical_history", ""),
-                "bp": input_patient_info.get("bp", ""),
-                "pulse": input_patient_info.get("pulse", ""),
-                "temperature": input_patient_info.get("temperature", ""),
-                "bmi": input_patient_info.get("bmi", ""),
-                "spo2": input_patient_info.get("spo2", ""),
-                "image_analysis_text": input_patient_info.get("image_analysis_text", ""),
-                "lab_analysis_text": input_patient_info.get("lab_analysis_text", ""),
-                "prescription_analysis_text": input_patient_info.get("prescription_analysis_text", ""),
-            }
-        
-        final_diagnosis_str = ", ".join(final_dx_list) if has_final_choices else input_diagnosis
-        final_tests_arr = final_tests_list if has_final_choices else input_tests
-        final_treatments_arr = final_treatment_list if has_final_choices else input_treatments
-        
-        prescription = generate_prescription(
-            diagnosis=final_diagnosis_str,
-            tests=final_tests_arr,
-            treatments=final_treatments_arr,
-            patient_info=full_patient_info
-        )
-        
-        return {"prescription": prescription}
-    
-    except Exception as e:
-        logger.exception("Error generating prescription")
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=str(e)
-        )
+    input_diagnosis = data.get("diagnosis", "")
+    input_tests = data.get("tests", [])
+    input_treatments = data.get("treatments", [])
+    input_patient_info = data.get("patient_info", {})
+
+    pid = None
+    if "patient_id" in data:
+        pid = data["patient_id"]
+    elif input_patient_info and "patient_id" in input_patient_info:
+        pid = input_patient_info["patient_id"]
+
+    row = None
+    if pid:
+        query = text("SELECT * FROM patient_info WHERE id = :pid")
+        with engine.connect() as conn:
+            row = conn.execute(query, {"pid": pid}).mappings().first()
 
-@app.post("/api/prescription/save")
+    final_dx_list = []
+    final_tests_list = []
+    final_treatment_list = []
+
+    if row:
+        dx_list, tests_list, treat_list = parse_final_choices(row)
+        final_dx_list = dx_list
+        final_tests_list = tests_list
+        final_treatment_list = treat_list
+
+    has_final_choices = (len(final_dx_list) > 0 or len(final_tests_list) > 0 or len(final_treatment_list) > 0)
+
+    full_patient_info = {}
+
+    if row:
+        # Reuse the document analyses already computed by /api/advice
+        stored_analyses = get_latest_patient_analyses(pid, row)
+        full_patient_info = {
+            "name": row.get("patient_name", ""),
+            "age": row.get("age", ""),
+            "gender": row.get("gender", ""),
+            "department": row.get("department", ""),
+            "chief_complaint": row.get("chief_complaint", ""),
+            "history_presenting_illness": row.get("history_of_presenting_illness", ""),
+            "past_history": row.get("past_history", ""),
+            "personal_history": row.get("personal_history", ""),
+            "family_history": row.get("family_history", ""),
+            "obg_history": row.get("obg_history", ""),
+            "allergies": row.get("allergies", ""),
+            "medication_history": row.get("medication_history", ""),
+            "surgical_history": row.get("surgical_history", ""),
+            "bp": row.get("bp", ""),
+            "pulse": row.get("pulse", ""),
+            "temperature": row.get("temperature", ""),
+            "bmi": row.get("bmi", ""),
+            "spo2": row.get("spo2", ""),
+            "image_analysis_text": stored_analyses.get("medical_imaging", ""),
+            "lab_analysis_text": stored_analyses.get("lab_report", ""),
+            "prescription_analysis_text": stored_analyses.get("previous_prescription", ""),
+        }
+    else:
+        full_patient_info = {
+            "name": input_patient_info.get("name", ""),
+            "age": input_patient_info.get("age", ""),
+            "gender": input_patient_info.get("gender", ""),
+            "department": input_patient_info.get("department", ""),
+            "chief_complaint": input_patient_info.get("chief_complaint", ""),
+            "history_presenting_illness": input_patient_info.get("history_presenting_illness", ""),
+            "past_history": input_patient_info.get("past_history", ""),
+            "personal_history": input_patient_info.get("personal_history", ""),
+            "family_history": input_patient_info.get("family_history", ""),
+            "obg_history": input_patient_info.get("obg_history", ""),
+            "allergies": input_patient_info.get("allergies", ""),
+            "medication_history": input_patient_info.get("medication_history", ""),
+            "surgical_history": input_patient_info.get("surgical_history", ""),
+            "bp": input_patient_info.get("bp", ""),
+            "pulse": input_patient_info.get("pulse", ""),
+            "temperature": input_patient_info.get("temperature", ""),
+            "bmi": input_patient_info.get("bmi", ""),
+            "spo2": input_patient_info.get("spo2", ""),
+            "image_analysis_text": input_patient_info.get("image_analysis_text", ""),
+            "lab_analysis_text": input_patient_info.get("lab_analysis_text", ""),
+            "prescription_analysis_text": input_patient_info.get("prescription_analysis_text", ""),
+        }
+
+    final_diagnosis_str = ", ".join(final_dx_list) if has_final_choices else input_diagnosis
+    final_tests_arr = final_tests_list if has_final_choices else input_tests
+    final_treatments_arr = final_treatment_list if has_final_choices else input_treatments
+
+    prescription = await generate_prescription(
+        diagnosis=final_diagnosis_str,
+        tests=final_tests_arr,
+        treatments=final_treatments_arr,
+        patient_info=full_patient_info
+    )
+
+    return {"prescription": prescription}
+
+@app.post("/api/prescription/generate")
+async def api_generate_prescription(data: dict):
+    try:
+        return await produce_prescription(data)
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.exception("Error generating prescription")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=str(e)
+        )
+
+@app.post("/api/prescription/save")
 async def api_save_prescription(data: dict):
     """
     Updated to allow a blank or missing patient_id in manual mode.
@@ -2245,112 +3052,16 @@ async def list_prescription_templates():
         logger.exception("Error listing prescription templates")
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/api/advice")
-async def generate_advice(data: dict):
-    patient_id = data.get("patient_id")
-    if not patient_id:
-        raise HTTPException(status_code=400, detail="Missing patient_id")
-
+def load_advice_patient(patient_id: int):
     sel_query = text("SELECT * FROM patient_info WHERE id = :pid")
     with engine.connect() as conn:
         row = conn.execute(sel_query, {"pid": patient_id}).mappings().first()
     if not row:
         raise HTTPException(status_code=404, detail="No patient found with that ID")
+    return row
 
-    department = row.get("department", "")
-    chief_complaint_single = row.get("chief_complaint", "")
-
-    include_lab_report = data.get("include_lab_report", True)
-    include_medical_imaging = data.get("include_medical_imaging", True)
-    include_prescription = data.get("include_prescription", True)
-
-    history_presenting_illness = row.get("history_presenting_illness", "")
-    past_history = row.get("past_history", "")
-    personal_history = row.get("personal_history", "")
-    family_history = row.get("family_history", "")
-    obg_history = row.get("obg_history", "")
-    age = row.get("age", 0)
-    gender = row.get("gender", "")
-
-    allergies = row.get("allergies", "")
-    medication_history = row.get("medication_history", "")
-    surgical_history = row.get("surgical_history", "")
-    bp = row.get("bp", "")
-    pulse = row.get("pulse", "")
-    temperature = row.get("temperature", "")
-
-    lab_analysis_text = ""
-    if row["lab_report_url"] and include_lab_report:
-        lab_bytes = download_from_s3(row["lab_report_url"])
-        if lab_bytes:
-            if is_pdf_file(row["lab_report_url"]):
-                lab_text = extract_text_from_pdf_bytes(lab_bytes)
-                lab_analysis_text = analyze_lab_report_text(lab_text)
-            elif is_image_file(row["lab_report_url"]):
-                b64 = base64.b64encode(lab_bytes).decode("utf-8")
-                lab_analysis_text = analyze_lab_report_image(b64)
-
-    image_analysis_text = ""
-    if row["medical_imaging_url"] and include_medical_imaging:
-        img_bytes = download_from_s3(row["medical_imaging_url"])
-        if img_bytes:
-            if is_pdf_file(row["medical_imaging_url"]):
-                pdf_text = extract_text_from_pdf_bytes(img_bytes)
-                image_analysis_text = analyze_medical_imaging_pdf(pdf_text)
-            else:
-                img_b64 = base64.b64encode(img_bytes).decode("utf-8")
-                cimg_type = row.get("cardiology_imaging_type", "")
-                nimg_type = row.get("neurology_imaging_type", "")
-                custom_prompt = None
-                if department == "Cardiology" and cimg_type:
-                    if cimg_type == "ECG/EKG":
-                        custom_prompt = PROMPT_ECG
-                    elif cimg_type == "Echocardiography (ECHO)":
-                        custom_prompt = PROMPT_ECHOCARDIOGRAPHY
-                    elif cimg_type == "Cardiac MRI":
-                        custom_prompt = PROMPT_CARDIAC_MRI
-                    elif cimg_type == "CT Coronary Angiography":
-                        custom_prompt = PROMPT_CT_CORONARY_ANGIO
-                    else:
-                        custom_prompt = FIXED_PROMPT_IMAGE
-                elif department == "Neurology" and nimg_type:
-                    if nimg_type == "MRI_SPINE":
-                        custom_prompt = PROMPT_MRI_SPINE
-                    elif nimg_type == "MRI_HEAD":
-                        custom_prompt = PROMPT_MRI_HEAD
-                    elif nimg_type == "CT_HEAD":
-                        custom_prompt = PROMPT_CT_HEAD
-                    elif nimg_type == "PET_BRAIN":
-                        custom_prompt = PROMPT_PET_BRAIN
-                    elif nimg_type == "SPECT_BRAIN":
-                        custom_prompt = PROMPT_SPECT_BRAIN
-                    elif nimg_type == "DSA_BRAIN":
-                        custom_prompt = PROMPT_DSA_BRAIN
-                    elif nimg_type == "Carotid_Doppler":
-                        custom_prompt = PROMPT_CAROTID_DOPPLER
-                    elif nimg_type == "TRANSCRANIAL_DOPPLER":
-                        custom_prompt = PROMPT_TRANSCRANIAL_DOPPLER
-                    elif nimg_type == "MYELOGRAPHY":
-                        custom_prompt = PROMPT_MYELOGRAPHY
-                    else:
-                        custom_prompt = FIXED_PROMPT_IMAGE
-                else:
-                    custom_prompt = FIXED_PROMPT_IMAGE
-
-                image_analysis_text = analyze_medical_image(img_b64, custom_prompt=custom_prompt)
-
-    prescription_analysis_text = ""
-    if row["previous_prescription_url"] and include_prescription:
-        presc_url = row["previous_prescription_url"].lower()
-        presc_bytes = download_from_s3(row["previous_prescription_url"])
-        if presc_bytes:
-            if presc_url.endswith(".pdf"):
-                pdf_text = extract_text_from_pdf_bytes(presc_bytes)
-                prescription_analysis_text = analyze_prescription_text_or_image(pdf_text, is_pdf=True)
-            else:
-                b64img = base64.b64encode(presc_bytes).decode("utf-8")
-                prescription_analysis_text = analyze_prescription_text_or_image(b64img, is_pdf=False)
-
+def load_latest_complaints(patient_id: int) -> list:
+    """Detailed complaint rows of the patient's most recent version."""
     with engine.connect() as conn:
         ver_query = text("""
             SELECT id FROM patient_info_versions
@@ -2367,8 +3078,11 @@ async def generate_advice(data: dict):
                 WHERE version_id = :vid
             """)
             complaint_rows = conn.execute(comp_query, {"vid": ver_row["id"]}).mappings().all()
+    return [dict(cr) for cr in complaint_rows]
 
-    full_complaint_text = chief_complaint_single.strip()
+def build_advice_request(row, complaint_rows: list, analyses: Dict[str, str]) -> dict:
+    """Keyword arguments for build_medical_advice_messages / get_medical_advice."""
+    full_complaint_text = (row.get("chief_complaint", "") or "").strip()
     if complaint_rows:
         lines = []
         for cr in complaint_rows:
@@ -2379,27 +3093,29 @@ async def generate_advice(data: dict):
             lines.append(line)
         full_complaint_text += "\n\nDetailed Complaints:\n" + "\n".join(lines)
 
-    advice = get_medical_advice(
-        department=department,
+    return dict(
+        department=row.get("department", ""),
         chief_complaint=full_complaint_text,
-        history_presenting_illness=history_presenting_illness,
-        past_history=past_history,
-        personal_history=personal_history,
-        family_history=family_history,
-        age=age,
-        gender=gender,
-        obg_history=obg_history,
-        allergies=allergies,
-        medication_history=medication_history,
-        surgical_history=surgical_history,
-        bp=bp,
-        pulse=pulse,
-        temperature=temperature,
-        image_analysis_text=image_analysis_text,
-        lab_analysis_text=lab_analysis_text,
-        prescription_analysis_text=prescription_analysis_text,
+        history_presenting_illness=row.get("history_presenting_illness", ""),
+        past_history=row.get("past_history", ""),
+        personal_history=row.get("personal_history", ""),
+        family_history=row.get("family_history", ""),
+        age=row.get("age", 0),
+        gender=row.get("gender", ""),
+        obg_history=row.get("obg_history", ""),
+        allergies=row.get("allergies", ""),
+        medication_history=row.get("medication_history", ""),
+        surgical_history=row.get("surgical_history", ""),
+        bp=row.get("bp", ""),
+        pulse=row.get("pulse", ""),
+        temperature=row.get("temperature", ""),
+        image_analysis_text=analyses.get("medical_imaging", ""),
+        lab_analysis_text=analyses.get("lab_report", ""),
+        prescription_analysis_text=analyses.get("previous_prescription", ""),
     )
 
+def persist_advice(patient_id: int, row, advice: str, complaint_rows: list, analyses: Dict[str, str]) -> int:
+    """Writes the advice as a new patient version and links the analyses to it."""
     new_version_id = update_patient_info(
         patient_id=patient_id,
         name=row["patient_name"],
@@ -2439,12 +3155,155 @@ async def generate_advice(data: dict):
         allergies=row.get("allergies", ""),
         medication_history=row.get("medication_history", ""),
         surgical_history=row.get("surgical_history", ""),
-        medical_advice=advice
+        medical_advice=advice,
+        complaint_details=complaint_rows
+    )
+
+    try:
+        save_version_analyses(patient_id, new_version_id, row, analyses)
+    except Exception as e:
+        logger.error(f"Error saving version analyses: {e}")
+
+    return new_version_id
+
+def advice_analysis_options(data: dict) -> dict:
+    return dict(
+        include_lab_report=data.get("include_lab_report", True),
+        include_medical_imaging=data.get("include_medical_imaging", True),
+        include_prescription=data.get("include_prescription", True),
+        use_cache=not data.get("bypass_cache", False),
+    )
+
+async def produce_advice(data: dict) -> dict:
+    patient_id = data.get("patient_id")
+    if not patient_id:
+        raise HTTPException(status_code=400, detail="Missing patient_id")
+
+    row = await asyncio.to_thread(load_advice_patient, patient_id)
+    analyses = await run_document_analyses(row, **advice_analysis_options(data))
+    complaint_rows = await asyncio.to_thread(load_latest_complaints, patient_id)
+
+    advice = await get_medical_advice(**build_advice_request(row, complaint_rows, analyses))
+    new_version_id = await asyncio.to_thread(
+        persist_advice, patient_id, row, advice, complaint_rows, analyses
     )
 
-    insert_patient_complaints(patient_id, new_version_id, list(complaint_rows))
+    return {"advice": advice, "version_id": new_version_id, "analyses": analyses}
+
+@app.post("/api/advice")
+async def generate_advice(data: dict):
+    return await produce_advice(data)
+
+ADVICE_HEADING_RE = re.compile(r"^\s*\*\*(.+?)\*\*\s*:?\s*$")
+
+class AdviceSectionTracker:
+    """
+    Splits streamed advice text on the fixed **Heading** lines requested in
+    build_medical_advice_messages and reports each section once it is complete.
+    """
+
+    def __init__(self):
+        self.current = None
+        self.lines = []
+        self.pending = ""
+
+    def feed(self, delta: str) -> list:
+        events = []
+        self.pending += delta
+        while "\n" in self.pending:
+            line, self.pending = self.pending.split("\n", 1)
+            events.extend(self._handle_line(line))
+        return events
+
+    def finish(self) -> list:
+        events = []
+        if self.pending:
+            events.extend(self._handle_line(self.pending))
+            self.pending = ""
+        events.extend(self._close_section())
+        return events
+
+    def _handle_line(self, line: str) -> list:
+        match = ADVICE_HEADING_RE.match(line)
+        if not match:
+            self.lines.append(line)
+            return []
+        events = self._close_section()
+        self.current = match.group(1).strip()
+        self.lines = []
+        events.append(("section_start", {"section": self.current}))
+        return events
+
+    def _close_section(self) -> list:
+        if self.current is None:
+            return []
+        return [("section", {"section": self.current, "content": "\n".join(self.lines).strip()})]
+
+def sse_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+@app.post("/api/advice/stream")
+async def generate_advice_stream(data: dict):
+    """
+    Server-sent events variant of /api/advice. Emits:
+      analysis       - as each document analysis finishes
+      section_start  - when a new advice heading begins
+      token          - every streamed chunk of advice text
+      section        - full text of a completed heading
+      done           - final advice, version_id and analyses (after persisting)
+      error          - if anything fails mid-stream
+    """
+    patient_id = data.get("patient_id")
+    if not patient_id:
+        raise HTTPException(status_code=400, detail="Missing patient_id")
+    row = await asyncio.to_thread(load_advice_patient, patient_id)
+
+    async def event_stream():
+        jobs = document_analysis_jobs(row, **advice_analysis_options(data))
 
-    return {"advice": advice}
+        async def _named(name, coro):
+            return name, await coro
+
+        tasks = [asyncio.create_task(_named(name, coro)) for name, coro in jobs.items()]
+        try:
+            yield sse_event("status", {"stage": "analyzing", "documents": list(jobs.keys())})
+            analyses = {"lab_report": "", "medical_imaging": "", "previous_prescription": ""}
+            for finished in asyncio.as_completed(tasks):
+                name, analysis_text = await finished
+                analyses[name] = analysis_text
+                yield sse_event("analysis", {"type": name, "text": analysis_text})
+
+            complaint_rows = await asyncio.to_thread(load_latest_complaints, patient_id)
+            messages = build_medical_advice_messages(**build_advice_request(row, complaint_rows, analyses))
+
+            yield sse_event("status", {"stage": "advising"})
+            tracker = AdviceSectionTracker()
+            parts = []
+            async for delta in llm_gateway.stream_chat("gpt-4", messages):
+                parts.append(delta)
+                yield sse_event("token", {"text": delta})
+                for event, payload in tracker.feed(delta):
+                    yield sse_event(event, payload)
+            for event, payload in tracker.finish():
+                yield sse_event(event, payload)
+
+            advice = "".join(parts).strip()
+            new_version_id = await asyncio.to_thread(
+                persist_advice, patient_id, row, advice, complaint_rows, analyses
+            )
+            yield sse_event("done", {"advice": advice, "version_id": new_version_id, "analyses": analyses})
+        except Exception as e:
+            logger.exception("Error streaming medical advice")
+            yield sse_event("error", {"detail": str(e)})
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 @app.get("/api/file-preview")
 async def file_preview(file_url: str = Query(...)):
@@ -2453,6 +3312,97 @@ async def file_preview(file_url: str = Query(...)):
         raise HTTPException(status_code=500, detail="Failed to generate presigned URL")
     return {"presigned_url": presigned_url}
 
+def parse_range_header(range_header: str, size: int) -> Optional[tuple]:
+    """
+    Parses a single "bytes=start-end" / "bytes=start-" / "bytes=-suffix"
+    Range header into an inclusive (start, end) pair. Raises ValueError when
+    the range can't be satisfied.
+    """
+    unit, _, spec = range_header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        raise ValueError("Unsupported range")
+    start_str, _, end_str = spec.strip().partition("-")
+    if start_str:
+        start = int(start_str)
+        end = min(int(end_str), size - 1) if end_str else size - 1
+    else:
+        suffix = int(end_str)
+        start, end = max(size - suffix, 0), size - 1
+    if start > end or start >= size:
+        raise ValueError("Unsatisfiable range")
+    return start, end
+
+@app.get("/api/storage/{object_key}")
+def serve_stored_object(object_key: str, request: Request, expires: int = 0, signature: str = ""):
+    """Serves objects of the local storage backend through their signed links."""
+    if not isinstance(storage, LocalStorageBackend):
+        raise HTTPException(status_code=404, detail="Not found")
+    if not storage.verify(object_key, expires, signature):
+        raise HTTPException(status_code=403, detail="Link is invalid or has expired")
+    try:
+        info = storage.head(object_key)
+    except (FileNotFoundError, ValueError):
+        raise HTTPException(status_code=404, detail="File not found")
+
+    size = info["size"]
+    headers = {"Accept-Ranges": "bytes"}
+    range_header = request.headers.get("range")
+    if range_header:
+        try:
+            start, end = parse_range_header(range_header, size)
+        except ValueError:
+            raise HTTPException(status_code=416, detail="Requested range not satisfiable",
+                                headers={"Content-Range": f"bytes */{size}"})
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        headers["Content-Length"] = str(end - start + 1)
+        return StreamingResponse(
+            storage.iter_chunks(object_key, S3_STREAM_CHUNK_SIZE, (start, end)),
+            status_code=206,
+            media_type=info["content_type"],
+            headers=headers,
+        )
+    headers["Content-Length"] = str(size)
+    return StreamingResponse(
+        storage.iter_chunks(object_key, S3_STREAM_CHUNK_SIZE),
+        media_type=info["content_type"],
+        headers=headers,
+    )
+
+PATIENT_DOCUMENT_COLUMNS = (
+    "lab_report_url",
+    "medical_imaging_url",
+    "previous_prescription_url",
+    "generated_prescription_url",
+)
+
+@app.get("/api/patient/{patient_id}/file-previews")
+def patient_file_previews(patient_id: int):
+    """
+    Signs all of a patient's documents in one call. Returns
+    {"patient_id", "files": {column: {"file_url", "presigned_url"} or None}}.
+    """
+    query = text(f"SELECT {', '.join(PATIENT_DOCUMENT_COLUMNS)} FROM patient_info WHERE id = :pid")
+    with engine.connect() as conn:
+        row = conn.execute(query, {"pid": patient_id}).mappings().first()
+    if not row:
+        raise HTTPException(status_code=404, detail="No patient found with that ID")
+    files = {}
+    for column in PATIENT_DOCUMENT_COLUMNS:
+        file_url = row[column]
+        files[column] = (
+            {"file_url": file_url, "presigned_url": generate_presigned_url(file_url, expiration=3600)}
+            if file_url else None
+        )
+    return {"patient_id": patient_id, "files": files}
+
+@app.get("/api/version/{version_id}/analyses")
+def api_get_version_analyses(version_id: int):
+    try:
+        return {"analyses": get_version_analyses(version_id)}
+    except Exception as e:
+        logger.exception("Error fetching version analyses")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.get("/api/version/{version_id}/complaints")
 def get_version_complaints(version_id: int):
     q = text("""
@@ -2514,8 +3464,154 @@ async def get_complaint_templates(department: str = None):
         logger.exception("Error fetching complaint templates")
         raise HTTPException(status_code=500, detail=str(e))
 
+# In-process autocomplete index over the medicines catalog. Names are kept in
+# a sorted array for prefix lookups plus a trigram map for typo-tolerant
+# matches; both are ranked by how often the medicine has been prescribed.
+MEDICINE_INDEX_REFRESH_SECONDS = int(os.getenv("MEDICINE_INDEX_REFRESH_SECONDS", "300"))
+# Refreshes only pick up catalog rows added since the last one; renames and
+# deletions are picked up by a full reload this often
+MEDICINE_INDEX_FULL_RELOAD_SECONDS = int(os.getenv("MEDICINE_INDEX_FULL_RELOAD_SECONDS", "3600"))
+
+def medicine_trigrams(key: str) -> set:
+    padded = f"  {key}"
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def prefix_edit_distance(query: str, name: str) -> int:
+    """Levenshtein distance between query and the closest prefix of name."""
+    previous = list(range(len(name) + 1))
+    for i, qc in enumerate(query, 1):
+        current = [i]
+        for j, nc in enumerate(name, 1):
+            current.append(min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (qc != nc)
+            ))
+        previous = current
+    return min(previous)
+
+class MedicineIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.keys: List[str] = []          # sorted, lower-cased names
+        self.display: Dict[str, str] = {}  # key -> name as stored
+        self.trigrams: Dict[str, List[str]] = {}
+        self.frequency: Counter = Counter()
+        self.last_usage_id = 0
+        self.last_medicine_id = 0
+        self.loaded_at = None
+        self.loaded = False
+
+    def refresh(self):
+        """
+        Merges catalog rows added since the last refresh (or reloads the whole
+        catalog every MEDICINE_INDEX_FULL_RELOAD_SECONDS) and adds prescription
+        counts for prescription_medicines rows newer than the last refresh.
+        """
+        full = not self.loaded or monotonic() - self.loaded_at >= MEDICINE_INDEX_FULL_RELOAD_SECONDS
+        with engine.connect() as conn:
+            catalog_rows = conn.execute(text("""
+                SELECT id, name FROM medicines
+                WHERE name IS NOT NULL AND id > :last_id
+                ORDER BY id
+            """), {"last_id": 0 if full else self.last_medicine_id}).all()
+            usage_rows = conn.execute(text("""
+                SELECT lower(trim(medicine)) AS key, COUNT(*) AS uses, MAX(id) AS max_id
+                FROM prescription_medicines
+                WHERE id > :last_id AND medicine IS NOT NULL AND medicine <> ''
+                GROUP BY lower(trim(medicine))
+            """), {"last_id": self.last_usage_id}).mappings().all()
+
+        if full:
+            display = {}
+            for _, name in catalog_rows:
+                display.setdefault(name.strip().lower(), name)
+            keys = sorted(display)
+            trigrams: Dict[str, List[str]] = {}
+            for key in keys:
+                for gram in medicine_trigrams(key):
+                    trigrams.setdefault(gram, []).append(key)
+        else:
+            # Searches read the published structures without the lock, so
+            # merge into copies instead of mutating them in place
+            display, keys, trigrams = self.display, self.keys, self.trigrams
+            added = {}
+            for _, name in catalog_rows:
+                key = name.strip().lower()
+                if key not in display and key not in added:
+                    added[key] = name
+            if added:
+                display = {**display, **added}
+                keys = list(keys)
+                trigrams = dict(trigrams)
+                for key in added:
+                    bisect.insort(keys, key)
+                    for gram in medicine_trigrams(key):
+                        trigrams[gram] = trigrams.get(gram, []) + [key]
+
+        with self._lock:
+            for row in usage_rows:
+                self.frequency[row["key"]] += row["uses"]
+                self.last_usage_id = max(self.last_usage_id, row["max_id"])
+            if catalog_rows:
+                self.last_medicine_id = max(self.last_medicine_id, catalog_rows[-1][0])
+            self.keys = keys
+            self.display = display
+            self.trigrams = trigrams
+            if full:
+                self.loaded_at = monotonic()
+            self.loaded = True
+
+    def _ranked(self, keys, limit: int) -> List[str]:
+        frequency = self.frequency
+        return heapq.nsmallest(limit, keys, key=lambda k: (-frequency[k], k))
+
+    def search(self, query: str, limit: int = 10) -> List[str]:
+        # An empty query matches every name, like the table's ILIKE '%' did
+        q = query.strip().lower()
+        with self._lock:
+            keys, display = self.keys, self.display
+        start = bisect.bisect_left(keys, q)
+        end = bisect.bisect_left(keys, q + "\uffff", start)
+        results = self._ranked(keys[start:end], limit)
+        if len(results) < limit and len(q) >= 3:
+            results += self._fuzzy(q, limit - len(results), exclude=set(results))
+        return [display[k] for k in results]
+
+    def _fuzzy(self, q: str, limit: int, exclude: set) -> List[str]:
+        max_edits = 1 if len(q) <= 5 else 2
+        shared = Counter()
+        for gram in medicine_trigrams(q):
+            shared.update(self.trigrams.get(gram, ()))
+        scored = []
+        for key, _ in shared.most_common(200):
+            if key in exclude:
+                continue
+            distance = prefix_edit_distance(q, key)
+            if distance <= max_edits:
+                scored.append((distance, -self.frequency[key], key))
+        scored.sort()
+        return [key for _, _, key in scored[:limit]]
+
+medicine_index = MedicineIndex()
+
+async def medicine_index_refresh_loop():
+    while True:
+        try:
+            await asyncio.to_thread(medicine_index.refresh)
+        except Exception as e:
+            logger.error(f"Error refreshing medicine index: {e}")
+        await asyncio.sleep(MEDICINE_INDEX_REFRESH_SECONDS)
+
+@app.on_event("startup")
+async def start_medicine_index():
+    asyncio.create_task(medicine_index_refresh_loop())
+
 @app.get("/api/medicines")
 def search_medicines(query: str = ""):
+    if medicine_index.loaded:
+        return medicine_index.search(query)
+    # Index not loaded yet (startup or DB error): fall back to the table
     sql = text("SELECT name FROM medicines WHERE name ILIKE :prefix LIMIT 10")
     with engine.connect() as conn:
         res = conn.execute(sql, {"prefix": f"{query}%"})
@@ -2547,6 +3643,61 @@ async def get_patient_by_id(patient_id: int):
     }
 
 
+# Services, doctors and clinics are small and read on every bill and
+# dropdown, so they are cached per process. The CRUD endpoints below
+# invalidate their table; the TTL bounds staleness for writes made by other
+# processes. Clinics have no write endpoints in this API (they are managed
+# directly in the database), so only the TTL applies to them; call
+# reference_cache.invalidate("clinics") from any clinic write path added later.
+REFERENCE_CACHE_TTL_SECONDS = int(os.getenv("REFERENCE_CACHE_TTL_SECONDS", "300"))
+
+class ReferenceDataCache:
+    QUERIES = {
+        "services": "SELECT id, name, default_price, requires_time FROM services ORDER BY id ASC",
+        "doctors": "SELECT id, name, speciality, contact_number, clinic_id FROM doctors ORDER BY name, id",
+        "clinics": "SELECT id, name FROM clinics ORDER BY name",
+    }
+
+    def __init__(self, ttl_seconds: int):
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._tables: Dict[str, tuple] = {}  # table -> (loaded_at, rows, ids_by_name)
+
+    def _load(self, table: str) -> tuple:
+        with self._lock:
+            entry = self._tables.get(table)
+            if entry and monotonic() - entry[0] < self.ttl_seconds:
+                return entry
+        with engine.connect() as conn:
+            rows = [dict(r) for r in conn.execute(text(self.QUERIES[table])).mappings()]
+        ids_by_name: Dict[str, int] = {}
+        for row in sorted(rows, key=lambda r: r["id"]):
+            ids_by_name.setdefault(row["name"], row["id"])
+        entry = (monotonic(), rows, ids_by_name)
+        with self._lock:
+            self._tables[table] = entry
+        return entry
+
+    def rows(self, table: str) -> List[dict]:
+        return [dict(row) for row in self._load(table)[1]]
+
+    def id_by_name(self, table: str, name: str) -> Optional[int]:
+        """Looks the name up, reloading once on a miss in case the cache is stale."""
+        ref_id = self._load(table)[2].get(name)
+        if ref_id is None:
+            self.invalidate(table)
+            ref_id = self._load(table)[2].get(name)
+        return ref_id
+
+    def invalidate(self, table: str = None):
+        with self._lock:
+            if table:
+                self._tables.pop(table, None)
+            else:
+                self._tables.clear()
+
+reference_cache = ReferenceDataCache(REFERENCE_CACHE_TTL_SECONDS)
+
 # Pydantic model for validation
 class ServiceCreate(BaseModel):
     name: str = Field(..., min_length=1, max_length=255)
@@ -2567,6 +3718,7 @@ def create_service(service: ServiceCreate):
         with engine.begin() as conn:
             result = conn.execute(insert_query, {"name": service.name, "default_price": service.default_price, "requires_time": service.requires_time,})
             service_id = result.fetchone()[0]
+        reference_cache.invalidate("services")
         
         return {"id": service_id, "name": service.name, "default_price": service.default_price, "requires_time": service.requires_time,}
     except Exception as e:
@@ -2576,18 +3728,7 @@ def create_service(service: ServiceCreate):
 def get_all_services():
     """Retrieve all services"""
     try:
-        query = text("SELECT id, name, default_price, requires_time FROM services ORDER BY id ASC")
-        with engine.begin() as conn:
-            result = conn.execute(query)
-            services = []
-            for row in result.mappings():
-                services.append({
-                    "id": row["id"],
-                    "name": row["name"],
-                    "default_price": row["default_price"],
-                    "requires_time": row["requires_time"],
-                })
-        return services
+        return reference_cache.rows("services")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -2633,6 +3774,7 @@ def update_service(service_id: int, service: ServiceCreate):
             updated_id = result.fetchone()
             if not updated_id:
                 raise HTTPException(status_code=404, detail="Service not found")
+        reference_cache.invalidate("services")
         
         return {
             "id": service_id,
@@ -2653,6 +3795,7 @@ def delete_service(service_id: int):
             deleted_id = result.fetchone()
             if not deleted_id:
                 raise HTTPException(status_code=404, detail="Service not found")
+        reference_cache.invalidate("services")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -2685,6 +3828,7 @@ def create_doctor(doctor: DoctorCreate):
                 "contact_number": doctor.contact_number
             })
             doctor_id = result.fetchone()[0]
+        reference_cache.invalidate("doctors")
         
         return {
             "id": doctor_id, 
@@ -2699,11 +3843,11 @@ def create_doctor(doctor: DoctorCreate):
 def get_all_doctors():
     """Retrieve all doctors"""
     try:
-        query = text("SELECT id, name, speciality, contact_number FROM doctors ORDER BY name ASC")
-        with engine.begin() as conn:
-            result = conn.execute(query)
-            doctors = [dict(row) for row in result.mappings()]
-        return doctors
+        # Same fields as before the cache; clinic_id is only used by list_doctors
+        return [
+            {key: doctor[key] for key in ("id", "name", "speciality", "contact_number")}
+            for doctor in reference_cache.rows("doctors")
+        ]
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -2742,6 +3886,7 @@ def update_doctor(doctor_id: int, doctor: DoctorCreate):
             updated_id = result.fetchone()
             if not updated_id:
                 raise HTTPException(status_code=404, detail="Doctor not found")
+        reference_cache.invalidate("doctors")
         
         return {
             "id": doctor_id, 
@@ -2762,6 +3907,7 @@ def delete_doctor(doctor_id: int):
             deleted_id = result.fetchone()
             if not deleted_id:
                 raise HTTPException(status_code=404, detail="Doctor not found")
+        reference_cache.invalidate("doctors")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -2802,14 +3948,35 @@ class BillResponse(BaseModel):
     total_amount: float
     items: List[BillItemResponse]
     pdf_base64: Optional[str] = None
+    pdf_url: Optional[str] = None
+    pdf_job_id: Optional[str] = None
 
 @app.post("/api/bills", response_model=BillResponse, status_code=status.HTTP_201_CREATED)
-def create_bill(bill: BillCreate):
-    """Create a new bill with items and generate PDF using WeasyPrint"""
+def create_bill(bill: BillCreate, pdf_delivery: str = "inline", include_pdf_base64: bool = True):
+    """
+    Create a new bill with items. pdf_delivery controls the receipt:
+    "inline" renders it now (stored in S3, returned as pdf_url and, unless
+    include_pdf_base64=false, as pdf_base64), "deferred" queues a render job
+    (pdf_job_id) and "none" skips it; GET /api/bills/{id}/pdf renders on demand.
+    """
+    validate_pdf_delivery(pdf_delivery)
     try:
         # Get patient_id from the request
         patient_id = bill.patient_id
         
+        # Resolve service and doctor names before opening the transaction, so
+        # a cache reload never needs a second pool connection while it is held
+        item_refs = []
+        for item in bill.rows:
+            service_id = reference_cache.id_by_name("services", item.service)
+            if service_id is None:
+                raise HTTPException(status_code=404, detail=f"Service '{item.service}' not found")
+            
+            doctor_id = reference_cache.id_by_name("doctors", item.doctor)
+            if doctor_id is None:
+                raise HTTPException(status_code=404, detail=f"Doctor '{item.doctor}' not found")
+            item_refs.append((service_id, doctor_id))
+        
         # Start a transaction
         with engine.begin() as conn:
             # Get patient details
@@ -2853,26 +4020,12 @@ def create_bill(bill: BillCreate):
             bill_id = bill_row[0]
             bill_date = bill_row[1]
             
-            # 2. Create bill items
+            # 2. Create bill items with one multi-row statement
             bill_items = []
+            item_values = []
+            item_params = {"bill_id": bill_id}
             
-            for item in bill.rows:
-                # Find service_id based on service name
-                service_query = text("SELECT id FROM services WHERE name = :name")
-                service_result = conn.execute(service_query, {"name": item.service})
-                service_row = service_result.fetchone()
-                if not service_row:
-                    raise HTTPException(status_code=404, detail=f"Service '{item.service}' not found")
-                service_id = service_row[0]
-                
-                # Find doctor_id based on doctor name
-                doctor_query = text("SELECT id FROM doctors WHERE name = :name")
-                doctor_result = conn.execute(doctor_query, {"name": item.doctor})
-                doctor_row = doctor_result.fetchone()
-                if not doctor_row:
-                    raise HTTPException(status_code=404, detail=f"Doctor '{item.doctor}' not found")
-                doctor_id = doctor_row[0]
-                
+            for n, (item, (service_id, doctor_id)) in enumerate(zip(bill.rows, item_refs)):
                 # Calculate net amount
                 discount_amount = (item.price * item.discount) / 100
                 net_amount = item.price - discount_amount
@@ -2880,37 +4033,24 @@ def create_bill(bill: BillCreate):
                 # Convert appointment time string to time object
                 appointment_time = datetime.datetime.strptime(item.appointmentTime, "%H:%M").time()
                 
-                # Insert bill item
-                insert_item_query = text("""
-                    INSERT INTO bill_items 
-                    (bill_id, service_id, doctor_id, appointment_date, appointment_time, 
-                     duration, price, discount, net_amount)
-                    VALUES 
-                    (:bill_id, :service_id, :doctor_id, :appointment_date, :appointment_time, 
-                     :duration, :price, :discount, :net_amount)
-                    RETURNING id
-                """)
-                
-                item_result = conn.execute(
-                    insert_item_query, 
-                    {
-                        "bill_id": bill_id,
-                        "service_id": service_id,
-                        "doctor_id": doctor_id,
-                        "appointment_date": item.appointmentDate,
-                        "appointment_time": appointment_time,
-                        "duration": item.duration,
-                        "price": item.price,
-                        "discount": item.discount,
-                        "net_amount": net_amount
-                    }
+                item_values.append(
+                    f"(:id_{n}, :bill_id, :service_id_{n}, :doctor_id_{n}, :appointment_date_{n}, "
+                    f":appointment_time_{n}, :duration_{n}, :price_{n}, :discount_{n}, :net_amount_{n})"
                 )
+                item_params.update({
+                    f"service_id_{n}": service_id,
+                    f"doctor_id_{n}": doctor_id,
+                    f"appointment_date_{n}": item.appointmentDate,
+                    f"appointment_time_{n}": appointment_time,
+                    f"duration_{n}": item.duration,
+                    f"price_{n}": item.price,
+                    f"discount_{n}": item.discount,
+                    f"net_amount_{n}": net_amount
+                })
                 
-                item_id = item_result.fetchone()[0]
-                
-                # Add to response items
+                # Add to response items (ids are filled in after the insert)
                 bill_items.append({
-                    "id": item_id,
+                    "id": None,
                     "service_id": service_id,
                     "doctor_id": doctor_id,
                     "appointment_date": item.appointmentDate,
@@ -2921,198 +4061,98 @@ def create_bill(bill: BillCreate):
                     "net_amount": net_amount
                 })
             
-            # 3. Generate PDF receipt using WeasyPrint
-            html_content = f"""
-            <!DOCTYPE html>
-            <html>
-            <head>
-                <meta charset="UTF-8">
-                <title>Bill Receipt</title>
-                <style>
-                    @page {{
-                        size: A4;
-                        margin: 1cm;
-                    }}
-                    body {{
-                        font-family: Arial, sans-serif;
-                        margin: 0;
-                        padding: 20px;
-                        color: #333;
-                    }}
-                    .receipt {{
-                        max-width: 800px;
-                        margin: 0 auto;
-                        border: 1px solid #ddd;
-                        padding: 20px;
-                        box-shadow: 0 0 10px rgba(0,0,0,0.1);
-                    }}
-                    .header {{
-                        text-align: center;
-                        border-bottom: 2px solid #333;
-                        padding-bottom: 10px;
-                        margin-bottom: 20px;
-                    }}
-                    .clinic-name {{
-                        font-size: 24px;
-                        font-weight: bold;
-                        margin-bottom: 5px;
-                    }}
-                    .clinic-contact {{
-                        font-size: 14px;
-                        color: #666;
-                    }}
-                    .bill-info {{
-                        display: flex;
-                        justify-content: space-between;
-                        margin-bottom: 20px;
-                    }}
-                    .patient-info, .bill-details {{
-                        flex: 1;
-                    }}
-                    .info-title {{
-                        font-weight: bold;
-                        margin-bottom: 5px;
-                    }}
-                    .info-item {{
-                        margin-bottom: 3px;
-                    }}
-                    table {{
-                        width: 100%;
-                        border-collapse: collapse;
-                        margin-bottom: 20px;
-                    }}
-                    th, td {{
-                        border: 1px solid #ddd;
-                        padding: 8px;
-                        text-align: left;
-                    }}
-                    th {{
-                        background-color: #f2f2f2;
-                    }}
-                    .summary {{
-                        margin-top: 20px;
-                        text-align: right;
-                    }}
-                    .total {{
-                        font-weight: bold;
-                        font-size: 18px;
-                        margin-top: 10px;
-                    }}
-                    .footer {{
-                        margin-top: 30px;
-                        text-align: center;
-                        font-size: 14px;
-                        color: #666;
-                        border-top: 1px solid #ddd;
-                        padding-top: 10px;
-                    }}
-                </style>
-            </head>
-            <body>
-                <div class="receipt">
-                    <div class="header">
-                        <div class="clinic-name">Health Plus Clinic</div>
-                        <div class="clinic-contact">123 Medical Avenue, City | Phone: +91 1234567890 | Email: info@healthplus.com</div>
-                    </div>
-                    
-                    <div class="bill-info">
-                        <div class="patient-info">
-                            <div class="info-title">Patient Information</div>
-                            <div class="info-item">Name: {patient_name}</div>
-                            <div class="info-item">Age/Gender: {patient_age}/{patient_gender}</div>
-                            <div class="info-item">Contact: {patient_phone}</div>
-                        </div>
-                        
-                        <div class="bill-details">
-                            <div class="info-title">Bill Details</div>
-                            <div class="info-item">Bill #: {bill_id}</div>
-                            <div class="info-item">Date: {bill_date.strftime('%d-%m-%Y')}</div>
-                            <div class="info-item">Payment Mode: {payment_mode.title()}</div>
-                            <div class="info-item">Status: {payment_status.title()}</div>
-                        </div>
-                    </div>
-                    
-                    <table>
-                        <thead>
-                            <tr>
-                                <th>Service</th>
-                                <th>Doctor</th>
-                                <th>Date & Time</th>
-                                <th>Duration</th>
-                                <th>Price (₹)</th>
-                                <th>Discount</th>
-                                <th>Amount (₹)</th>
-                            </tr>
-                        </thead>
-                        <tbody>
-            """
-            
-            # Add rows for each bill item
-            for item in bill.rows:
-                discount_amount = (item.price * item.discount) / 100
-                net_amount = item.price - discount_amount
-                appointment_datetime = f"{item.appointmentDate} at {item.appointmentTime}"
-                
-                html_content += f"""
-                            <tr>
-                                <td>{item.service}</td>
-                                <td>{item.doctor}</td>
-                                <td>{appointment_datetime}</td>
-                                <td>{item.duration} min</td>
-                                <td>{item.price:.2f}</td>
-                                <td>{item.discount}% ({discount_amount:.2f})</td>
-                                <td>{net_amount:.2f}</td>
-                            </tr>
-                """
-            
-            # Complete the HTML
-            html_content += f"""
-                        </tbody>
-                    </table>
-                    
-                    <div class="summary">
-                        <div class="total">Total Amount: ₹{total_amount:.2f}</div>
-                    </div>
-                    
-                    <div class="footer">
-                        <p>Thank you for choosing Health Plus Clinic. Get well soon!</p>
-                        <p>This is a computer-generated receipt and does not require a signature.</p>
-                    </div>
-                </div>
-            </body>
-            </html>
-            """
-            
-            # Import WeasyPrint here to avoid startup overhead if not needed
-            from weasyprint import HTML
-            import io
-            import base64
-            
-            # Generate PDF from HTML
-            pdf_buffer = io.BytesIO()
-            HTML(string=html_content).write_pdf(pdf_buffer)
+            if item_values:
+                # RETURNING order is not guaranteed to follow VALUES order, so
+                # take the ids from the sequence up front and insert them explicitly
+                reserve_ids_query = text("""
+                    SELECT nextval(pg_get_serial_sequence('bill_items', 'id'))
+                    FROM generate_series(1, :count)
+                """)
+                item_ids = [row[0] for row in conn.execute(reserve_ids_query, {"count": len(bill_items)})]
+                for n, (bill_item, item_id) in enumerate(zip(bill_items, item_ids)):
+                    bill_item["id"] = item_id
+                    item_params[f"id_{n}"] = item_id
+                insert_items_query = text(f"""
+                    INSERT INTO bill_items 
+                    (id, bill_id, service_id, doctor_id, appointment_date, appointment_time, 
+                     duration, price, discount, net_amount)
+                    VALUES {", ".join(item_values)}
+                """)
+                conn.execute(insert_items_query, item_params)
             
-            # Get PDF content and convert to base64
-            pdf_buffer.seek(0)
-            pdf_content = pdf_buffer.getvalue()
-            pdf_base64 = base64.b64encode(pdf_content).decode('utf-8')
+            receipt = {
+                "id": bill_id,
+                "patient_name": patient_name,
+                "patient_age": patient_age,
+                "patient_gender": patient_gender,
+                "patient_phone": patient_phone,
+                "bill_date": bill_date,
+                "payment_mode": payment_mode,
+                "payment_status": payment_status,
+                "total_amount": total_amount,
+                "items": [
+                    {
+                        "service": item.service,
+                        "doctor": item.doctor,
+                        "appointment_date": item.appointmentDate,
+                        "appointment_time": item.appointmentTime,
+                        "duration": item.duration,
+                        "price": item.price,
+                        "discount": item.discount
+                    }
+                    for item in bill.rows
+                ]
+            }
             
-            # 4. Return full bill with items and PDF
-            return {
+            response = {
                 "id": bill_id,
                 "patient_id": patient_id,
                 "bill_date": bill_row[1],
                 "payment_mode": bill_row[2],
                 "payment_status": bill_row[3],
                 "total_amount": bill_row[4],
-                "items": bill_items,
-                "pdf_base64": pdf_base64
+                "items": bill_items
             }
+        
+        # 3. Deliver the PDF receipt after the bill is committed
+        response.update(deliver_receipt("clinic", receipt, pdf_delivery, include_pdf_base64))
+        return response
             
+    except HTTPException as he:
+        raise he
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+BILL_ITEMS_SQL = """
+    SELECT bi.bill_id, bi.id, bi.service_id, bi.doctor_id, bi.appointment_date,
+           bi.appointment_time, bi.duration, bi.price, bi.discount, bi.net_amount
+    FROM bill_items bi
+    WHERE bi.bill_id = ANY(:bill_ids)
+    ORDER BY bi.bill_id, bi.id
+"""
+
+PHARMACY_BILL_ITEMS_SQL = """
+    SELECT bill_id, id, medicine_id, medicine_name, quantity, price_per_unit,
+           discount_percentage, item_total
+    FROM pharmacy_bill_items
+    WHERE bill_id = ANY(:bill_ids)
+    ORDER BY bill_id, id
+"""
+
+def attach_bill_items(conn, bills: list, items_sql: str) -> list:
+    """Fills bill["items"] for every bill using one query over all their ids."""
+    if not bills:
+        return bills
+    rows = conn.execute(text(items_sql), {"bill_ids": [b["id"] for b in bills]}).mappings().all()
+    items_by_bill: Dict[int, list] = {}
+    for row in rows:
+        item = dict(row)
+        items_by_bill.setdefault(item.pop("bill_id"), []).append(item)
+    for bill in bills:
+        bill["items"] = items_by_bill.get(bill["id"], [])
+    return bills
+
 @app.get("/api/bills/{bill_id}", response_model=BillResponse)
 def get_bill(bill_id: int):
     """Retrieve a bill by ID with all its items"""
@@ -3166,21 +4206,16 @@ def get_patient_bills(patient_id: int):
             if not patient_result.fetchone():
                 raise HTTPException(status_code=404, detail="Patient not found")
             
-            # Get all bills for the patient
+            # Get all bills for the patient, then all their items in one query
             bills_query = text("""
-                SELECT id FROM bills WHERE patient_id = :patient_id ORDER BY bill_date DESC
+                SELECT id, patient_id, bill_date, payment_mode, payment_status, total_amount
+                FROM bills WHERE patient_id = :patient_id ORDER BY bill_date DESC
             """)
             
             bills_result = conn.execute(bills_query, {"patient_id": patient_id})
-            bill_ids = [row[0] for row in bills_result]
-            
-            # Get details for each bill
-            bills = []
-            for bill_id in bill_ids:
-                bill = get_bill(bill_id)
-                bills.append(bill)
+            bills = [dict(row._mapping) for row in bills_result]
             
-            return bills
+            return attach_bill_items(conn, bills, BILL_ITEMS_SQL)
             
     except HTTPException as he:
         raise he
@@ -3208,36 +4243,141 @@ def delete_bill(bill_id: int):
         raise HTTPException(status_code=500, detail=str(e))
     
 
-@app.post("/api/transcribe-audio")
-async def transcribe_audio(file: UploadFile):
-    if not OPENAI_API_KEY:
-        raise HTTPException(500, "Missing OPENAI_API_KEY")
-
-    contents = await file.read()
-    temp_filename = "temp_audio.webm"
-    with open(temp_filename, "wb") as f:
-        f.write(contents)
+TRANSCRIPTION_TIMEOUT_SECONDS = float(os.getenv("TRANSCRIPTION_TIMEOUT_SECONDS", "120"))
+
+def audio_upload_name(filename: Optional[str]) -> str:
+    """Whisper detects the format from the extension, so keep one on the name."""
+    if filename and os.path.splitext(filename)[1]:
+        return os.path.basename(filename)
+    return "audio.webm"
+
+# Shrink recordings to mono 16 kHz Opus and trim edge silence before sending them
+AUDIO_PREPROCESS = os.getenv("AUDIO_PREPROCESS", "true").lower() in ("1", "true", "yes")
+# Recordings longer than TRANSCRIPTION_SEGMENT_THRESHOLD_SECONDS are cut on
+# silences into segments of about TRANSCRIPTION_SEGMENT_SECONDS (never more
+# than TRANSCRIPTION_SEGMENT_MAX_SECONDS) and transcribed concurrently.
+TRANSCRIPTION_SEGMENT_THRESHOLD_SECONDS = float(os.getenv("TRANSCRIPTION_SEGMENT_THRESHOLD_SECONDS", "90"))
+TRANSCRIPTION_SEGMENT_SECONDS = float(os.getenv("TRANSCRIPTION_SEGMENT_SECONDS", "45"))
+TRANSCRIPTION_SEGMENT_MAX_SECONDS = float(os.getenv("TRANSCRIPTION_SEGMENT_MAX_SECONDS", "90"))
+TRANSCRIPTION_PARALLELISM = int(os.getenv("TRANSCRIPTION_PARALLELISM", "4"))
+
+def _response_field(obj, name, default=None):
+    if isinstance(obj, dict):
+        return obj.get(name, default)
+    return getattr(obj, name, default)
+
+async def whisper_segments(audio, filename: str, content_type: str, offset: float = 0.0) -> tuple:
+    """
+    Transcribes one file object with timestamps. Returns (text, segments)
+    where segment times are shifted by offset seconds.
+    """
+    try:
+        response = await llm_gateway.audio_translation(
+            file=(filename, audio, content_type),
+            response_format="verbose_json",
+            timeout=TRANSCRIPTION_TIMEOUT_SECONDS,
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(500, f"Whisper API error: {e}")
+    text_out = (_response_field(response, "text") or "").strip()
+    segments = [
+        {
+            "start": round(offset + float(_response_field(seg, "start", 0.0)), 2),
+            "end": round(offset + float(_response_field(seg, "end", 0.0)), 2),
+            "text": (_response_field(seg, "text") or "").strip(),
+        }
+        for seg in (_response_field(response, "segments") or [])
+    ]
+    return text_out, segments
 
-    url = "https://api.openai.com/v1/audio/translations"
-    headers = {
-        "Authorization": f"Bearer {OPENAI_API_KEY}"
+def stitch_transcript(parts: List[tuple]) -> dict:
+    """parts: (text, segments) per audio segment, in recording order."""
+    return {
+        "transcript": " ".join(text_part for text_part, _ in parts if text_part),
+        "segments": [seg for _, segments in parts for seg in segments],
     }
 
-    with open(temp_filename, "rb") as audio:
-        files = {
-            "file": (temp_filename, audio, file.content_type),
-            "model": (None, "whisper-1"),
-        }
-        response = requests.post(url, headers=headers, files=files)
+async def transcribe_segmented(path: str, duration: float, workdir: str, offset: float = 0.0) -> dict:
+    silences = await asyncio.to_thread(detect_silences, path)
+    plan = plan_segments(duration, silences, TRANSCRIPTION_SEGMENT_SECONDS, TRANSCRIPTION_SEGMENT_MAX_SECONDS)
+    limiter = asyncio.Semaphore(TRANSCRIPTION_PARALLELISM)
+
+    async def run_segment(index: int, start: float, end: float) -> tuple:
+        async with limiter:
+            segment_path = os.path.join(workdir, f"segment_{index:03d}.ogg")
+            await asyncio.to_thread(extract_segment, path, start, end, segment_path)
+            with open(segment_path, "rb") as segment:
+                return await whisper_segments(segment, os.path.basename(segment_path), "audio/ogg", offset=offset + start)
+
+    started = monotonic()
+    parts = await asyncio.gather(*(run_segment(i, start, end) for i, (start, end) in enumerate(plan)))
+    logger.info(f"Transcribed {duration:.0f}s of audio in {len(plan)} segments in {monotonic() - started:.1f}s")
+    result = stitch_transcript(parts)
+    result["segment_count"] = len(plan)
+    return result
+
+async def transcribe_audio_file(audio, filename: Optional[str], content_type: Optional[str]) -> dict:
+    """
+    Transcribes a per-request audio file object (the upload's own spooled
+    file or a spooled download) over the shared keep-alive client. Long
+    recordings are split on silence and sent as concurrent segments; short
+    ones, or any recording ffmpeg can't process, go as a single request.
+    With AUDIO_PREPROCESS on, the recording is first shrunk to mono 16 kHz
+    Opus with edge silence trimmed. Returns {"transcript", "segments":
+    [{"start", "end", "text"}], "segment_count", "preprocessing"}, where
+    preprocessing holds the time taken and bytes saved (None if skipped).
+    Segment times are in seconds from the start of the original recording.
+    """
+    if not OPENAI_API_KEY:
+        raise HTTPException(500, "Missing OPENAI_API_KEY")
+    name = audio_upload_name(filename)
+    content_type = content_type or "audio/webm"
+    with tempfile.TemporaryDirectory(prefix="dictation-") as workdir:
+        path = os.path.join(workdir, name)
+        audio.seek(0)
+        with open(path, "wb") as local_copy:
+            await asyncio.to_thread(shutil.copyfileobj, audio, local_copy)
+
+        preprocessing = None
+        lead_in = 0.0
+        if AUDIO_PREPROCESS:
+            processed_path = os.path.join(workdir, "preprocessed.ogg")
+            try:
+                preprocessing = await asyncio.to_thread(preprocess_audio, path, processed_path)
+                path, name, content_type = processed_path, "preprocessed.ogg", "audio/ogg"
+                lead_in = preprocessing["lead_in_seconds"]
+                logger.info(
+                    f"Preprocessed audio in {preprocessing['seconds']:.2f}s: "
+                    f"{preprocessing['input_bytes']} -> {preprocessing['output_bytes']} bytes"
+                )
+            except AudioProcessingError as e:
+                logger.warning(f"Audio preprocessing unavailable, sending the original recording: {e}")
 
-    if response.status_code != 200:
-        raise HTTPException(500, f"Whisper API error: {response.text}")
+        result = None
+        try:
+            duration = await asyncio.to_thread(probe_duration, path)
+            if preprocessing and duration is not None and duration < 0.1:
+                # Nothing but silence once trimmed
+                result = {"transcript": "", "segments": [], "segment_count": 0}
+            elif duration and duration > TRANSCRIPTION_SEGMENT_THRESHOLD_SECONDS:
+                result = await transcribe_segmented(path, duration, workdir, offset=lead_in)
+        except AudioProcessingError as e:
+            logger.warning(f"Audio segmentation unavailable, sending the whole recording: {e}")
+        if result is None:
+            with open(path, "rb") as whole:
+                result = stitch_transcript([await whisper_segments(whole, name, content_type, offset=lead_in)])
+            result["segment_count"] = 1
+        result["preprocessing"] = preprocessing
+        return result
 
-    data = response.json()
-    return {"transcript": data["text"]}
+@app.post("/api/transcribe-audio")
+async def transcribe_audio(file: UploadFile):
+    return await transcribe_audio_file(file.file, file.filename, file.content_type)
 
 @app.post("/api/parse-voice-transcript")
-def parse_voice_transcript(payload: dict):
+async def parse_voice_transcript(payload: dict):
     """
     Expects JSON:
     {
@@ -3322,28 +4462,21 @@ Department is {department}, but only use it if relevant for classification conte
 """
 
     try:
-        response = client.chat.completions.create(
-            model="gpt-4",
+        return await llm_gateway.chat_json(
+            model=STRUCTURED_OUTPUT_MODEL,
             messages=[{"role": "user", "content": prompt}],
+            schema=VOICE_HISTORY_SCHEMA,
+            name="voice_history",
             temperature=0.3,
             max_tokens=600
         )
-        raw_content = response.choices[0].message.content.strip()
-
-        result = json.loads(raw_content)
-
-        return {
-            "complaints": result.get("complaints", []),
-            "past_history": result.get("past_history", []),
-            "personal_history": result.get("personal_history", []),
-            "family_history": result.get("family_history", []),
-            "allergies": result.get("allergies", []),
-            "medication_history": result.get("medication_history", []),
-            "surgical_history": result.get("surgical_history", []),
-            "hpi": result.get("hpi", ""),
-            "vitals": result.get("vitals", {})
-        }
 
+    except StructuredOutputError as e:
+        # Unrecoverable model JSON is an upstream failure, not an empty result
+        raise HTTPException(status_code=502, detail=f"Model returned unusable output: {e}")
+    except HTTPException:
+        # Gateway overload (queue full / timeout) must reach the client as a 503
+        raise
     except Exception as e:
         logging.error(f"parse_voice_transcript error: {e}")
         # Return empty fallback
@@ -3360,7 +4493,7 @@ Department is {department}, but only use it if relevant for classification conte
         }
     
 @app.post("/api/parse-voice-prescription")
-def parse_voice_prescription(payload: dict):
+async def parse_voice_prescription(payload: dict):
     """
     Expects JSON:
     {
@@ -3432,42 +4565,21 @@ Return JSON with exactly these keys, no extra commentary.
 """
 
     try:
-        import json
-        from openai import OpenAI
-        import os
-        import logging
-
-        OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
-        client = OpenAI(api_key=OPENAI_API_KEY)
-
-        response = client.chat.completions.create(
-            model="gpt-4",
+        return await llm_gateway.chat_json(
+            model=STRUCTURED_OUTPUT_MODEL,
             messages=[{"role": "user", "content": prompt}],
+            schema=VOICE_PRESCRIPTION_SCHEMA,
+            name="voice_prescription",
             temperature=0.3,
             max_tokens=800
         )
 
-        raw_content = response.choices[0].message.content.strip()
-        parsed = json.loads(raw_content)
-
-        return {
-            "patient_name": parsed.get("patient_name", ""),
-            "patient_age": parsed.get("patient_age", ""),
-            "patient_gender": parsed.get("patient_gender", ""),
-            "patient_contact": parsed.get("patient_contact", ""),
-            "complaints": parsed.get("complaints", []),
-            "diagnosis": parsed.get("diagnosis", ""),
-            "tests": parsed.get("tests", []),
-            "follow_up": parsed.get("follow_up", ""),
-            "vitals": parsed.get("vitals", {
-                "temperature": "",
-                "bp": "",
-                "pulse": "",
-                "bmi": ""
-            }),
-            "medicines": parsed.get("medicines", [])
-        }
-
+    except StructuredOutputError as e:
+        # Unrecoverable model JSON is an upstream failure, not an empty result
+        raise HTTPException(status_code=502, detail=f"Model returned unusable output: {e}")
+    except HTTPException:
+        # Gateway overload (queue full / timeout) must reach the client as a 503
+        raise
     except Exception as e:
         logging.error(f"parse_voice_prescription error: {e}")
         # Return fallback if parsing fails
@@ -3489,38 +4601,567 @@ Return JSON with exactly these keys, no extra commentary.
             "medicines": []
         }
 
+# Live dictation over WebSocket. Audio chunks are appended to a per-session
+# file; every DICTATION_PARTIAL_INTERVAL_SECONDS the untranscribed tail is cut
+# at its last pause and transcribed, and only that new text is sent to the
+# model together with the current fields to update them.
+DICTATION_PARTIAL_INTERVAL_SECONDS = float(os.getenv("DICTATION_PARTIAL_INTERVAL_SECONDS", "4"))
+DICTATION_MIN_WINDOW_SECONDS = float(os.getenv("DICTATION_MIN_WINDOW_SECONDS", "3"))
+DICTATION_MAX_WINDOW_SECONDS = float(os.getenv("DICTATION_MAX_WINDOW_SECONDS", "30"))
+DICTATION_MAX_AUDIO_BYTES = int(os.getenv("DICTATION_MAX_AUDIO_BYTES", str(50 * 1024 * 1024)))
 
-class AppointmentCreate(BaseModel):
-    patient_name: str
-    age: int
-    gender: str
-    contact_number: str
-    appointment_date: date
-    appointment_time: time
+VOICE_FIELD_SCHEMAS = {
+    "history": VOICE_HISTORY_SCHEMA,
+    "prescription": VOICE_PRESCRIPTION_SCHEMA,
+}
 
-@app.post("/api/appointments")
-def create_appointment(data: AppointmentCreate):
+def empty_voice_fields(mode: str) -> dict:
+    return empty_from_schema(VOICE_FIELD_SCHEMAS[mode])
+
+async def parse_voice_delta(mode: str, department: str, fields: dict, delta: str) -> dict:
     """
-    Creates a new appointment record in the 'appointments' table.
+    Updates already-extracted fields with a new piece of dictation. Only the
+    delta and the current fields go to the model, not the whole transcript.
     """
-    insert_query = text("""
-        INSERT INTO appointments (
-            patient_name,
-            age,
-            gender,
-            contact_number,
-            appointment_date,
-            appointment_time
-        ) VALUES (
-            :patient_name,
-            :age,
-            :gender,
-            :contact_number,
-            :appointment_date,
-            :appointment_time
-        )
-        RETURNING id
-    """)
+    prompt = f"""
+You are a medical assistant filling in a structured record from live voice dictation.
+These fields have already been extracted from the earlier dictation:
+{json.dumps(fields)}
+
+The doctor has just said:
+\"\"\"{delta}\"\"\"
+
+Update the fields with anything new or corrected in this text. Keep existing values unless the
+new text changes them, and do not duplicate items already present.
+Return the complete updated JSON object with exactly the same keys, no extra commentary.
+Department is {department}, but only use it if relevant for classification context.
+"""
+    return await llm_gateway.chat_json(
+        model=STRUCTURED_OUTPUT_MODEL,
+        messages=[{"role": "user", "content": prompt}],
+        schema=VOICE_FIELD_SCHEMAS[mode],
+        name=f"voice_{mode}_update",
+        temperature=0.2,
+        max_tokens=800
+    )
+
+class DictationSession:
+    def __init__(self, mode: str, department: str):
+        self.mode = mode
+        self.department = department
+        self.fields = empty_voice_fields(mode)
+        self.transcript_parts: List[str] = []
+        self.committed_seconds = 0.0
+        self.audio_bytes = 0
+        self.transcribed_bytes = 0
+        self.segmentation_available = True
+        self._workdir = tempfile.TemporaryDirectory(prefix="live-dictation-")
+        self.audio_path = os.path.join(self._workdir.name, "stream.webm")
+        self._audio = open(self.audio_path, "ab")
+        self.stopped = asyncio.Event()
+
+    def add_audio(self, chunk: bytes):
+        if self.audio_bytes + len(chunk) > DICTATION_MAX_AUDIO_BYTES:
+            raise ValueError("Dictation is too long")
+        self._audio.write(chunk)
+        self._audio.flush()
+        self.audio_bytes += len(chunk)
+
+    @property
+    def transcript(self) -> str:
+        return " ".join(self.transcript_parts)
+
+    async def next_window(self, final: bool) -> Optional[tuple]:
+        """
+        Cuts the untranscribed tail of the recording at its last pause.
+        Returns (path, offset, length) of the audio to transcribe, or None
+        when there is not enough new audio yet.
+        """
+        window_path = os.path.join(self._workdir.name, "window.ogg")
+        await asyncio.to_thread(extract_tail, self.audio_path, self.committed_seconds, window_path)
+        length = await asyncio.to_thread(probe_duration, window_path) or 0.0
+        if length < 0.1 or (not final and length < DICTATION_MIN_WINDOW_SECONDS):
+            return None
+        if final:
+            return window_path, self.committed_seconds, length
+        # Leave the last second alone: a word may still be in progress
+        pauses = [(start + end) / 2 for start, end in await asyncio.to_thread(detect_silences, window_path)]
+        pauses = [p for p in pauses if DICTATION_MIN_WINDOW_SECONDS <= p < length - 1.0]
+        if pauses:
+            cut = pauses[-1]
+        elif length >= DICTATION_MAX_WINDOW_SECONDS:
+            cut = length
+        else:
+            return None
+        segment_path = os.path.join(self._workdir.name, "segment.ogg")
+        await asyncio.to_thread(extract_segment, window_path, 0.0, cut, segment_path)
+        return segment_path, self.committed_seconds, cut
+
+    async def transcribe_new_audio(self, final: bool) -> Optional[dict]:
+        """Transcribes audio received since the last step; None when there is nothing new."""
+        if self.audio_bytes == self.transcribed_bytes and not final:
+            return None
+        if self.segmentation_available:
+            try:
+                window = await self.next_window(final)
+            except AudioToolMissingError as e:
+                logger.warning(f"Live dictation segmentation unavailable, transcribing at the end: {e}")
+                self.segmentation_available = False
+            except AudioProcessingError as e:
+                # Usually a chunk that is only half written; retry on the next tick
+                if not final:
+                    logger.info(f"Live dictation window not decodable yet: {e}")
+                    return None
+                logger.warning(f"Live dictation tail could not be cut, transcribing the whole recording: {e}")
+                self.segmentation_available = False
+                self.transcript_parts = []
+        if not self.segmentation_available:
+            if not final:
+                return None
+            with open(self.audio_path, "rb") as audio:
+                result = await transcribe_audio_file(audio, "stream.webm", "audio/webm")
+            self.transcribed_bytes = self.audio_bytes
+            return {"text": result["transcript"], "segments": result["segments"]}
+        if window is None:
+            return None
+        path, offset, length = window
+        with open(path, "rb") as audio:
+            delta, segments = await whisper_segments(audio, os.path.basename(path), "audio/ogg", offset=offset)
+        self.committed_seconds = offset + length
+        self.transcribed_bytes = self.audio_bytes
+        return {"text": delta, "segments": segments}
+
+    async def apply_delta(self, delta: str) -> List[str]:
+        """Merges a transcript delta into the fields; returns the changed keys."""
+        previous = self.fields
+        try:
+            self.fields = await parse_voice_delta(self.mode, self.department, previous, delta)
+        except Exception as e:
+            logger.error(f"Live dictation parse error: {e}")
+            return []
+        return [key for key in self.fields if self.fields[key] != previous[key]]
+
+    async def run(self, websocket: WebSocket):
+        """Periodically transcribes and parses new audio until stopped, then sends the final result."""
+        while True:
+            try:
+                await asyncio.wait_for(self.stopped.wait(), DICTATION_PARTIAL_INTERVAL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            final = self.stopped.is_set()
+            try:
+                update = await self.transcribe_new_audio(final)
+            except Exception as e:
+                # A timeout or 429 on a partial tick must not lose the dictation:
+                # committed_seconds has not moved, so the next tick retries the window
+                if final:
+                    raise
+                logger.warning(f"Live dictation partial transcription failed, retrying: {e}")
+                continue
+            if update and update["text"]:
+                self.transcript_parts.append(update["text"])
+                await websocket.send_json({
+                    "type": "partial_transcript",
+                    "text": update["text"],
+                    "segments": update["segments"],
+                    "transcript": self.transcript,
+                })
+                changed = await self.apply_delta(update["text"])
+                if changed:
+                    await websocket.send_json({"type": "fields", "fields": self.fields, "changed": changed})
+            if final:
+                await websocket.send_json({"type": "final", "transcript": self.transcript, "fields": self.fields})
+                return
+
+    def close(self):
+        self._audio.close()
+        self._workdir.cleanup()
+
+@app.websocket("/ws/dictation")
+async def dictation_socket(websocket: WebSocket, mode: str = "history", department: str = "General Medicine"):
+    """
+    Live dictation. Send audio chunks (e.g. MediaRecorder webm) as binary
+    messages and {"type": "stop"} as text when done. mode is "history"
+    (VOICE_HISTORY_SCHEMA, as parse-voice-transcript) or "prescription"
+    (VOICE_PRESCRIPTION_SCHEMA, as parse-voice-prescription). The server sends:
+      {"type": "partial_transcript", "text", "segments", "transcript"}
+      {"type": "fields", "fields", "changed"}
+      {"type": "final", "transcript", "fields"}
+      {"type": "error", "detail"}
+    """
+    await websocket.accept()
+    if mode not in VOICE_FIELD_SCHEMAS:
+        await websocket.send_json({"type": "error", "detail": f"Unknown mode: {mode}"})
+        await websocket.close(code=1008)
+        return
+    if not OPENAI_API_KEY:
+        await websocket.send_json({"type": "error", "detail": "Missing OPENAI_API_KEY"})
+        await websocket.close(code=1011)
+        return
+
+    session = DictationSession(mode, department)
+    worker = asyncio.create_task(session.run(websocket))
+    try:
+        while not worker.done():
+            receive = asyncio.create_task(websocket.receive())
+            await asyncio.wait({receive, worker}, return_when=asyncio.FIRST_COMPLETED)
+            if not receive.done():
+                receive.cancel()
+                break
+            message = receive.result()
+            if message["type"] == "websocket.disconnect":
+                worker.cancel()
+                return
+            if message.get("bytes"):
+                session.add_audio(message["bytes"])
+            elif message.get("text"):
+                try:
+                    data = json.loads(message["text"])
+                except ValueError:
+                    data = {}
+                if data.get("type") == "stop":
+                    session.stopped.set()
+                    await worker
+                    break
+        if worker.done() and not worker.cancelled() and worker.exception():
+            raise worker.exception()
+        await websocket.close()
+    except WebSocketDisconnect:
+        worker.cancel()
+    except Exception as e:
+        worker.cancel()
+        logger.exception("Live dictation error")
+        detail = e.detail if isinstance(e, HTTPException) else str(e)
+        with contextlib.suppress(Exception):
+            await websocket.send_json({"type": "error", "detail": detail})
+            await websocket.close(code=1011)
+    finally:
+        with contextlib.suppress(asyncio.CancelledError, Exception):
+            await worker
+        session.close()
+
+@app.get("/api/llm/stats")
+async def llm_stats():
+    """Current LLM gateway queue depth and in-flight calls per model."""
+    return llm_gateway.stats()
+
+# Background jobs for long-running AI work. Jobs live in the ai_jobs table so
+# they survive restarts and can be claimed by any API process; each process
+# runs JOB_WORKERS asyncio workers that claim jobs with SKIP LOCKED.
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_TIMEOUT_SECONDS = int(os.getenv("JOB_TIMEOUT_SECONDS", "600"))
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "2"))
+
+SCHEMA_STATEMENTS.append("""
+    CREATE TABLE IF NOT EXISTS ai_jobs (
+        id UUID PRIMARY KEY,
+        kind TEXT NOT NULL,
+        payload JSONB NOT NULL DEFAULT '{}'::jsonb,
+        status TEXT NOT NULL DEFAULT 'queued',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        max_attempts INTEGER NOT NULL DEFAULT 3,
+        result JSONB,
+        error TEXT,
+        run_after TIMESTAMPTZ NOT NULL DEFAULT now(),
+        locked_at TIMESTAMPTZ,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        finished_at TIMESTAMPTZ
+    )
+""")
+SCHEMA_STATEMENTS.append("""
+    CREATE INDEX IF NOT EXISTS idx_ai_jobs_queue ON ai_jobs (status, run_after)
+""")
+
+async def run_transcription_job(payload: dict) -> dict:
+    audio = await asyncio.to_thread(spool_s3_object, payload["audio_url"])
+    if audio is None:
+        raise HTTPException(status_code=404, detail="Audio file not found")
+    with audio:
+        return await transcribe_audio_file(audio, payload["audio_url"].split("/")[-1], payload.get("content_type"))
+
+def cleanup_transcription_job(payload: dict):
+    # The staged audio is only needed while the job can still run
+    delete_from_s3(payload["audio_url"])
+
+# kind -> coroutine function(payload) returning a JSON-serializable result
+JOB_HANDLERS = {
+    "advice": produce_advice,
+    "prescription": produce_prescription,
+    "transcribe_audio": run_transcription_job,
+}
+
+# kind -> function(payload) run once the job has succeeded or failed for good
+JOB_CLEANUP_HANDLERS = {
+    "transcribe_audio": cleanup_transcription_job,
+}
+
+job_wakeup = asyncio.Event()
+job_worker_tasks: List[asyncio.Task] = []
+
+def submit_job(kind: str, payload: dict, max_attempts: int = None) -> str:
+    if kind not in JOB_HANDLERS:
+        raise HTTPException(status_code=400, detail=f"Unknown job kind: {kind}")
+    job_id = str(uuid.uuid4())
+    insert_query = text("""
+        INSERT INTO ai_jobs (id, kind, payload, max_attempts)
+        VALUES (:id, :kind, CAST(:payload AS JSONB), :max_attempts)
+    """)
+    with engine.begin() as conn:
+        conn.execute(insert_query, {
+            "id": job_id,
+            "kind": kind,
+            "payload": json.dumps(payload, default=str),
+            "max_attempts": max_attempts or JOB_MAX_ATTEMPTS
+        })
+    job_wakeup.set()
+    return job_id
+
+def claim_next_job():
+    """
+    Marks the oldest runnable job as running and returns it. Jobs left in
+    'running' by a crashed worker are reclaimed once their lock is stale,
+    or marked failed if they have used up their attempts.
+    """
+    exhausted_query = text("""
+        UPDATE ai_jobs
+        SET status = 'failed',
+            error = COALESCE(error, 'Worker stopped responding'),
+            locked_at = NULL,
+            updated_at = now(),
+            finished_at = now()
+        WHERE status = 'running'
+          AND locked_at < now() - make_interval(secs => :stale)
+          AND attempts >= max_attempts
+        RETURNING id, kind, payload
+    """)
+    claim_query = text("""
+        UPDATE ai_jobs
+        SET status = 'running',
+            attempts = attempts + 1,
+            locked_at = now(),
+            updated_at = now()
+        WHERE id = (
+            SELECT id FROM ai_jobs
+            WHERE (status = 'queued' AND run_after <= now())
+               OR (status = 'running' AND locked_at < now() - make_interval(secs => :stale)
+                   AND attempts < max_attempts)
+            ORDER BY created_at
+            FOR UPDATE SKIP LOCKED
+            LIMIT 1
+        )
+        RETURNING id, kind, payload, attempts, max_attempts
+    """)
+    with engine.begin() as conn:
+        exhausted_jobs = conn.execute(exhausted_query, {"stale": JOB_TIMEOUT_SECONDS * 2}).mappings().all()
+        row = conn.execute(claim_query, {"stale": JOB_TIMEOUT_SECONDS * 2}).mappings().first()
+    for exhausted in exhausted_jobs:
+        logger.error(f"Job {exhausted['id']} ({exhausted['kind']}) failed: worker stopped responding on its last attempt")
+        cleanup_job(exhausted["kind"], exhausted["payload"])
+    return dict(row) if row else None
+
+def cleanup_job(kind: str, payload: dict):
+    cleanup = JOB_CLEANUP_HANDLERS.get(kind)
+    if not cleanup:
+        return
+    try:
+        cleanup(payload or {})
+    except Exception as e:
+        logger.error(f"Error cleaning up {kind} job: {e}")
+
+def complete_job(job_id, result: dict):
+    query = text("""
+        UPDATE ai_jobs
+        SET status = 'succeeded',
+            result = CAST(:result AS JSONB),
+            error = NULL,
+            updated_at = now(),
+            finished_at = now()
+        WHERE id = :id
+    """)
+    with engine.begin() as conn:
+        conn.execute(query, {"id": job_id, "result": json.dumps(result, default=str)})
+
+def fail_job(job, error: str, retryable: bool = True) -> bool:
+    """
+    Requeues the job with exponential backoff, or marks it failed for good.
+    Returns True when the job will not run again.
+    """
+    final = not (retryable and job["attempts"] < job["max_attempts"])
+    if not final:
+        query = text("""
+            UPDATE ai_jobs
+            SET status = 'queued',
+                error = :error,
+                locked_at = NULL,
+                run_after = now() + make_interval(secs => :delay),
+                updated_at = now()
+            WHERE id = :id
+        """)
+        params = {"id": job["id"], "error": error, "delay": 5 * 2 ** (job["attempts"] - 1)}
+    else:
+        query = text("""
+            UPDATE ai_jobs
+            SET status = 'failed',
+                error = :error,
+                updated_at = now(),
+                finished_at = now()
+            WHERE id = :id
+        """)
+        params = {"id": job["id"], "error": error}
+    with engine.begin() as conn:
+        conn.execute(query, params)
+    return final
+
+async def run_job(job: dict):
+    handler = JOB_HANDLERS.get(job["kind"])
+    if not handler:
+        await asyncio.to_thread(fail_job, job, f"Unknown job kind: {job['kind']}", False)
+        return
+    try:
+        result = await asyncio.wait_for(handler(job["payload"] or {}), timeout=JOB_TIMEOUT_SECONDS)
+    except HTTPException as he:
+        # Validation / not-found errors will not succeed on retry
+        retryable = he.status_code >= 500
+        finished = await asyncio.to_thread(fail_job, job, str(he.detail), retryable)
+    except Exception as e:
+        logger.exception(f"Job {job['id']} ({job['kind']}) failed")
+        finished = await asyncio.to_thread(fail_job, job, str(e) or e.__class__.__name__)
+    else:
+        await asyncio.to_thread(complete_job, job["id"], result)
+        finished = True
+    if finished:
+        await asyncio.to_thread(cleanup_job, job["kind"], job["payload"])
+
+async def job_worker_loop(worker_number: int):
+    logger.info(f"Job worker {worker_number} started")
+    while True:
+        try:
+            job = await asyncio.to_thread(claim_next_job)
+        except Exception as e:
+            logger.error(f"Job worker {worker_number} could not claim a job: {e}")
+            job = None
+        if job:
+            await run_job(job)
+            continue
+        try:
+            await asyncio.wait_for(job_wakeup.wait(), timeout=JOB_POLL_SECONDS)
+            job_wakeup.clear()
+        except asyncio.TimeoutError:
+            pass
+
+@app.on_event("startup")
+async def start_job_workers():
+    for n in range(JOB_WORKERS):
+        job_worker_tasks.append(asyncio.create_task(job_worker_loop(n)))
+
+@app.on_event("shutdown")
+async def stop_job_workers():
+    for task in job_worker_tasks:
+        task.cancel()
+
+def serialize_job(row) -> dict:
+    return {
+        "job_id": str(row["id"]),
+        "kind": row["kind"],
+        "status": row["status"],
+        "attempts": row["attempts"],
+        "max_attempts": row["max_attempts"],
+        "error": row["error"],
+        "created_at": row["created_at"].isoformat() if row["created_at"] else None,
+        "updated_at": row["updated_at"].isoformat() if row["updated_at"] else None,
+        "finished_at": row["finished_at"].isoformat() if row["finished_at"] else None,
+    }
+
+def get_job(job_id: str):
+    try:
+        uuid.UUID(job_id)
+    except ValueError:
+        raise HTTPException(status_code=404, detail="Job not found")
+    query = text("SELECT * FROM ai_jobs WHERE id = :id")
+    with engine.connect() as conn:
+        row = conn.execute(query, {"id": job_id}).mappings().first()
+    if not row:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return row
+
+# Job kinds clients may submit directly through /api/jobs
+PUBLIC_JOB_KINDS = ("advice", "prescription")
+
+@app.post("/api/jobs", status_code=status.HTTP_202_ACCEPTED)
+def api_submit_job(data: dict):
+    """
+    Expects:
+    {
+      "kind": "advice" | "prescription",
+      "payload": { ...same body as /api/advice or /api/prescription/generate... }
+    }
+    """
+    kind = data.get("kind")
+    if not kind:
+        raise HTTPException(status_code=400, detail="Missing job kind")
+    # Other kinds (receipt, transcribe_audio) are only queued by their own routes
+    if kind not in PUBLIC_JOB_KINDS:
+        raise HTTPException(status_code=400, detail=f"Unknown job kind: {kind}")
+    job_id = submit_job(kind, data.get("payload") or {})
+    return {"job_id": job_id, "status": "queued"}
+
+@app.post("/api/jobs/transcribe-audio", status_code=status.HTTP_202_ACCEPTED)
+async def api_submit_transcription_job(file: UploadFile):
+    upload = await asyncio.to_thread(upload_fileobj_to_s3, file.file, audio_upload_name(file.filename))
+    audio_url = upload["url"]
+    job_id = await asyncio.to_thread(submit_job, "transcribe_audio", {
+        "audio_url": audio_url,
+        "content_type": file.content_type,
+    })
+    return {"job_id": job_id, "status": "queued"}
+
+@app.get("/api/jobs/{job_id}")
+def api_get_job(job_id: str):
+    return serialize_job(get_job(job_id))
+
+@app.get("/api/jobs/{job_id}/result")
+def api_get_job_result(job_id: str):
+    row = get_job(job_id)
+    if row["status"] == "failed":
+        raise HTTPException(status_code=500, detail=row["error"] or "Job failed")
+    if row["status"] != "succeeded":
+        return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content=serialize_job(row))
+    return {"job_id": str(row["id"]), "status": row["status"], "result": row["result"]}
+
+
+class AppointmentCreate(BaseModel):
+    patient_name: str
+    age: int
+    gender: str
+    contact_number: str
+    appointment_date: date
+    appointment_time: time
+
+@app.post("/api/appointments")
+def create_appointment(data: AppointmentCreate):
+    """
+    Creates a new appointment record in the 'appointments' table.
+    """
+    insert_query = text("""
+        INSERT INTO appointments (
+            patient_name,
+            age,
+            gender,
+            contact_number,
+            appointment_date,
+            appointment_time
+        ) VALUES (
+            :patient_name,
+            :age,
+            :gender,
+            :contact_number,
+            :appointment_date,
+            :appointment_time
+        )
+        RETURNING id
+    """)
     try:
         with engine.begin() as conn:
             result = conn.execute(insert_query, {
@@ -3722,22 +5363,15 @@ def get_todays_appointments(
 
 @app.get("/api/clinics")
 def list_clinics():
-    with engine.connect() as conn:
-        rows = conn.execute(text("SELECT id, name FROM clinics ORDER BY name")).mappings().all()
-    return [{"id": r["id"], "name": r["name"]} for r in rows]
+    return reference_cache.rows("clinics")
 
 
 @app.get("/api/doctors")
 def list_doctors(clinic_id: Optional[int] = None):
-    query = "SELECT id, name, speciality, contact_number, clinic_id FROM doctors"
-    params = {}
+    doctors = reference_cache.rows("doctors")
     if clinic_id:
-        query += " WHERE clinic_id = :cid"
-        params["cid"] = clinic_id
-    query += " ORDER BY name"
-    with engine.connect() as conn:
-        rows = conn.execute(text(query), params).mappings().all()
-    return [dict(r) for r in rows]
+        doctors = [d for d in doctors if d["clinic_id"] == clinic_id]
+    return doctors
 
 @app.get("/api/reports")
 def get_reports():
@@ -3758,226 +5392,220 @@ def get_reports():
       - monthlyAgeTrend
       - *NEW*: topDiagnosis
       - *NEW*: monthlyRevenue
+
+    Each source table is scanned once: patient metrics come from one
+    GROUPING SETS query, bill metrics from another, bill item, version and
+    appointment metrics from one query each.
     """
     try:
         with engine.begin() as conn:
 
-            # 1) TOTAL PATIENTS
-            total_patients_q = text("SELECT COUNT(*) FROM patient_info")
-            total_patients = conn.execute(total_patients_q).scalar() or 0
-
-            # 2) GENDER RATIO
-            male_q = text("SELECT COUNT(*) FROM patient_info WHERE gender ILIKE 'male'")
-            female_q = text("SELECT COUNT(*) FROM patient_info WHERE gender ILIKE 'female'")
-            others_q = text("""
-                SELECT COUNT(*) 
-                FROM patient_info
-                WHERE gender NOT ILIKE 'male'
-                  AND gender NOT ILIKE 'female'
-                  AND gender NOT IN ('','Select Gender')
-            """)
-            male_count = conn.execute(male_q).scalar() or 0
-            female_count = conn.execute(female_q).scalar() or 0
-            other_count = conn.execute(others_q).scalar() or 0
-
-            # 3) AGE DISTRIBUTION
-            age_0_18_q = text("SELECT COUNT(*) FROM patient_info WHERE age BETWEEN 0 AND 18")
-            age_19_30_q = text("SELECT COUNT(*) FROM patient_info WHERE age BETWEEN 19 AND 30")
-            age_31_60_q = text("SELECT COUNT(*) FROM patient_info WHERE age BETWEEN 31 AND 60")
-            age_61_plus_q = text("SELECT COUNT(*) FROM patient_info WHERE age >= 61")
-            age_0_18 = conn.execute(age_0_18_q).scalar() or 0
-            age_19_30 = conn.execute(age_19_30_q).scalar() or 0
-            age_31_60 = conn.execute(age_31_60_q).scalar() or 0
-            age_61_plus = conn.execute(age_61_plus_q).scalar() or 0
-
-            # 4) TOTAL APPOINTMENTS
+            # 1) PATIENTS: totals, gender, age, departments, monthly trends and
+            # diagnoses in a single scan. Diagnoses are unnested with ordinality,
+            # so only the first row of each patient (first_row) is counted for
+            # the non-diagnosis metrics.
+            patient_sql = """
+                WITH p AS (
+                    SELECT
+                        to_char(date_trunc('month', pi.created_at), 'YYYY-MM') AS month_label,
+                        pi.department,
+                        pi.gender,
+                        pi.age,
+                        trim(dx.diag) AS diagnosis,
+                        (dx.ord IS NULL OR dx.ord = 1) AS first_row
+                    FROM patient_info pi
+                    LEFT JOIN LATERAL unnest(string_to_array(NULLIF(pi.final_diagnosis, ''), ','))
+                        WITH ORDINALITY AS dx(diag, ord) ON TRUE
+                )
+                SELECT
+                    GROUPING(month_label) AS g_month,
+                    GROUPING(department) AS g_dept,
+                    GROUPING(diagnosis) AS g_diag,
+                    month_label,
+                    department,
+                    diagnosis,
+                    COUNT(*) FILTER (WHERE first_row) AS total,
+                    COUNT(*) AS diag_count,
+                    COUNT(*) FILTER (WHERE first_row AND gender ILIKE 'male') AS male,
+                    COUNT(*) FILTER (WHERE first_row AND gender ILIKE 'female') AS female,
+                    COUNT(*) FILTER (
+                        WHERE first_row
+                          AND gender NOT ILIKE 'male'
+                          AND gender NOT ILIKE 'female'
+                          AND gender NOT IN ('','Select Gender')
+                    ) AS others,
+                    COUNT(*) FILTER (WHERE first_row AND age BETWEEN 0 AND 18) AS age_0_18,
+                    COUNT(*) FILTER (WHERE first_row AND age BETWEEN 19 AND 30) AS age_19_30,
+                    COUNT(*) FILTER (WHERE first_row AND age BETWEEN 31 AND 60) AS age_31_60,
+                    COUNT(*) FILTER (WHERE first_row AND age >= 61) AS age_61_plus
+                FROM p
+                GROUP BY GROUPING SETS ((), (month_label), (department), (diagnosis))
+            """
+            patient_rows = conn.execute(text(patient_sql)).mappings().all()
+
+            totals = None
+            month_rows = []
+            dept_rows = []
+            diag_rows = []
+            for r in patient_rows:
+                if r["g_month"] and r["g_dept"] and r["g_diag"]:
+                    totals = r
+                elif not r["g_month"]:
+                    month_rows.append(r)
+                elif not r["g_dept"]:
+                    if r["department"]:
+                        dept_rows.append(r)
+                elif r["diagnosis"] is not None:
+                    diag_rows.append(r)
+
+            total_patients = totals["total"] if totals else 0
+            male_count = totals["male"] if totals else 0
+            female_count = totals["female"] if totals else 0
+            other_count = totals["others"] if totals else 0
+            age_0_18 = totals["age_0_18"] if totals else 0
+            age_19_30 = totals["age_19_30"] if totals else 0
+            age_31_60 = totals["age_31_60"] if totals else 0
+            age_61_plus = totals["age_61_plus"] if totals else 0
+
+            month_rows.sort(key=lambda r: (r["month_label"] is None, r["month_label"] or ""))
+            monthly_gender_trend = [
+                {
+                    "month": r["month_label"],
+                    "male": r["male"],
+                    "female": r["female"],
+                    "others": r["others"],
+                }
+                for r in month_rows
+            ]
+            monthly_age_trend = [
+                {
+                    "month": r["month_label"],
+                    "age_0_18": r["age_0_18"],
+                    "age_19_30": r["age_19_30"],
+                    "age_31_60": r["age_31_60"],
+                    "age_61_plus": r["age_61_plus"],
+                }
+                for r in month_rows
+            ]
+
+            dept_rows.sort(key=lambda r: r["total"], reverse=True)
+            top_departments = [
+                {"department": dr["department"], "count": dr["total"]}
+                for dr in dept_rows[:5]
+            ]
+
+            diag_rows.sort(key=lambda r: r["diag_count"], reverse=True)
+            top_diagnosis = [
+                {"diagnosis": row_d["diagnosis"], "count": row_d["diag_count"]}
+                for row_d in diag_rows[:5]
+            ]
+
+            # 2) TOTAL APPOINTMENTS
             total_appts_q = text("SELECT COUNT(*) FROM appointments")
             total_appointments = conn.execute(total_appts_q).scalar() or 0
 
-            # 5) REPEAT VISITS
-            repeat_sql = """
-                WITH counts AS (
-                    SELECT patient_id, COUNT(*) AS version_count
+            # 3) VERSIONS: repeat visits and monthly footfall from one scan
+            version_sql = """
+                WITH grouped AS (
+                    SELECT
+                        GROUPING(patient_id) AS by_month,
+                        to_char(date_trunc('month', version_timestamp), 'YYYY-MM') AS month_label,
+                        COUNT(*) AS cnt
                     FROM patient_info_versions
-                    GROUP BY patient_id
+                    GROUP BY GROUPING SETS (
+                        (patient_id),
+                        (to_char(date_trunc('month', version_timestamp), 'YYYY-MM'))
+                    )
                 )
-                SELECT
-                    SUM(CASE WHEN version_count = 1 THEN 1 ELSE 0 END) AS one_visit,
-                    SUM(CASE WHEN version_count = 2 THEN 1 ELSE 0 END) AS two_visits,
-                    SUM(CASE WHEN version_count = 3 THEN 1 ELSE 0 END) AS three_visits,
-                    SUM(CASE WHEN version_count >= 4 THEN 1 ELSE 0 END) AS four_plus_visits
-                FROM counts
+                SELECT 'month' AS kind, month_label AS label, cnt AS count
+                FROM grouped WHERE by_month = 1
+                UNION ALL
+                SELECT 'visits', LEAST(cnt, 4)::text, COUNT(*)
+                FROM grouped WHERE by_month = 0
+                GROUP BY LEAST(cnt, 4)
             """
-            row = conn.execute(text(repeat_sql)).mappings().first()
+            version_rows = conn.execute(text(version_sql)).mappings().all()
+            visits = {r["label"]: r["count"] for r in version_rows if r["kind"] == "visits"}
             repeat_visits = {
-                "one": row["one_visit"] if row else 0,
-                "two": row["two_visits"] if row else 0,
-                "three": row["three_visits"] if row else 0,
-                "four_plus": row["four_plus_visits"] if row else 0,
+                "one": visits.get("1", 0),
+                "two": visits.get("2", 0),
+                "three": visits.get("3", 0),
+                "four_plus": visits.get("4", 0),
             }
+            footfall_rows = sorted(
+                (r for r in version_rows if r["kind"] == "month"),
+                key=lambda r: (r["label"] is None, r["label"] or "")
+            )
+            monthly_footfall = [
+                {"month": r["label"], "count": r["count"]}
+                for r in footfall_rows
+            ]
 
-            # 6) MONTHLY FOOTFALL
-            footfall_sql = """
-                SELECT 
-                    to_char(date_trunc('month', version_timestamp), 'YYYY-MM') AS month_label,
-                    COUNT(*) AS count
-                FROM patient_info_versions
-                GROUP BY 1
-                ORDER BY 1
-            """
-            footfall_rows = conn.execute(text(footfall_sql)).mappings().all()
-            monthly_footfall = []
-            for r in footfall_rows:
-                monthly_footfall.append({
-                    "month": r["month_label"],
-                    "count": r["count"]
-                })
-
-            # 7) TOP DOCTORS
-            top_doctors_sql = """
-                SELECT d.name as doctor_name, COUNT(bi.id) as total_count
+            # 4) TOP DOCTORS & SERVICES from one scan of bill_items
+            bill_items_sql = """
+                SELECT
+                    GROUPING(d.name) AS by_service,
+                    d.name AS doctor_name,
+                    s.name AS service_name,
+                    COUNT(bi.id) AS total_count
                 FROM bill_items bi
-                JOIN doctors d ON d.id = bi.doctor_id
-                GROUP BY d.name
-                ORDER BY total_count DESC
-                LIMIT 5
+                LEFT JOIN doctors d ON d.id = bi.doctor_id
+                LEFT JOIN services s ON s.id = bi.service_id
+                GROUP BY GROUPING SETS ((d.name), (s.name))
             """
-            top_doctors_rows = conn.execute(text(top_doctors_sql)).mappings().all()
+            item_rows = conn.execute(text(bill_items_sql)).mappings().all()
+            doctor_rows = sorted(
+                (r for r in item_rows if not r["by_service"] and r["doctor_name"] is not None),
+                key=lambda r: r["total_count"], reverse=True
+            )
+            service_rows = sorted(
+                (r for r in item_rows if r["by_service"] and r["service_name"] is not None),
+                key=lambda r: r["total_count"], reverse=True
+            )
             top_doctors = [
                 {"doctor": td["doctor_name"], "count": td["total_count"]}
-                for td in top_doctors_rows
+                for td in doctor_rows[:5]
             ]
-
-            # 8) TOP SERVICES
-            top_services_sql = """
-                SELECT s.name as service_name, COUNT(bi.id) as total_count
-                FROM bill_items bi
-                JOIN services s ON s.id = bi.service_id
-                GROUP BY s.name
-                ORDER BY total_count DESC
-                LIMIT 5
-            """
-            top_services_rows = conn.execute(text(top_services_sql)).mappings().all()
             top_services = [
                 {"service": ts["service_name"], "count": ts["total_count"]}
-                for ts in top_services_rows
-            ]
-
-            # 9) TOTAL REVENUE (BILLS)
-            total_revenue_q = text("SELECT COALESCE(SUM(total_amount), 0) FROM bills")
-            total_revenue = conn.execute(total_revenue_q).scalar() or 0.0
-
-            # 10) PAYMENT MODE
-            payment_mode_sql = """
-                SELECT payment_mode, COUNT(*) AS cnt
-                FROM bills
-                GROUP BY payment_mode
-            """
-            p_rows = conn.execute(text(payment_mode_sql)).mappings().all()
-            payment_mode_dist = []
-            for r in p_rows:
-                payment_mode_dist.append({
-                    "mode": r["payment_mode"] or "Unknown",
-                    "count": r["cnt"]
-                })
-
-            # 11) TOP DEPARTMENTS
-            top_dept_sql = """
-                SELECT department, COUNT(*) as dept_count
-                FROM patient_info
-                WHERE department IS NOT NULL 
-                  AND department <> ''
-                GROUP BY department
-                ORDER BY dept_count DESC
-                LIMIT 5
-            """
-            dept_rows = conn.execute(text(top_dept_sql)).mappings().all()
-            top_departments = [
-                {"department": dr["department"], "count": dr["dept_count"]}
-                for dr in dept_rows
+                for ts in service_rows[:5]
             ]
 
-            # 12) MONTHLY GENDER TREND
-            monthly_gender_sql = """
-                SELECT 
-                    to_char(date_trunc('month', created_at), 'YYYY-MM') AS month_label,
-                    SUM(CASE WHEN gender ILIKE 'male' THEN 1 ELSE 0 END) AS male,
-                    SUM(CASE WHEN gender ILIKE 'female' THEN 1 ELSE 0 END) AS female,
-                    SUM(CASE WHEN gender NOT ILIKE 'male' AND gender NOT ILIKE 'female'
-                             AND gender NOT IN ('','Select Gender') THEN 1 ELSE 0 END) AS others
-                FROM patient_info
-                GROUP BY 1
-                ORDER BY 1
-            """
-            mg_rows = conn.execute(text(monthly_gender_sql)).mappings().all()
-            monthly_gender_trend = []
-            for r in mg_rows:
-                monthly_gender_trend.append({
-                    "month": r["month_label"],
-                    "male": r["male"],
-                    "female": r["female"],
-                    "others": r["others"],
-                })
-
-            # 13) MONTHLY AGE TREND
-            monthly_age_sql = """
+            # 5) BILLS: total revenue, payment modes and monthly revenue in one scan
+            bills_sql = """
                 SELECT
-                    to_char(date_trunc('month', created_at), 'YYYY-MM') AS month_label,
-                    SUM(CASE WHEN age BETWEEN 0 AND 18 THEN 1 ELSE 0 END) AS age_0_18,
-                    SUM(CASE WHEN age BETWEEN 19 AND 30 THEN 1 ELSE 0 END) AS age_19_30,
-                    SUM(CASE WHEN age BETWEEN 31 AND 60 THEN 1 ELSE 0 END) AS age_31_60,
-                    SUM(CASE WHEN age >= 61 THEN 1 ELSE 0 END) AS age_61_plus
-                FROM patient_info
-                GROUP BY 1
-                ORDER BY 1
-            """
-            ma_rows = conn.execute(text(monthly_age_sql)).mappings().all()
-            monthly_age_trend = []
-            for r in ma_rows:
-                monthly_age_trend.append({
-                    "month": r["month_label"],
-                    "age_0_18": r["age_0_18"],
-                    "age_19_30": r["age_19_30"],
-                    "age_31_60": r["age_31_60"],
-                    "age_61_plus": r["age_61_plus"],
-                })
-
-            top_diag_sql = """
-                WITH diag_cte AS (
-                  SELECT unnest(string_to_array(final_diagnosis, ',')) AS diag
-                  FROM patient_info
-                  WHERE final_diagnosis IS NOT NULL
-                    AND final_diagnosis <> ''
-                )
-                SELECT trim(diag) AS diagnosis, COUNT(*) AS count
-                FROM diag_cte
-                GROUP BY trim(diag)
-                ORDER BY count DESC
-                LIMIT 5
-            """
-            diag_rows = conn.execute(text(top_diag_sql)).mappings().all()
-            top_diagnosis = []
-            for row_d in diag_rows:
-                top_diagnosis.append({
-                    "diagnosis": row_d["diagnosis"],
-                    "count": row_d["count"]
-                })
-
-            monthly_revenue_sql = """
-                SELECT 
+                    GROUPING(payment_mode) AS g_mode,
+                    GROUPING(to_char(date_trunc('month', bill_date), 'YYYY-MM')) AS g_month,
+                    payment_mode,
                     to_char(date_trunc('month', bill_date), 'YYYY-MM') AS month_label,
-                    COALESCE(SUM(total_amount), 0) as revenue
+                    COUNT(*) AS cnt,
+                    COALESCE(SUM(total_amount), 0) AS revenue
                 FROM bills
-                GROUP BY 1
-                ORDER BY 1
+                GROUP BY GROUPING SETS (
+                    (),
+                    (payment_mode),
+                    (to_char(date_trunc('month', bill_date), 'YYYY-MM'))
+                )
             """
-            rev_rows = conn.execute(text(monthly_revenue_sql)).mappings().all()
-            monthly_revenue = []
-            for rr in rev_rows:
-                monthly_revenue.append({
-                    "month": rr["month_label"],
-                    "revenue": float(rr["revenue"])
-                })
+            bill_rows = conn.execute(text(bills_sql)).mappings().all()
+            total_revenue = 0.0
+            payment_mode_dist = []
+            revenue_rows = []
+            for r in bill_rows:
+                if r["g_mode"] and r["g_month"]:
+                    total_revenue = r["revenue"] or 0.0
+                elif not r["g_mode"]:
+                    payment_mode_dist.append({
+                        "mode": r["payment_mode"] or "Unknown",
+                        "count": r["cnt"]
+                    })
+                else:
+                    revenue_rows.append(r)
+            revenue_rows.sort(key=lambda r: (r["month_label"] is None, r["month_label"] or ""))
+            monthly_revenue = [
+                {"month": rr["month_label"], "revenue": float(rr["revenue"])}
+                for rr in revenue_rows
+            ]
 
         return {
             "success": True,
@@ -4022,6 +5650,513 @@ def get_reports():
     except Exception as e:
         logger.exception("Error generating reports")
         return {"success": False, "error": str(e)}
+
+# Report rollups: small aggregate tables kept current by triggers on the
+# source tables, so /api/reports/summary never scans patient or bill history.
+# rebuild_report_rollups() recomputes them from scratch (first start, or
+# after bulk data fixes). Triggers are only created when missing, so a normal
+# startup takes no locks on the source tables; the trigger functions are
+# replaced in place. Give a trigger a new name if its event list changes.
+SCHEMA_STATEMENTS.extend([
+    """
+    CREATE TABLE IF NOT EXISTS report_patient_rollup (
+        month TEXT NOT NULL,
+        gender_bucket TEXT NOT NULL,
+        age_bucket TEXT NOT NULL,
+        department TEXT NOT NULL,
+        patients BIGINT NOT NULL DEFAULT 0,
+        PRIMARY KEY (month, gender_bucket, age_bucket, department)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS report_diagnosis_rollup (
+        diagnosis TEXT PRIMARY KEY,
+        patients BIGINT NOT NULL DEFAULT 0
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS report_visit_rollup (
+        patient_id INTEGER PRIMARY KEY,
+        versions BIGINT NOT NULL DEFAULT 0
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS report_footfall_rollup (
+        month TEXT PRIMARY KEY,
+        versions BIGINT NOT NULL DEFAULT 0
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS report_bill_rollup (
+        month TEXT NOT NULL,
+        payment_mode TEXT NOT NULL,
+        bills BIGINT NOT NULL DEFAULT 0,
+        revenue NUMERIC NOT NULL DEFAULT 0,
+        PRIMARY KEY (month, payment_mode)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS report_bill_item_rollup (
+        item_kind TEXT NOT NULL,
+        ref_id INTEGER NOT NULL,
+        items BIGINT NOT NULL DEFAULT 0,
+        PRIMARY KEY (item_kind, ref_id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS report_counters (
+        metric TEXT PRIMARY KEY,
+        value BIGINT NOT NULL DEFAULT 0
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS report_rollup_meta (
+        id INTEGER PRIMARY KEY DEFAULT 1,
+        rebuilt_at TIMESTAMPTZ NOT NULL
+    )
+    """,
+    """
+    CREATE OR REPLACE FUNCTION report_month(ts TIMESTAMP) RETURNS TEXT AS $$
+        SELECT COALESCE(to_char(date_trunc('month', ts), 'YYYY-MM'), '')
+    $$ LANGUAGE sql IMMUTABLE
+    """,
+    """
+    CREATE OR REPLACE FUNCTION report_gender_bucket(g TEXT) RETURNS TEXT AS $$
+        SELECT CASE
+            WHEN g ILIKE 'male' THEN 'male'
+            WHEN g ILIKE 'female' THEN 'female'
+            WHEN g IS NULL OR g IN ('', 'Select Gender') THEN 'unknown'
+            ELSE 'others'
+        END
+    $$ LANGUAGE sql IMMUTABLE
+    """,
+    """
+    CREATE OR REPLACE FUNCTION report_age_bucket(a INTEGER) RETURNS TEXT AS $$
+        SELECT CASE
+            WHEN a BETWEEN 0 AND 18 THEN '0_18'
+            WHEN a BETWEEN 19 AND 30 THEN '19_30'
+            WHEN a BETWEEN 31 AND 60 THEN '31_60'
+            WHEN a >= 61 THEN '61_plus'
+            ELSE 'unknown'
+        END
+    $$ LANGUAGE sql IMMUTABLE
+    """,
+    """
+    CREATE OR REPLACE FUNCTION report_patient_rollup_apply(p patient_info, delta INTEGER) RETURNS void AS $$
+    BEGIN
+        INSERT INTO report_patient_rollup (month, gender_bucket, age_bucket, department, patients)
+        VALUES (report_month(p.created_at::timestamp), report_gender_bucket(p.gender),
+                report_age_bucket(p.age), COALESCE(p.department, ''), delta)
+        ON CONFLICT (month, gender_bucket, age_bucket, department)
+        DO UPDATE SET patients = report_patient_rollup.patients + EXCLUDED.patients;
+
+        IF p.final_diagnosis IS NOT NULL AND p.final_diagnosis <> '' THEN
+            INSERT INTO report_diagnosis_rollup (diagnosis, patients)
+            SELECT trim(d), delta * COUNT(*)
+            FROM unnest(string_to_array(p.final_diagnosis, ',')) AS d
+            GROUP BY trim(d)
+            ON CONFLICT (diagnosis)
+            DO UPDATE SET patients = report_diagnosis_rollup.patients + EXCLUDED.patients;
+        END IF;
+    END;
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE OR REPLACE FUNCTION report_patient_rollup_trigger() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            PERFORM report_patient_rollup_apply(OLD, -1);
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            PERFORM report_patient_rollup_apply(NEW, 1);
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    DO $$
+    BEGIN
+        IF NOT EXISTS (
+            SELECT 1 FROM pg_trigger WHERE tgname = 'report_patient_rollup_trg' AND tgrelid = 'patient_info'::regclass
+        ) THEN
+            CREATE TRIGGER report_patient_rollup_trg
+            AFTER INSERT OR DELETE OR UPDATE OF gender, age, department, created_at, final_diagnosis
+            ON patient_info
+            FOR EACH ROW EXECUTE FUNCTION report_patient_rollup_trigger();
+        END IF;
+    END
+    $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION report_version_rollup_trigger() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            UPDATE report_visit_rollup SET versions = versions - 1 WHERE patient_id = OLD.patient_id;
+            UPDATE report_footfall_rollup SET versions = versions - 1
+            WHERE month = report_month(OLD.version_timestamp::timestamp);
+            RETURN NULL;
+        END IF;
+        INSERT INTO report_visit_rollup (patient_id, versions) VALUES (NEW.patient_id, 1)
+        ON CONFLICT (patient_id) DO UPDATE SET versions = report_visit_rollup.versions + 1;
+        INSERT INTO report_footfall_rollup (month, versions)
+        VALUES (report_month(NEW.version_timestamp::timestamp), 1)
+        ON CONFLICT (month) DO UPDATE SET versions = report_footfall_rollup.versions + 1;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    DO $$
+    BEGIN
+        IF NOT EXISTS (
+            SELECT 1 FROM pg_trigger WHERE tgname = 'report_version_rollup_trg' AND tgrelid = 'patient_info_versions'::regclass
+        ) THEN
+            CREATE TRIGGER report_version_rollup_trg
+            AFTER INSERT OR DELETE ON patient_info_versions
+            FOR EACH ROW EXECUTE FUNCTION report_version_rollup_trigger();
+        END IF;
+    END
+    $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION report_bill_rollup_trigger() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            UPDATE report_bill_rollup
+            SET bills = bills - 1, revenue = revenue - COALESCE(OLD.total_amount, 0)
+            WHERE month = report_month(OLD.bill_date::timestamp)
+              AND payment_mode = COALESCE(OLD.payment_mode, '');
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            INSERT INTO report_bill_rollup (month, payment_mode, bills, revenue)
+            VALUES (report_month(NEW.bill_date::timestamp), COALESCE(NEW.payment_mode, ''),
+                    1, COALESCE(NEW.total_amount, 0))
+            ON CONFLICT (month, payment_mode)
+            DO UPDATE SET bills = report_bill_rollup.bills + 1,
+                          revenue = report_bill_rollup.revenue + EXCLUDED.revenue;
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    DO $$
+    BEGIN
+        IF NOT EXISTS (
+            SELECT 1 FROM pg_trigger WHERE tgname = 'report_bill_rollup_trg' AND tgrelid = 'bills'::regclass
+        ) THEN
+            CREATE TRIGGER report_bill_rollup_trg
+            AFTER INSERT OR DELETE OR UPDATE OF bill_date, payment_mode, total_amount ON bills
+            FOR EACH ROW EXECUTE FUNCTION report_bill_rollup_trigger();
+        END IF;
+    END
+    $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION report_bill_item_rollup_trigger() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            UPDATE report_bill_item_rollup SET items = items - 1
+            WHERE (item_kind = 'doctor' AND ref_id = OLD.doctor_id)
+               OR (item_kind = 'service' AND ref_id = OLD.service_id);
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            INSERT INTO report_bill_item_rollup (item_kind, ref_id, items)
+            SELECT kind, ref, 1
+            FROM (VALUES ('doctor', NEW.doctor_id), ('service', NEW.service_id)) AS v(kind, ref)
+            WHERE ref IS NOT NULL
+            ON CONFLICT (item_kind, ref_id)
+            DO UPDATE SET items = report_bill_item_rollup.items + 1;
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    DO $$
+    BEGIN
+        IF NOT EXISTS (
+            SELECT 1 FROM pg_trigger WHERE tgname = 'report_bill_item_rollup_trg' AND tgrelid = 'bill_items'::regclass
+        ) THEN
+            CREATE TRIGGER report_bill_item_rollup_trg
+            AFTER INSERT OR DELETE OR UPDATE OF doctor_id, service_id ON bill_items
+            FOR EACH ROW EXECUTE FUNCTION report_bill_item_rollup_trigger();
+        END IF;
+    END
+    $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION report_appointment_counter_trigger() RETURNS trigger AS $$
+    BEGIN
+        INSERT INTO report_counters (metric, value)
+        VALUES ('appointments', CASE WHEN TG_OP = 'INSERT' THEN 1 ELSE -1 END)
+        ON CONFLICT (metric) DO UPDATE SET value = report_counters.value + EXCLUDED.value;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    DO $$
+    BEGIN
+        IF NOT EXISTS (
+            SELECT 1 FROM pg_trigger WHERE tgname = 'report_appointment_counter_trg' AND tgrelid = 'appointments'::regclass
+        ) THEN
+            CREATE TRIGGER report_appointment_counter_trg
+            AFTER INSERT OR DELETE ON appointments
+            FOR EACH ROW EXECUTE FUNCTION report_appointment_counter_trigger();
+        END IF;
+    END
+    $$
+    """,
+])
+
+REPORT_ROLLUP_TABLES = [
+    "report_patient_rollup",
+    "report_diagnosis_rollup",
+    "report_visit_rollup",
+    "report_footfall_rollup",
+    "report_bill_rollup",
+    "report_bill_item_rollup",
+    "report_counters",
+]
+
+def rebuild_report_rollups():
+    """
+    Recomputes every rollup table from the source tables in one transaction.
+    TRUNCATE's lock makes concurrent trigger updates wait for the rebuild.
+    """
+    logger.info("Rebuilding report rollups")
+    with engine.begin() as conn:
+        conn.execute(text(f"TRUNCATE {', '.join(REPORT_ROLLUP_TABLES)}"))
+        conn.execute(text("""
+            INSERT INTO report_patient_rollup (month, gender_bucket, age_bucket, department, patients)
+            SELECT report_month(created_at::timestamp), report_gender_bucket(gender),
+                   report_age_bucket(age), COALESCE(department, ''), COUNT(*)
+            FROM patient_info
+            GROUP BY 1, 2, 3, 4
+        """))
+        conn.execute(text("""
+            INSERT INTO report_diagnosis_rollup (diagnosis, patients)
+            SELECT trim(d), COUNT(*)
+            FROM patient_info, unnest(string_to_array(final_diagnosis, ',')) AS d
+            WHERE final_diagnosis IS NOT NULL AND final_diagnosis <> ''
+            GROUP BY trim(d)
+        """))
+        conn.execute(text("""
+            INSERT INTO report_visit_rollup (patient_id, versions)
+            SELECT patient_id, COUNT(*) FROM patient_info_versions GROUP BY patient_id
+        """))
+        conn.execute(text("""
+            INSERT INTO report_footfall_rollup (month, versions)
+            SELECT report_month(version_timestamp::timestamp), COUNT(*)
+            FROM patient_info_versions
+            GROUP BY 1
+        """))
+        conn.execute(text("""
+            INSERT INTO report_bill_rollup (month, payment_mode, bills, revenue)
+            SELECT report_month(bill_date::timestamp), COALESCE(payment_mode, ''),
+                   COUNT(*), COALESCE(SUM(total_amount), 0)
+            FROM bills
+            GROUP BY 1, 2
+        """))
+        conn.execute(text("""
+            INSERT INTO report_bill_item_rollup (item_kind, ref_id, items)
+            SELECT 'doctor', doctor_id, COUNT(*) FROM bill_items
+            WHERE doctor_id IS NOT NULL GROUP BY doctor_id
+            UNION ALL
+            SELECT 'service', service_id, COUNT(*) FROM bill_items
+            WHERE service_id IS NOT NULL GROUP BY service_id
+        """))
+        conn.execute(text("""
+            INSERT INTO report_counters (metric, value)
+            SELECT 'appointments', COUNT(*) FROM appointments
+        """))
+        conn.execute(text("""
+            INSERT INTO report_rollup_meta (id, rebuilt_at) VALUES (1, now())
+            ON CONFLICT (id) DO UPDATE SET rebuilt_at = EXCLUDED.rebuilt_at
+        """))
+
+@app.on_event("startup")
+def ensure_report_rollups():
+    try:
+        with engine.connect() as conn:
+            built = conn.execute(text("SELECT 1 FROM report_rollup_meta WHERE id = 1")).first()
+        if not built:
+            rebuild_report_rollups()
+    except Exception as e:
+        logger.error(f"Error preparing report rollups: {e}")
+
+def month_label(month: str):
+    return month or None
+
+@app.get("/api/reports/summary")
+def get_reports_summary():
+    """
+    Same payload as /api/reports, read from the trigger-maintained rollup
+    tables instead of aggregating patient and bill history.
+    """
+    try:
+        with engine.connect() as conn:
+            patient_rows = conn.execute(text("""
+                SELECT month, gender_bucket, age_bucket, department, patients
+                FROM report_patient_rollup
+                WHERE patients <> 0
+            """)).mappings().all()
+
+            version_row = conn.execute(text("""
+                SELECT
+                    COUNT(*) FILTER (WHERE versions = 1) AS one_visit,
+                    COUNT(*) FILTER (WHERE versions = 2) AS two_visits,
+                    COUNT(*) FILTER (WHERE versions = 3) AS three_visits,
+                    COUNT(*) FILTER (WHERE versions >= 4) AS four_plus_visits
+                FROM report_visit_rollup
+            """)).mappings().first()
+
+            footfall_rows = conn.execute(text("""
+                SELECT month, versions FROM report_footfall_rollup
+                WHERE versions > 0
+                ORDER BY month
+            """)).mappings().all()
+
+            bill_rows = conn.execute(text("""
+                SELECT month, payment_mode, bills, revenue
+                FROM report_bill_rollup
+                WHERE bills <> 0
+            """)).mappings().all()
+
+            top_doctors_rows = conn.execute(text("""
+                SELECT d.name AS doctor_name, SUM(r.items) AS total_count
+                FROM report_bill_item_rollup r
+                JOIN doctors d ON d.id = r.ref_id
+                WHERE r.item_kind = 'doctor'
+                GROUP BY d.name
+                ORDER BY total_count DESC
+                LIMIT 5
+            """)).mappings().all()
+
+            top_services_rows = conn.execute(text("""
+                SELECT s.name AS service_name, SUM(r.items) AS total_count
+                FROM report_bill_item_rollup r
+                JOIN services s ON s.id = r.ref_id
+                WHERE r.item_kind = 'service'
+                GROUP BY s.name
+                ORDER BY total_count DESC
+                LIMIT 5
+            """)).mappings().all()
+
+            diag_rows = conn.execute(text("""
+                SELECT diagnosis, patients FROM report_diagnosis_rollup
+                WHERE patients > 0
+                ORDER BY patients DESC
+                LIMIT 5
+            """)).mappings().all()
+
+            total_appointments = conn.execute(text(
+                "SELECT value FROM report_counters WHERE metric = 'appointments'"
+            )).scalar() or 0
+
+            rebuilt_at = conn.execute(text(
+                "SELECT rebuilt_at FROM report_rollup_meta WHERE id = 1"
+            )).scalar()
+
+        gender_ratio = {"male": 0, "female": 0, "others": 0}
+        age_distribution = {"0_18": 0, "19_30": 0, "31_60": 0, "61_plus": 0}
+        departments = Counter()
+        gender_by_month: Dict[str, Dict[str, int]] = {}
+        age_by_month: Dict[str, Dict[str, int]] = {}
+        total_patients = 0
+        for r in patient_rows:
+            count = r["patients"]
+            total_patients += count
+            if r["gender_bucket"] in gender_ratio:
+                gender_ratio[r["gender_bucket"]] += count
+            if r["age_bucket"] in age_distribution:
+                age_distribution[r["age_bucket"]] += count
+            if r["department"]:
+                departments[r["department"]] += count
+            g = gender_by_month.setdefault(r["month"], {"male": 0, "female": 0, "others": 0})
+            if r["gender_bucket"] in g:
+                g[r["gender_bucket"]] += count
+            a = age_by_month.setdefault(r["month"], {"0_18": 0, "19_30": 0, "31_60": 0, "61_plus": 0})
+            if r["age_bucket"] in a:
+                a[r["age_bucket"]] += count
+
+        total_revenue = 0.0
+        payment_modes = Counter()
+        revenue_by_month: Dict[str, float] = {}
+        for r in bill_rows:
+            total_revenue += float(r["revenue"])
+            payment_modes[r["payment_mode"]] += r["bills"]
+            revenue_by_month[r["month"]] = revenue_by_month.get(r["month"], 0.0) + float(r["revenue"])
+
+        return {
+            "success": True,
+            "data": {
+                "counts": {
+                    "totalPatients": total_patients,
+                    "totalAppointments": total_appointments,
+                    "totalRevenue": total_revenue,
+                },
+                "genderRatio": gender_ratio,
+                "ageDistribution": age_distribution,
+                "repeatVisits": {
+                    "one": version_row["one_visit"] if version_row else 0,
+                    "two": version_row["two_visits"] if version_row else 0,
+                    "three": version_row["three_visits"] if version_row else 0,
+                    "four_plus": version_row["four_plus_visits"] if version_row else 0,
+                },
+                "monthlyFootfall": [
+                    {"month": month_label(r["month"]), "count": r["versions"]}
+                    for r in footfall_rows
+                ],
+                "topDoctors": [
+                    {"doctor": td["doctor_name"], "count": td["total_count"]}
+                    for td in top_doctors_rows
+                ],
+                "topServices": [
+                    {"service": ts["service_name"], "count": ts["total_count"]}
+                    for ts in top_services_rows
+                ],
+                "paymentModeDistribution": [
+                    {"mode": mode or "Unknown", "count": count}
+                    for mode, count in payment_modes.items() if count
+                ],
+                "topDepartments": [
+                    {"department": dept, "count": count}
+                    for dept, count in departments.most_common(5)
+                ],
+                "monthlyGenderTrend": [
+                    {"month": month_label(m), **gender_by_month[m]}
+                    for m in sorted(gender_by_month)
+                ],
+                "monthlyAgeTrend": [
+                    {"month": month_label(m), **{f"age_{k}": v for k, v in age_by_month[m].items()}}
+                    for m in sorted(age_by_month)
+                ],
+                "topDiagnosis": [
+                    {"diagnosis": row_d["diagnosis"], "count": row_d["patients"]}
+                    for row_d in diag_rows
+                ],
+                "monthlyRevenue": [
+                    {"month": month_label(m), "revenue": revenue_by_month[m]}
+                    for m in sorted(revenue_by_month)
+                ],
+                "rollupsRebuiltAt": rebuilt_at.isoformat() if rebuilt_at else None
+            }
+        }
+    except Exception as e:
+        logger.exception("Error generating reports from rollups")
+        return {"success": False, "error": str(e)}
+
+@app.post("/api/reports/rollups/rebuild")
+def api_rebuild_report_rollups():
+    try:
+        rebuild_report_rollups()
+        return {"message": "Report rollups rebuilt"}
+    except Exception as e:
+        logger.exception("Error rebuilding report rollups")
+        raise HTTPException(status_code=500, detail=str(e))
     
 
 from fastapi import FastAPI, HTTPException, status
@@ -4268,11 +6403,17 @@ class PharmacyBillResponse(BaseModel):
     total_amount: float
     items: List[PharmacyBillItemResponse]
     pdf_base64: Optional[str] = None
+    pdf_url: Optional[str] = None
+    pdf_job_id: Optional[str] = None
 
 # Pharmacy billing endpoints
 @app.post("/api/pharmacy/bills", response_model=PharmacyBillResponse, status_code=status.HTTP_201_CREATED)
-def create_pharmacy_bill(bill: PharmacyBillCreate):
-    """Create a new pharmacy bill with items and generate PDF"""
+def create_pharmacy_bill(bill: PharmacyBillCreate, pdf_delivery: str = "inline", include_pdf_base64: bool = True):
+    """
+    Create a new pharmacy bill with items. pdf_delivery works as in
+    create_bill: "inline", "deferred" or "none".
+    """
+    validate_pdf_delivery(pdf_delivery)
     try:
         # Extract patient information
         patient_id = bill.patient.get("id")
@@ -4386,180 +6527,8 @@ def create_pharmacy_bill(bill: PharmacyBillCreate):
                     # If quantity went negative, roll back with a specific error
                     raise HTTPException(status_code=400, detail=f"Insufficient stock for {item.name}")
             
-            # 3. Generate PDF receipt
-            html_content = f"""
-            <!DOCTYPE html>
-            <html>
-            <head>
-                <meta charset="UTF-8">
-                <title>Pharmacy Bill Receipt</title>
-                <style>
-                    @page {{
-                        size: A4;
-                        margin: 1cm;
-                    }}
-                    body {{
-                        font-family: Arial, sans-serif;
-                        margin: 0;
-                        padding: 20px;
-                        color: #333;
-                    }}
-                    .receipt {{
-                        max-width: 800px;
-                        margin: 0 auto;
-                        border: 1px solid #ddd;
-                        padding: 20px;
-                        box-shadow: 0 0 10px rgba(0,0,0,0.1);
-                    }}
-                    .header {{
-                        text-align: center;
-                        border-bottom: 2px solid #333;
-                        padding-bottom: 10px;
-                        margin-bottom: 20px;
-                    }}
-                    .pharmacy-name {{
-                        font-size: 24px;
-                        font-weight: bold;
-                        margin-bottom: 5px;
-                    }}
-                    .pharmacy-contact {{
-                        font-size: 14px;
-                        color: #666;
-                    }}
-                    .bill-info {{
-                        display: flex;
-                        justify-content: space-between;
-                        margin-bottom: 20px;
-                    }}
-                    .patient-info, .bill-details {{
-                        flex: 1;
-                    }}
-                    .info-title {{
-                        font-weight: bold;
-                        margin-bottom: 5px;
-                    }}
-                    .info-item {{
-                        margin-bottom: 3px;
-                    }}
-                    table {{
-                        width: 100%;
-                        border-collapse: collapse;
-                        margin-bottom: 20px;
-                    }}
-                    th, td {{
-                        border: 1px solid #ddd;
-                        padding: 8px;
-                        text-align: left;
-                    }}
-                    th {{
-                        background-color: #f2f2f2;
-                    }}
-                    .summary {{
-                        margin-top: 20px;
-                        text-align: right;
-                    }}
-                    .total {{
-                        font-weight: bold;
-                        font-size: 18px;
-                        margin-top: 10px;
-                    }}
-                    .footer {{
-                        margin-top: 30px;
-                        text-align: center;
-                        font-size: 14px;
-                        color: #666;
-                        border-top: 1px solid #ddd;
-                        padding-top: 10px;
-                    }}
-                </style>
-            </head>
-            <body>
-                <div class="receipt">
-                    <div class="header">
-                        <div class="pharmacy-name">Health Plus Pharmacy</div>
-                        <div class="pharmacy-contact">123 Medical Avenue, City | Phone: +91 1234567890 | Email: pharmacy@healthplus.com</div>
-                    </div>
-                    
-                    <div class="bill-info">
-                        <div class="patient-info">
-                            <div class="info-title">Patient Information</div>
-                            <div class="info-item">Name: {patient_name}</div>
-                            <div class="info-item">Age/Gender: {patient_age or 'N/A'}/{patient_gender or 'N/A'}</div>
-                            <div class="info-item">Contact: {patient_phone}</div>
-                        </div>
-                        
-                        <div class="bill-details">
-                            <div class="info-title">Bill Details</div>
-                            <div class="info-item">Bill #: {bill_id}</div>
-                            <div class="info-item">Date: {bill_date.strftime('%d-%m-%Y')}</div>
-                            <div class="info-item">Time: {bill_date.strftime('%H:%M')}</div>
-                            <div class="info-item">Payment Mode: {payment_mode.title()}</div>
-                            <div class="info-item">Status: {payment_status.title()}</div>
-                        </div>
-                    </div>
-                    
-                    <table>
-                        <thead>
-                            <tr>
-                                <th>Medicine</th>
-                                <th>Quantity</th>
-                                <th>Price (₹)</th>
-                                <th>Discount</th>
-                                <th>Amount (₹)</th>
-                            </tr>
-                        </thead>
-                        <tbody>
-            """
-            
-            # Add rows for each medicine item
-            for item in bill.items:
-                item_total = item.quantity * item.price * (1 - item.discount / 100)
-                discount_amount = (item.quantity * item.price * item.discount) / 100
-                
-                html_content += f"""
-                            <tr>
-                                <td>{item.name}</td>
-                                <td>{item.quantity}</td>
-                                <td>{item.price:.2f}</td>
-                                <td>{item.discount}% ({discount_amount:.2f})</td>
-                                <td>{item_total:.2f}</td>
-                            </tr>
-                """
-            
-            # Complete the HTML
-            html_content += f"""
-                        </tbody>
-                    </table>
-                    
-                    <div class="summary">
-                        <div class="total">Total Amount: ₹{total_amount:.2f}</div>
-                    </div>
-                    
-                    <div class="footer">
-                        <p>Thank you for choosing Health Plus Pharmacy. Get well soon!</p>
-                        <p>This is a computer-generated receipt and does not require a signature.</p>
-                    </div>
-                </div>
-            </body>
-            </html>
-            """
-            
-            # Import WeasyPrint here to avoid startup overhead if not needed
-            from weasyprint import HTML
-            
-            # Generate PDF from HTML
-            pdf_buffer = io.BytesIO()
-            HTML(string=html_content).write_pdf(pdf_buffer)
-            
-            # Get PDF content and convert to base64
-            pdf_buffer.seek(0)
-            pdf_content = pdf_buffer.getvalue()
-            pdf_base64 = base64.b64encode(pdf_content).decode('utf-8')
-            
-            # 4. Return full bill with items and PDF
-            return {
+            receipt = {
                 "id": bill_id,
-                "patient_id": patient_id,
                 "patient_name": patient_name,
                 "patient_age": patient_age,
                 "patient_gender": patient_gender,
@@ -4568,9 +6537,25 @@ def create_pharmacy_bill(bill: PharmacyBillCreate):
                 "payment_mode": payment_mode,
                 "payment_status": payment_status,
                 "total_amount": total_amount,
-                "items": bill_items,
-                "pdf_base64": pdf_base64
+                "items": bill_items
             }
+        
+        # 3. Deliver the PDF receipt after the bill is committed
+        response = {
+            "id": bill_id,
+            "patient_id": patient_id,
+            "patient_name": patient_name,
+            "patient_age": patient_age,
+            "patient_gender": patient_gender,
+            "patient_phone": patient_phone,
+            "bill_date": bill_date,
+            "payment_mode": payment_mode,
+            "payment_status": payment_status,
+            "total_amount": total_amount,
+            "items": bill_items
+        }
+        response.update(deliver_receipt("pharmacy", receipt, pdf_delivery, include_pdf_base64))
+        return response
             
     except HTTPException as he:
         raise he
@@ -4594,19 +6579,8 @@ def get_recent_pharmacy_bills(limit: int = 10):
             bills_result = conn.execute(bills_query, {"limit": limit})
             bills_data = [dict(row._mapping) for row in bills_result]
             
-            # For each bill, get its items
-            for bill in bills_data:
-                items_query = text("""
-                    SELECT id, medicine_id, medicine_name, quantity, price_per_unit, 
-                           discount_percentage, item_total
-                    FROM pharmacy_bill_items
-                    WHERE bill_id = :bill_id
-                """)
-                
-                items_result = conn.execute(items_query, {"bill_id": bill["id"]})
-                bill["items"] = [dict(row._mapping) for row in items_result]
-            
-            return bills_data
+            # Get the items for all bills in one query
+            return attach_bill_items(conn, bills_data, PHARMACY_BILL_ITEMS_SQL)
             
     except Exception as e:
         print(f"Error in get_recent_pharmacy_bills: {str(e)}")
@@ -4667,250 +6641,256 @@ def get_pharmacy_bill(bill_id: int):
 
 
 @app.get("/api/pharmacy/bills/{bill_id}/pdf")
-def get_pharmacy_bill_pdf(bill_id: int):
-    """Generate and return a PDF for a pharmacy bill"""
+def get_pharmacy_bill_pdf(bill_id: int, redirect: bool = False):
+    """
+    Return the PDF for a pharmacy bill. The stored receipt is reused while the
+    bill is unchanged; redirect=true sends the client to a presigned S3 URL
+    instead of streaming the bytes through the API.
+    """
     try:
-        with engine.begin() as conn:
-            # Get pharmacy bill data
-            bill_query = text("""
-                SELECT id, patient_id, patient_name, patient_age, patient_gender, patient_phone,
-                       bill_date, payment_mode, payment_status, total_amount
-                FROM pharmacy_bills WHERE id = :bill_id
-            """)
-            
-            bill_result = conn.execute(bill_query, {"bill_id": bill_id})
-            bill_row = bill_result.fetchone()
-            
-            if not bill_row:
-                raise HTTPException(status_code=404, detail="Pharmacy bill not found")
-            
-            bill_id = bill_row[0]
-            patient_name = bill_row[2]
-            patient_age = bill_row[3]
-            patient_gender = bill_row[4]
-            patient_phone = bill_row[5]
-            bill_date = bill_row[6]
-            payment_mode = bill_row[7]
-            payment_status = bill_row[8]
-            total_amount = bill_row[9]
-            
-            # Get pharmacy bill items
-            items_query = text("""
-                SELECT id, medicine_id, medicine_name, quantity, price_per_unit, 
-                       discount_percentage, item_total
-                FROM pharmacy_bill_items
-                WHERE bill_id = :bill_id
-            """)
-            
-            items_result = conn.execute(items_query, {"bill_id": bill_id})
-            items = [dict(row._mapping) for row in items_result]
-            
-            # Generate PDF - HTML content creation
-            html_content = f"""
-            <!DOCTYPE html>
-            <html>
-            <head>
-                <meta charset="UTF-8">
-                <title>Pharmacy Bill Receipt</title>
-                <style>
-                    @page {{
-                        size: A4;
-                        margin: 1cm;
-                    }}
-                    body {{
-                        font-family: Arial, sans-serif;
-                        margin: 0;
-                        padding: 20px;
-                        color: #333;
-                    }}
-                    .receipt {{
-                        max-width: 800px;
-                        margin: 0 auto;
-                        border: 1px solid #ddd;
-                        padding: 20px;
-                        box-shadow: 0 0 10px rgba(0,0,0,0.1);
-                    }}
-                    .header {{
-                        text-align: center;
-                        border-bottom: 2px solid #333;
-                        padding-bottom: 10px;
-                        margin-bottom: 20px;
-                    }}
-                    .pharmacy-name {{
-                        font-size: 24px;
-                        font-weight: bold;
-                        margin-bottom: 5px;
-                    }}
-                    .pharmacy-contact {{
-                        font-size: 14px;
-                        color: #666;
-                    }}
-                    .bill-info {{
-                        display: flex;
-                        justify-content: space-between;
-                        margin-bottom: 20px;
-                    }}
-                    .patient-info, .bill-details {{
-                        flex: 1;
-                    }}
-                    .info-title {{
-                        font-weight: bold;
-                        margin-bottom: 5px;
-                    }}
-                    .info-item {{
-                        margin-bottom: 3px;
-                    }}
-                    table {{
-                        width: 100%;
-                        border-collapse: collapse;
-                        margin-bottom: 20px;
-                    }}
-                    th, td {{
-                        border: 1px solid #ddd;
-                        padding: 8px;
-                        text-align: left;
-                    }}
-                    th {{
-                        background-color: #f2f2f2;
-                    }}
-                    .summary {{
-                        margin-top: 20px;
-                        text-align: right;
-                    }}
-                    .total {{
-                        font-weight: bold;
-                        font-size: 18px;
-                        margin-top: 10px;
-                    }}
-                    .footer {{
-                        margin-top: 30px;
-                        text-align: center;
-                        font-size: 14px;
-                        color: #666;
-                        border-top: 1px solid #ddd;
-                        padding-top: 10px;
-                    }}
-                </style>
-            </head>
-            <body>
-                <div class="receipt">
-                    <div class="header">
-                        <div class="pharmacy-name">Health Plus Pharmacy</div>
-                        <div class="pharmacy-contact">123 Medical Avenue, City | Phone: +91 1234567890 | Email: pharmacy@healthplus.com</div>
-                    </div>
-                    
-                    <div class="bill-info">
-                        <div class="patient-info">
-                            <div class="info-title">Patient Information</div>
-                            <div class="info-item">Name: {patient_name}</div>
-                            <div class="info-item">Age/Gender: {patient_age or 'N/A'}/{patient_gender or 'N/A'}</div>
-                            <div class="info-item">Contact: {patient_phone}</div>
-                        </div>
-                        
-                        <div class="bill-details">
-                            <div class="info-title">Bill Details</div>
-                            <div class="info-item">Bill #: {bill_id}</div>
-                            <div class="info-item">Date: {bill_date.strftime('%d-%m-%Y')}</div>
-                            <div class="info-item">Time: {bill_date.strftime('%H:%M')}</div>
-                            <div class="info-item">Payment Mode: {payment_mode.title()}</div>
-                            <div class="info-item">Status: {payment_status.title()}</div>
-                        </div>
-                    </div>
-                    
-                    <table>
-                        <thead>
-                            <tr>
-                                <th>Medicine</th>
-                                <th>Quantity</th>
-                                <th>Price (₹)</th>
-                                <th>Discount</th>
-                                <th>Amount (₹)</th>
-                            </tr>
-                        </thead>
-                        <tbody>
-            """
-            
-            # Add rows for each medicine item
-            for item in items:
-                discount_amount = (item['quantity'] * item['price_per_unit'] * item['discount_percentage']) / 100
-                
-                html_content += f"""
-                            <tr>
-                                <td>{item['medicine_name']}</td>
-                                <td>{item['quantity']}</td>
-                                <td>{item['price_per_unit']:.2f}</td>
-                                <td>{item['discount_percentage']}% ({discount_amount:.2f})</td>
-                                <td>{item['item_total']:.2f}</td>
-                            </tr>
-                """
-            
-            # Complete the HTML
-            html_content += f"""
-                        </tbody>
-                    </table>
-                    
-                    <div class="summary">
-                        <div class="total">Total Amount: ₹{total_amount:.2f}</div>
-                    </div>
-                    
-                    <div class="footer">
-                        <p>Thank you for choosing Health Plus Pharmacy. Get well soon!</p>
-                        <p>This is a computer-generated receipt and does not require a signature.</p>
-                    </div>
-                </div>
-            </body>
-            </html>
-            """
-            
-            # Import WeasyPrint here to avoid startup overhead if not needed
-            from weasyprint import HTML
-            from fastapi.responses import Response
-            
-            # Generate PDF from HTML
-            pdf_buffer = io.BytesIO()
-            HTML(string=html_content).write_pdf(pdf_buffer)
-            
-            # Return PDF as a downloadable file
-            pdf_buffer.seek(0)
-            pdf_content = pdf_buffer.getvalue()
-            
-            # Return PDF with proper headers for download
-            return Response(
-                content=pdf_content,
-                media_type="application/pdf",
-                headers={
-                    "Content-Disposition": f"attachment; filename=pharmacy-bill-{bill_id}.pdf"
-                }
-            )
-            
+        # Load the bill first so no DB connection is held during render/upload
+        bills = load_receipt_bills("pharmacy", [bill_id])
+        if not bills:
+            raise HTTPException(status_code=404, detail="Pharmacy bill not found")
+        receipt_url, pdf_content = ensure_receipt_pdf("pharmacy", bills[0], need_bytes=not redirect)
+        if redirect:
+            return RedirectResponse(generate_presigned_url(receipt_url, RECEIPT_URL_EXPIRATION_SECONDS))
+        
+        # Return PDF with proper headers for download
+        return Response(
+            content=pdf_content,
+            media_type="application/pdf",
+            headers={
+                "Content-Disposition": f"attachment; filename=pharmacy-bill-{bill_id}.pdf"
+            }
+        )
+    except HTTPException as he:
+        raise he
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+RECEIPT_BULK_MAX = int(os.getenv("RECEIPT_BULK_MAX", "100"))
+RECEIPT_URL_EXPIRATION_SECONDS = int(os.getenv("RECEIPT_URL_EXPIRATION_SECONDS", "3600"))
+
+# Rendered receipts are stored in S3 under a key derived from the bill id and
+# the content version, so a receipt is rendered once per distinct content.
+SCHEMA_STATEMENTS.append("""
+    CREATE TABLE IF NOT EXISTS bill_receipts (
+        kind TEXT NOT NULL,
+        bill_id INTEGER NOT NULL,
+        content_version TEXT NOT NULL,
+        s3_url TEXT NOT NULL,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        PRIMARY KEY (kind, bill_id)
+    )
+""")
+
+def get_stored_receipt_url(kind: str, bill_id: int, content_version: str) -> Optional[str]:
+    query = text("""
+        SELECT s3_url FROM bill_receipts
+        WHERE kind = :kind AND bill_id = :bill_id AND content_version = :version
+    """)
+    with engine.connect() as conn:
+        return conn.execute(query, {"kind": kind, "bill_id": bill_id, "version": content_version}).scalar()
+
+def ensure_receipt_pdf(kind: str, bill: dict, need_bytes: bool = False, pdf_bytes: bytes = None):
+    """
+    Returns (s3_url, pdf_bytes) for the bill's current receipt. Reuses the
+    stored PDF when the content version matches, otherwise renders (unless
+    pdf_bytes is supplied), uploads and records it. pdf_bytes is None when the
+    stored copy was reused and need_bytes is False.
+    """
+    version = receipt_content_version(kind, bill)
+    if pdf_bytes is None:
+        s3_url = get_stored_receipt_url(kind, bill["id"], version)
+        if s3_url:
+            if not need_bytes:
+                return s3_url, None
+            stored = download_from_s3(s3_url)
+            if stored:
+                return s3_url, stored
+        pdf_bytes = render_receipt(kind, bill)
+
+    key = f"receipt_{kind}_{bill['id']}_{version}.pdf"
+    s3_url = upload_to_s3(pdf_bytes, key, key=key)
+    upsert_query = text("""
+        INSERT INTO bill_receipts (kind, bill_id, content_version, s3_url)
+        VALUES (:kind, :bill_id, :version, :url)
+        ON CONFLICT (kind, bill_id) DO UPDATE
+        SET content_version = EXCLUDED.content_version,
+            s3_url = EXCLUDED.s3_url,
+            created_at = now()
+    """)
+    with engine.begin() as conn:
+        conn.execute(upsert_query, {"kind": kind, "bill_id": bill["id"], "version": version, "url": s3_url})
+    return s3_url, pdf_bytes
+
+PDF_DELIVERY_MODES = ("none", "deferred", "inline")
+
+def validate_pdf_delivery(pdf_delivery: str):
+    if pdf_delivery not in PDF_DELIVERY_MODES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"pdf_delivery must be one of: {', '.join(PDF_DELIVERY_MODES)}"
+        )
+
+def deliver_receipt(kind: str, receipt: dict, pdf_delivery: str, include_pdf_base64: bool) -> dict:
+    """
+    Returns the pdf_* response fields for a newly created bill. The bill is
+    already committed, so receipt failures are logged rather than raised (a
+    500 here would make clients retry and create a duplicate bill): a failed
+    inline render falls back to a deferred job, and if that cannot be queued
+    either the pdf fields are left out.
+    """
+    if pdf_delivery == "none":
+        return {}
+    if pdf_delivery == "inline":
+        try:
+            receipt_url, pdf_content = ensure_receipt_pdf(kind, receipt, need_bytes=include_pdf_base64)
+            return {
+                "pdf_base64": base64.b64encode(pdf_content).decode('utf-8') if include_pdf_base64 else None,
+                "pdf_url": generate_presigned_url(receipt_url, RECEIPT_URL_EXPIRATION_SECONDS)
+            }
+        except Exception as e:
+            logger.error(f"Error rendering {kind} receipt for bill {receipt['id']}, deferring: {e}")
+    try:
+        return {"pdf_job_id": submit_job("receipt", {"kind": kind, "bill_id": receipt["id"]})}
+    except Exception as e:
+        logger.error(f"Error queueing {kind} receipt job for bill {receipt['id']}: {e}")
+        return {}
+
+def store_receipt_for_bill(kind: str, bill_id: int) -> dict:
+    bills = load_receipt_bills(kind, [bill_id])
+    if not bills:
+        raise HTTPException(status_code=404, detail="Bill not found")
+    receipt_url, _ = ensure_receipt_pdf(kind, bills[0])
+    return {
+        "bill_id": bill_id,
+        "pdf_url": generate_presigned_url(receipt_url, RECEIPT_URL_EXPIRATION_SECONDS)
+    }
+
+async def run_receipt_job(payload: dict) -> dict:
+    return await asyncio.to_thread(store_receipt_for_bill, payload["kind"], int(payload["bill_id"]))
+
+JOB_HANDLERS["receipt"] = run_receipt_job
+
+def load_receipt_bills(kind: str, bill_ids: List[int]) -> List[dict]:
+    """Loads headers and items for clinic or pharmacy receipts in two queries."""
+    if kind == "clinic":
+        bills_query = text("""
+            SELECT b.id, b.bill_date, b.payment_mode, b.payment_status, b.total_amount,
+                   p.patient_name, p.age AS patient_age, p.gender AS patient_gender,
+                   p.contact_number AS patient_phone
+            FROM bills b
+            JOIN patient_info p ON p.id = b.patient_id
+            WHERE b.id = ANY(:bill_ids)
+        """)
+        items_sql = BILL_ITEMS_SQL
+    else:
+        bills_query = text("""
+            SELECT id, patient_name, patient_age, patient_gender, patient_phone,
+                   bill_date, payment_mode, payment_status, total_amount
+            FROM pharmacy_bills
+            WHERE id = ANY(:bill_ids)
+        """)
+        items_sql = PHARMACY_BILL_ITEMS_SQL
+
+    with engine.connect() as conn:
+        bills = [dict(row) for row in conn.execute(bills_query, {"bill_ids": bill_ids}).mappings()]
+        attach_bill_items(conn, bills, items_sql)
+
+    if kind == "clinic":
+        services = {s["id"]: s["name"] for s in reference_cache.rows("services")}
+        doctors = {d["id"]: d["name"] for d in reference_cache.rows("doctors")}
+        for bill in bills:
+            for item in bill["items"]:
+                item["service"] = services.get(item["service_id"], "")
+                item["doctor"] = doctors.get(item["doctor_id"], "")
+                if item["appointment_time"] is not None:
+                    item["appointment_time"] = item["appointment_time"].strftime("%H:%M")
+    return bills
+
+@app.get("/api/bills/{bill_id}/pdf")
+def get_bill_pdf(bill_id: int, redirect: bool = False):
+    """
+    Return the PDF receipt for a clinic bill, rendering it only if no stored
+    copy matches the bill's current content.
+    """
+    try:
+        bills = load_receipt_bills("clinic", [bill_id])
+        if not bills:
+            raise HTTPException(status_code=404, detail="Bill not found")
+        receipt_url, pdf_content = ensure_receipt_pdf("clinic", bills[0], need_bytes=not redirect)
+        if redirect:
+            return RedirectResponse(generate_presigned_url(receipt_url, RECEIPT_URL_EXPIRATION_SECONDS))
+        return Response(
+            content=pdf_content,
+            media_type="application/pdf",
+            headers={"Content-Disposition": f"attachment; filename=bill-{bill_id}.pdf"}
+        )
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.exception("Error generating bill PDF")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/receipts/render")
+def render_receipts_bulk(data: dict):
+    """
+    Renders receipts for many bills at once across the receipt worker pool.
+    Expects: { "kind": "clinic" | "pharmacy", "bill_ids": [1, 2, ...] }
+    """
+    kind = data.get("kind", "clinic")
+    if kind not in ("clinic", "pharmacy"):
+        raise HTTPException(status_code=400, detail="kind must be 'clinic' or 'pharmacy'")
+    try:
+        bill_ids = [int(b) for b in data.get("bill_ids") or []]
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="bill_ids must be a list of integers")
+    if not bill_ids:
+        raise HTTPException(status_code=400, detail="No bill_ids provided")
+    if len(bill_ids) > RECEIPT_BULK_MAX:
+        raise HTTPException(status_code=400, detail=f"At most {RECEIPT_BULK_MAX} bills per request")
+
+    try:
+        bills = load_receipt_bills(kind, bill_ids)
+        pdfs = render_receipts(kind, bills)
+    except Exception as e:
+        logger.exception("Error rendering receipts")
+        raise HTTPException(status_code=500, detail=str(e))
+
+    return {
+        "receipts": [
+            {"bill_id": bill_id, "pdf_base64": base64.b64encode(pdfs[bill_id]).decode("utf-8")}
+            for bill_id in bill_ids if bill_id in pdfs
+        ],
+        "missing": [bill_id for bill_id in bill_ids if bill_id not in pdfs]
+    }
+
+@app.on_event("shutdown")
+def stop_receipt_pool():
+    shutdown_receipt_pool()
+
+
 @app.get("/api/pharmacy/patient/{patient_id}/bills", response_model=List[PharmacyBillResponse])
 def get_patient_pharmacy_bills(patient_id: int):
     """Retrieve all pharmacy bills for a patient"""
     try:
         with engine.begin() as conn:
-            # Get all bills for the patient
+            # Get all bills for the patient, then all their items in one query
             bills_query = text("""
-                SELECT id FROM pharmacy_bills 
+                SELECT id, patient_id, patient_name, patient_age, patient_gender, patient_phone,
+                       bill_date, payment_mode, payment_status, total_amount
+                FROM pharmacy_bills 
                 WHERE patient_id = :patient_id 
                 ORDER BY bill_date DESC
             """)
             
             bills_result = conn.execute(bills_query, {"patient_id": patient_id})
-            bill_ids = [row[0] for row in bills_result]
-            
-            # Get details for each bill
-            bills = []
-            for bill_id in bill_ids:
-                bill = get_pharmacy_bill(bill_id)
-                # Remove pdf_base64 to reduce response size
-                bill.pop("pdf_base64", None)
-                bills.append(bill)
+            bills = [dict(row._mapping) for row in bills_result]
             
-            return bills
+            return attach_bill_items(conn, bills, PHARMACY_BILL_ITEMS_SQL)
             
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -4920,27 +6900,20 @@ def get_pharmacy_bills_by_status(status: str, limit: int = 50):
     """Retrieve pharmacy bills by payment status"""
     try:
         with engine.begin() as conn:
-            # Get bills by status
+            # Get bills by status, then all their items in one query
             bills_query = text("""
-                SELECT id FROM pharmacy_bills 
+                SELECT id, patient_id, patient_name, patient_age, patient_gender, patient_phone,
+                       bill_date, payment_mode, payment_status, total_amount
+                FROM pharmacy_bills 
                 WHERE payment_status = :status
                 ORDER BY bill_date DESC
                 LIMIT :limit
             """)
             
             bills_result = conn.execute(bills_query, {"status": status, "limit": limit})
-            bill_ids = [row[0] for row in bills_result]
-            
-            # Get details for each bill
-            bills = []
-            for bill_id in bill_ids:
-                bill = get_pharmacy_bill(bill_id)
-                # Remove pdf_base64 to reduce response size
-                if "pdf_base64" in bill:
-                    bill.pop("pdf_base64")
-                bills.append(bill)
+            bills = [dict(row._mapping) for row in bills_result]
             
-            return bills
+            return attach_bill_items(conn, bills, PHARMACY_BILL_ITEMS_SQL)
             
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
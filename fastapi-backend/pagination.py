@@ -0,0 +1,24 @@
+"""
+Opaque keyset-pagination cursors.
+
+A cursor encodes the (score, id) of the last row on a page; the next page
+continues with rows ordered strictly after it.
+"""
+import base64
+from decimal import Decimal
+from typing import Tuple
+
+
+def encode_cursor(score, row_id: int) -> str:
+    raw = f"{score}:{row_id}".encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> Tuple[Decimal, int]:
+    """Raises ValueError for anything encode_cursor did not produce."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")
+        score, row_id = raw.split(":")
+        return Decimal(score), int(row_id)
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {cursor!r}") from e
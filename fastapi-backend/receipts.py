@@ -0,0 +1,358 @@
+"""
+Receipt PDF rendering for clinic and pharmacy bills.
+
+The stylesheet and HTML templates are compiled once per process, and the
+WeasyPrint layout runs in a dedicated process pool so it does not hold up
+the API workers. This module is imported by the pool's worker processes, so
+it must stay free of app, database and S3 setup.
+
+The pool uses the spawn start method, which also re-imports the parent's
+__main__ module in every worker. Under `uvicorn main:app` that is uvicorn's
+own entry point, so workers load little beyond this module. When the API is
+started with `python main.py`, each worker re-imports main.py as
+__mp_main__ and repeats its module-level setup: the app object, the
+SQLAlchemy engine (no connections are opened) and the S3 and OpenAI
+clients. Startup hooks do not run there, so this is a one-off import cost
+per worker rather than a second API instance.
+"""
+import os
+import html
+import base64
+import hashlib
+import json
+import datetime
+import threading
+import multiprocessing
+from string import Template
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, List, Optional
+
+# Bump when the templates or stylesheet change so stored receipts are re-rendered
+RECEIPT_TEMPLATE_VERSION = "1"
+
+RECEIPT_RENDER_WORKERS = int(os.getenv("RECEIPT_RENDER_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+RECEIPT_CSS = """
+    @page {
+        size: A4;
+        margin: 1cm;
+    }
+    body {
+        font-family: Arial, sans-serif;
+        margin: 0;
+        padding: 20px;
+        color: #333;
+    }
+    .receipt {
+        max-width: 800px;
+        margin: 0 auto;
+        border: 1px solid #ddd;
+        padding: 20px;
+        box-shadow: 0 0 10px rgba(0,0,0,0.1);
+    }
+    .header {
+        text-align: center;
+        border-bottom: 2px solid #333;
+        padding-bottom: 10px;
+        margin-bottom: 20px;
+    }
+    .clinic-name, .pharmacy-name {
+        font-size: 24px;
+        font-weight: bold;
+        margin-bottom: 5px;
+    }
+    .clinic-contact, .pharmacy-contact {
+        font-size: 14px;
+        color: #666;
+    }
+    .bill-info {
+        display: flex;
+        justify-content: space-between;
+        margin-bottom: 20px;
+    }
+    .patient-info, .bill-details {
+        flex: 1;
+    }
+    .info-title {
+        font-weight: bold;
+        margin-bottom: 5px;
+    }
+    .info-item {
+        margin-bottom: 3px;
+    }
+    table {
+        width: 100%;
+        border-collapse: collapse;
+        margin-bottom: 20px;
+    }
+    th, td {
+        border: 1px solid #ddd;
+        padding: 8px;
+        text-align: left;
+    }
+    th {
+        background-color: #f2f2f2;
+    }
+    .summary {
+        margin-top: 20px;
+        text-align: right;
+    }
+    .total {
+        font-weight: bold;
+        font-size: 18px;
+        margin-top: 10px;
+    }
+    .footer {
+        margin-top: 30px;
+        text-align: center;
+        font-size: 14px;
+        color: #666;
+        border-top: 1px solid #ddd;
+        padding-top: 10px;
+    }
+"""
+
+RECEIPT_PAGE = Template("""<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="UTF-8">
+    <title>${title}</title>
+</head>
+<body>
+    <div class="receipt">
+        <div class="header">
+            <div class="${brand_class}-name">${brand_name}</div>
+            <div class="${brand_class}-contact">${brand_contact}</div>
+        </div>
+        <div class="bill-info">
+            <div class="patient-info">
+                <div class="info-title">Patient Information</div>
+                <div class="info-item">Name: ${patient_name}</div>
+                <div class="info-item">Age/Gender: ${patient_age}/${patient_gender}</div>
+                <div class="info-item">Contact: ${patient_phone}</div>
+            </div>
+            <div class="bill-details">
+                <div class="info-title">Bill Details</div>
+                ${bill_details}
+            </div>
+        </div>
+        <table>
+            <thead>
+                <tr>${header_cells}</tr>
+            </thead>
+            <tbody>
+                ${rows}
+            </tbody>
+        </table>
+        <div class="summary">
+            <div class="total">Total Amount: ₹${total_amount}</div>
+        </div>
+        <div class="footer">
+            <p>Thank you for choosing ${brand_name}. Get well soon!</p>
+            <p>This is a computer-generated receipt and does not require a signature.</p>
+        </div>
+    </div>
+</body>
+</html>
+""")
+
+DETAIL_ITEM = Template('<div class="info-item">${label}: ${value}</div>')
+CELL = Template("<td>${value}</td>")
+HEADER_CELL = Template("<th>${value}</th>")
+
+CLINIC_COLUMNS = ["Service", "Doctor", "Date &amp; Time", "Duration", "Price (₹)", "Discount", "Amount (₹)"]
+PHARMACY_COLUMNS = ["Medicine", "Quantity", "Price (₹)", "Discount", "Amount (₹)"]
+
+CLINIC_HEADER_CELLS = "".join(HEADER_CELL.substitute(value=c) for c in CLINIC_COLUMNS)
+PHARMACY_HEADER_CELLS = "".join(HEADER_CELL.substitute(value=c) for c in PHARMACY_COLUMNS)
+
+def _esc(value) -> str:
+    return html.escape("" if value is None else str(value))
+
+def _row(values) -> str:
+    return "<tr>" + "".join(CELL.substitute(value=_esc(v)) for v in values) + "</tr>"
+
+def _details(pairs) -> str:
+    return "".join(DETAIL_ITEM.substitute(label=label, value=_esc(value)) for label, value in pairs)
+
+def render_clinic_receipt_html(bill: dict) -> str:
+    """
+    bill: id, patient_name, patient_age, patient_gender, patient_phone,
+    bill_date, payment_mode, payment_status, total_amount and items with
+    service, doctor, appointment_date, appointment_time, duration, price, discount.
+    """
+    rows = []
+    for item in bill["items"]:
+        price, discount = float(item["price"]), float(item["discount"])
+        discount_amount = (price * discount) / 100
+        net_amount = price - discount_amount
+        rows.append(_row([
+            item["service"],
+            item["doctor"],
+            f"{item['appointment_date']} at {item['appointment_time']}",
+            f"{item['duration']} min",
+            f"{price:.2f}",
+            f"{item['discount']}% ({discount_amount:.2f})",
+            f"{net_amount:.2f}",
+        ]))
+    return RECEIPT_PAGE.substitute(
+        title="Bill Receipt",
+        brand_class="clinic",
+        brand_name="Health Plus Clinic",
+        brand_contact="123 Medical Avenue, City | Phone: +91 1234567890 | Email: info@healthplus.com",
+        patient_name=_esc(bill["patient_name"]),
+        patient_age=_esc(bill["patient_age"]),
+        patient_gender=_esc(bill["patient_gender"]),
+        patient_phone=_esc(bill["patient_phone"]),
+        bill_details=_details([
+            ("Bill #", bill["id"]),
+            ("Date", bill["bill_date"].strftime('%d-%m-%Y')),
+            ("Payment Mode", bill["payment_mode"].title()),
+            ("Status", bill["payment_status"].title()),
+        ]),
+        header_cells=CLINIC_HEADER_CELLS,
+        rows="".join(rows),
+        total_amount=f"{float(bill['total_amount']):.2f}",
+    )
+
+def render_pharmacy_receipt_html(bill: dict) -> str:
+    """
+    bill: same header fields as the clinic receipt, items with medicine_name,
+    quantity, price_per_unit, discount_percentage and item_total.
+    """
+    rows = []
+    for item in bill["items"]:
+        price, discount = float(item["price_per_unit"]), float(item["discount_percentage"])
+        discount_amount = (item["quantity"] * price * discount) / 100
+        rows.append(_row([
+            item["medicine_name"],
+            item["quantity"],
+            f"{price:.2f}",
+            f"{item['discount_percentage']}% ({discount_amount:.2f})",
+            f"{float(item['item_total']):.2f}",
+        ]))
+    return RECEIPT_PAGE.substitute(
+        title="Pharmacy Bill Receipt",
+        brand_class="pharmacy",
+        brand_name="Health Plus Pharmacy",
+        brand_contact="123 Medical Avenue, City | Phone: +91 1234567890 | Email: pharmacy@healthplus.com",
+        patient_name=_esc(bill["patient_name"]),
+        patient_age=_esc(bill["patient_age"] or "N/A"),
+        patient_gender=_esc(bill["patient_gender"] or "N/A"),
+        patient_phone=_esc(bill["patient_phone"]),
+        bill_details=_details([
+            ("Bill #", bill["id"]),
+            ("Date", bill["bill_date"].strftime('%d-%m-%Y')),
+            ("Time", bill["bill_date"].strftime('%H:%M')),
+            ("Payment Mode", bill["payment_mode"].title()),
+            ("Status", bill["payment_status"].title()),
+        ]),
+        header_cells=PHARMACY_HEADER_CELLS,
+        rows="".join(rows),
+        total_amount=f"{float(bill['total_amount']):.2f}",
+    )
+
+HEADER_FIELDS = (
+    "id", "patient_name", "patient_age", "patient_gender", "patient_phone",
+    "bill_date", "payment_mode", "payment_status", "total_amount",
+)
+ITEM_FIELDS = {
+    "clinic": ("service", "doctor", "appointment_date", "appointment_time", "duration", "price", "discount"),
+    "pharmacy": ("medicine_name", "quantity", "price_per_unit", "discount_percentage", "item_total"),
+}
+
+def _canonical(value):
+    if isinstance(value, bool) or value is None:
+        return value
+    if isinstance(value, (int, float)) or type(value).__name__ == "Decimal":
+        return f"{float(value):.4f}"
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    return str(value)
+
+def receipt_content_version(kind: str, bill: dict) -> str:
+    """
+    Fingerprint of everything that appears on the receipt. It changes only
+    when the printed content (or RECEIPT_TEMPLATE_VERSION) changes.
+    """
+    content = {
+        "template": RECEIPT_TEMPLATE_VERSION,
+        "kind": kind,
+        "header": [_canonical(bill.get(f)) for f in HEADER_FIELDS],
+        "items": [[_canonical(item.get(f)) for f in ITEM_FIELDS[kind]] for item in bill["items"]],
+    }
+    digest = hashlib.sha256(json.dumps(content, sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+RECEIPT_RENDERERS = {
+    "clinic": render_clinic_receipt_html,
+    "pharmacy": render_pharmacy_receipt_html,
+}
+
+# Per-process WeasyPrint state: the stylesheet is parsed once and reused
+_stylesheet = None
+_font_config = None
+
+def _init_renderer():
+    global _stylesheet, _font_config
+    if _stylesheet is None:
+        from weasyprint import CSS
+        try:
+            from weasyprint.text.fonts import FontConfiguration
+        except ImportError:  # WeasyPrint < 53
+            from weasyprint.fonts import FontConfiguration
+        _font_config = FontConfiguration()
+        _stylesheet = CSS(string=RECEIPT_CSS, font_config=_font_config)
+
+def render_receipt_pdf(kind: str, bill: dict) -> bytes:
+    """Renders one receipt to PDF bytes. Runs inside the pool workers."""
+    from weasyprint import HTML
+    _init_renderer()
+    document = RECEIPT_RENDERERS[kind](bill)
+    return HTML(string=document).write_pdf(stylesheets=[_stylesheet], font_config=_font_config)
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+def get_receipt_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn: workers start clean instead of inheriting the API process's
+            # threads and connections (see the module docstring for what they import)
+            _pool = ProcessPoolExecutor(
+                max_workers=RECEIPT_RENDER_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_renderer,
+            )
+        return _pool
+
+def shutdown_receipt_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+def render_receipt(kind: str, bill: dict) -> bytes:
+    """Renders a receipt in the pool, blocking the calling thread until done."""
+    try:
+        return get_receipt_pool().submit(render_receipt_pdf, kind, bill).result()
+    except BrokenProcessPool:
+        # A worker died (e.g. OOM); start a fresh pool and retry once
+        shutdown_receipt_pool()
+        return get_receipt_pool().submit(render_receipt_pdf, kind, bill).result()
+
+def render_receipt_base64(kind: str, bill: dict) -> str:
+    return base64.b64encode(render_receipt(kind, bill)).decode("utf-8")
+
+def render_receipts(kind: str, bills: List[dict]) -> Dict[int, bytes]:
+    """Renders many receipts in parallel across the pool, keyed by bill id."""
+    pool = get_receipt_pool()
+    futures = {bill["id"]: pool.submit(render_receipt_pdf, kind, bill) for bill in bills}
+    try:
+        return {bill_id: future.result() for bill_id, future in futures.items()}
+    except BrokenProcessPool:
+        shutdown_receipt_pool()
+        raise
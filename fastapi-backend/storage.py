@@ -0,0 +1,399 @@
+"""
+Object storage backends for uploaded documents and generated PDFs.
+
+S3StorageBackend is the production store. LocalStorageBackend keeps objects
+on the local filesystem (read through mmap) and hands out signed URLs that
+point back at this API, so the upload and advice paths can run on a single
+box without AWS. CachedStorageBackend puts a local backend in front of S3 as
+an on-node cache for hot documents.
+
+Object keys are flat names (no "/"); URLs map back to keys through their
+last path segment. All backends expose the same methods and raise on
+missing objects or transport errors; callers decide how to log them.
+"""
+import os
+import hmac
+import json
+import contextlib
+import mmap
+import time
+import hashlib
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Iterable, Iterator, Optional, Tuple
+from urllib.parse import quote, unquote
+
+logger = logging.getLogger(__name__)
+
+# Inclusive (start, end) byte positions; end=None reads to the end of the object
+ByteRange = Optional[Tuple[int, Optional[int]]]
+
+def resolve_range(byte_range: ByteRange, size: int) -> Tuple[int, int]:
+    """Turns an inclusive byte range into a [start, stop) slice clamped to size."""
+    if not byte_range:
+        return 0, size
+    start, end = byte_range
+    stop = size if end is None else min(end + 1, size)
+    return min(start, size), stop
+
+
+class S3StorageBackend:
+    def __init__(self, client, bucket: str, region: str, transfer_config=None):
+        self.client = client
+        self.bucket = bucket
+        self.region = region
+        self.transfer_config = transfer_config
+
+    def url_for(self, key: str) -> str:
+        return f"https://{self.bucket}.s3.{self.region}.amazonaws.com/{key}"
+
+    def key_from_url(self, url: str) -> Optional[str]:
+        if not url or "amazonaws.com" not in url:
+            return None
+        return url.split("/")[-1]
+
+    def put_bytes(self, key: str, data: bytes, content_type: str) -> dict:
+        response = self.client.put_object(
+            Bucket=self.bucket,
+            Key=key,
+            Body=data,
+            ContentType=content_type,
+            ACL='private'
+        )
+        return {"etag": response.get("ETag", "").strip('"'), "size": len(data)}
+
+    def put_fileobj(self, key: str, fileobj, content_type: str, metadata: Optional[dict] = None) -> dict:
+        extra_args = {"ContentType": content_type, "ACL": "private"}
+        if metadata:
+            extra_args["Metadata"] = metadata
+        self.client.upload_fileobj(fileobj, self.bucket, key, ExtraArgs=extra_args, Config=self.transfer_config)
+        # upload_fileobj does not return the ETag (multipart ETags differ from an MD5)
+        return self.head(key)
+
+    def head(self, key: str) -> dict:
+        head = self.client.head_object(Bucket=self.bucket, Key=key)
+        return {
+            "etag": head.get("ETag", "").strip('"'),
+            "size": head.get("ContentLength", 0),
+            "content_type": head.get("ContentType", "application/octet-stream"),
+        }
+
+    def get_bytes(self, key: str) -> bytes:
+        return self.client.get_object(Bucket=self.bucket, Key=key)["Body"].read()
+
+    def iter_chunks(self, key: str, chunk_size: int, byte_range: ByteRange = None) -> Iterator[bytes]:
+        params = {"Bucket": self.bucket, "Key": key}
+        if byte_range:
+            start, end = byte_range
+            params["Range"] = f"bytes={start}-{'' if end is None else end}"
+        body = self.client.get_object(**params)["Body"]
+        try:
+            for chunk in body.iter_chunks(chunk_size):
+                yield chunk
+        finally:
+            body.close()
+
+    def delete(self, key: str):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+    def presign(self, key: str, expiration: int) -> str:
+        return self.client.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': self.bucket, 'Key': key},
+            ExpiresIn=expiration
+        )
+
+
+class LocalStorageBackend:
+    """
+    Stores each object as a file under root, with its ETag, size and content
+    type in a JSON sidecar under root/.meta. URLs point at base_url's
+    /api/storage/{key} route and are signed with an HMAC of key and expiry.
+    """
+
+    def __init__(self, root: str, base_url: str, signing_secret: str):
+        self.root = os.path.abspath(root)
+        self.meta_root = os.path.join(self.root, ".meta")
+        self.base_url = base_url.rstrip("/")
+        self.signing_secret = signing_secret.encode("utf-8")
+        os.makedirs(self.meta_root, exist_ok=True)
+
+    def path_for(self, key: str) -> str:
+        if not key or "/" in key or "\\" in key or key.startswith("."):
+            raise ValueError(f"Invalid object key: {key!r}")
+        return os.path.join(self.root, key)
+
+    def _meta_path(self, key: str) -> str:
+        return os.path.join(self.meta_root, f"{key}.json")
+
+    def url_for(self, key: str) -> str:
+        return f"{self.base_url}/api/storage/{quote(key)}"
+
+    def key_from_url(self, url: str) -> Optional[str]:
+        prefix = f"{self.base_url}/api/storage/"
+        if not url or not url.startswith(prefix):
+            return None
+        return unquote(url[len(prefix):].split("?")[0])
+
+    def _signature(self, key: str, expires: int) -> str:
+        return hmac.new(self.signing_secret, f"{key}:{expires}".encode("utf-8"), hashlib.sha256).hexdigest()
+
+    def presign(self, key: str, expiration: int) -> str:
+        expires = int(time.time()) + expiration
+        return f"{self.url_for(key)}?expires={expires}&signature={self._signature(key, expires)}"
+
+    def verify(self, key: str, expires: int, signature: str) -> bool:
+        if expires < time.time():
+            return False
+        return hmac.compare_digest(self._signature(key, expires), signature or "")
+
+    def exists(self, key: str) -> bool:
+        return os.path.isfile(self.path_for(key))
+
+    def put_chunks(self, key: str, chunks: Iterable[bytes], content_type: str,
+                   metadata: Optional[dict] = None, etag: Optional[str] = None) -> dict:
+        """
+        Writes the chunks and the sidecar to temp files and renames them into
+        place (data first), so readers never see a partial object and the
+        sidecar never describes bytes that are not there yet. etag overrides
+        the computed MD5 (used when mirroring an S3 object).
+        """
+        path = self.path_for(key)
+        md5 = hashlib.md5()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix=".tmp-")
+        tmp_meta_path = None
+        try:
+            with os.fdopen(fd, "wb") as out:
+                for chunk in chunks:
+                    out.write(chunk)
+                    md5.update(chunk)
+                    size += len(chunk)
+            info = {
+                "etag": etag or md5.hexdigest(),
+                "size": size,
+                "content_type": content_type,
+                "metadata": metadata or {},
+            }
+            meta_fd, tmp_meta_path = tempfile.mkstemp(dir=self.meta_root, prefix=".tmp-")
+            with os.fdopen(meta_fd, "w") as meta:
+                json.dump(info, meta)
+            # Drop the old sidecar first: in between, head() fingerprints the new bytes itself
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self._meta_path(key))
+            os.replace(tmp_path, path)
+            os.replace(tmp_meta_path, self._meta_path(key))
+        except BaseException:
+            for leftover in (tmp_path, tmp_meta_path):
+                if leftover:
+                    with contextlib.suppress(OSError):
+                        os.remove(leftover)
+            raise
+        return {"etag": info["etag"], "size": size}
+
+    def put_bytes(self, key: str, data: bytes, content_type: str, etag: Optional[str] = None) -> dict:
+        return self.put_chunks(key, [data], content_type, etag=etag)
+
+    def put_fileobj(self, key: str, fileobj, content_type: str,
+                    metadata: Optional[dict] = None, etag: Optional[str] = None) -> dict:
+        chunks = iter(lambda: fileobj.read(1024 * 1024), b"")
+        return self.put_chunks(key, chunks, content_type, metadata, etag)
+
+    def head(self, key: str) -> dict:
+        path = self.path_for(key)
+        try:
+            with open(self._meta_path(key)) as meta:
+                info = json.load(meta)
+        except (FileNotFoundError, ValueError):
+            # Object copied in by hand: fingerprint it on the fly
+            md5 = hashlib.md5()
+            for chunk in self.iter_chunks(key, 1024 * 1024):
+                md5.update(chunk)
+            info = {"etag": md5.hexdigest(), "content_type": "application/octet-stream"}
+        info["size"] = os.path.getsize(path)
+        return info
+
+    def get_bytes(self, key: str) -> bytes:
+        with open(self.path_for(key), "rb") as f:
+            return f.read()
+
+    def iter_chunks(self, key: str, chunk_size: int, byte_range: ByteRange = None) -> Iterator[bytes]:
+        with open(self.path_for(key), "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return
+            # mmap lets concurrent readers share the page cache instead of buffering copies
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                start, stop = resolve_range(byte_range, size)
+                for offset in range(start, stop, chunk_size):
+                    yield mapped[offset:min(offset + chunk_size, stop)]
+
+    def touch(self, key: str):
+        os.utime(self.path_for(key))
+
+    def delete(self, key: str):
+        path = self.path_for(key)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self._meta_path(key))
+
+    def trim(self, max_total_bytes: int):
+        """Deletes least recently used objects until the total size fits."""
+        entries = []
+        total = 0
+        with os.scandir(self.root) as it:
+            for entry in it:
+                if entry.name.startswith(".") or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.name))
+                total += stat.st_size
+        if total <= max_total_bytes:
+            return
+        for _, size, key in sorted(entries):
+            with contextlib.suppress(OSError):
+                os.remove(self.path_for(key))
+            with contextlib.suppress(OSError):
+                os.remove(self._meta_path(key))
+            total -= size
+            if total <= max_total_bytes:
+                break
+
+
+class CachedStorageBackend:
+    """
+    Reads go to the local cache first and fill it from the primary on a miss;
+    writes go to the primary and are mirrored into the cache. URLs, signing
+    and ETags always come from the primary. Objects larger than
+    max_object_bytes bypass the cache, and any cache I/O error falls back to
+    the primary.
+    """
+
+    def __init__(self, primary, cache: LocalStorageBackend, max_object_bytes: int, max_total_bytes: int):
+        self.primary = primary
+        self.cache = cache
+        self.max_object_bytes = max_object_bytes
+        self.max_total_bytes = max_total_bytes
+        self._trim_lock = threading.Lock()
+
+    def url_for(self, key: str) -> str:
+        return self.primary.url_for(key)
+
+    def key_from_url(self, url: str) -> Optional[str]:
+        return self.primary.key_from_url(url)
+
+    def presign(self, key: str, expiration: int) -> str:
+        return self.primary.presign(key, expiration)
+
+    def _trim(self):
+        if self._trim_lock.acquire(blocking=False):
+            try:
+                self.cache.trim(self.max_total_bytes)
+            finally:
+                self._trim_lock.release()
+
+    def _cached(self, key: str) -> bool:
+        try:
+            if self.cache.exists(key):
+                self.cache.touch(key)
+                return True
+        except (OSError, ValueError) as e:
+            logger.warning(f"Storage cache lookup failed for {key}: {e}")
+        return False
+
+    def _fill(self, key: str, chunk_size: int) -> bool:
+        """Copies an object from the primary into the cache. False if it is too big or the copy failed."""
+        info = self.primary.head(key)
+        if info["size"] > self.max_object_bytes:
+            return False
+        try:
+            self.cache.put_chunks(key, self.primary.iter_chunks(key, chunk_size), info["content_type"], etag=info["etag"])
+        except (OSError, ValueError) as e:
+            logger.warning(f"Storage cache fill failed for {key}: {e}")
+            return False
+        self._trim()
+        return True
+
+    def put_bytes(self, key: str, data: bytes, content_type: str) -> dict:
+        info = self.primary.put_bytes(key, data, content_type)
+        if len(data) <= self.max_object_bytes:
+            try:
+                self.cache.put_bytes(key, data, content_type, etag=info["etag"])
+                self._trim()
+            except (OSError, ValueError) as e:
+                logger.warning(f"Storage cache write failed for {key}: {e}")
+        return info
+
+    def put_fileobj(self, key: str, fileobj, content_type: str, metadata: Optional[dict] = None) -> dict:
+        info = self.primary.put_fileobj(key, fileobj, content_type, metadata)
+        if info["size"] <= self.max_object_bytes:
+            try:
+                fileobj.seek(0)
+                self.cache.put_fileobj(key, fileobj, content_type, metadata, etag=info["etag"])
+                self._trim()
+            except (OSError, ValueError) as e:
+                logger.warning(f"Storage cache write failed for {key}: {e}")
+        return info
+
+    def delete(self, key: str):
+        self.primary.delete(key)
+        try:
+            self.cache.delete(key)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Storage cache delete failed for {key}: {e}")
+
+    def head(self, key: str) -> dict:
+        if self._cached(key):
+            return self.cache.head(key)
+        return self.primary.head(key)
+
+    def get_bytes(self, key: str) -> bytes:
+        if self._cached(key) or self._fill(key, 1024 * 1024):
+            return self.cache.get_bytes(key)
+        return self.primary.get_bytes(key)
+
+    def iter_chunks(self, key: str, chunk_size: int, byte_range: ByteRange = None) -> Iterator[bytes]:
+        if self._cached(key) or self._fill(key, chunk_size):
+            return self.cache.iter_chunks(key, chunk_size, byte_range)
+        return self.primary.iter_chunks(key, chunk_size, byte_range)
+
+
+class PresignedUrlCache:
+    """
+    Per-process LRU of presigned GET URLs keyed by object key and requested
+    expiration, so a caller asking for a long window never gets a URL signed
+    for a shorter one. A signed URL stays valid for its whole window, so it
+    is handed out again until it gets close to expiring.
+    """
+
+    def __init__(self, max_entries: int, min_remaining_seconds: int):
+        self.max_entries = max_entries
+        self.min_remaining_seconds = min_remaining_seconds
+        self._lock = threading.Lock()
+        self._urls: "OrderedDict[tuple, tuple]" = OrderedDict()  # (key, expiration) -> (expires_at, url)
+
+    def get(self, object_key: str, expiration: int) -> Optional[str]:
+        # Short-lived requests must not get a URL that outlives half their own window
+        required = min(self.min_remaining_seconds, expiration // 2)
+        cache_key = (object_key, expiration)
+        with self._lock:
+            entry = self._urls.get(cache_key)
+            if entry is None:
+                return None
+            expires_at, url = entry
+            if expires_at - time.monotonic() < required:
+                del self._urls[cache_key]
+                return None
+            self._urls.move_to_end(cache_key)
+            return url
+
+    def put(self, object_key: str, url: str, expiration: int):
+        cache_key = (object_key, expiration)
+        with self._lock:
+            self._urls[cache_key] = (time.monotonic() + expiration, url)
+            self._urls.move_to_end(cache_key)
+            while len(self._urls) > self.max_entries:
+                self._urls.popitem(last=False)
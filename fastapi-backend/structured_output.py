@@ -0,0 +1,210 @@
+"""
+JSON schemas and helpers for model calls that must return structured data.
+
+The schemas are written for strict structured outputs (every property
+required, no additional properties), so the same schema can be sent to the
+provider and used locally to coerce whatever comes back into the exact
+shape the endpoints return. parse_json_output repairs near-valid JSON
+(code fences, surrounding prose, trailing commas, Python-style literals,
+truncation) so a malformed reply does not cost a second call.
+"""
+import ast
+import json
+import re
+from typing import Any, Tuple
+
+
+class StructuredOutputError(ValueError):
+    pass
+
+
+def _string():
+    return {"type": "string"}
+
+
+def _strings():
+    return {"type": "array", "items": {"type": "string"}}
+
+
+def _object(properties: dict) -> dict:
+    return {
+        "type": "object",
+        "properties": properties,
+        "required": list(properties),
+        "additionalProperties": False,
+    }
+
+
+PRESCRIPTION_SCHEMA = _object({
+    "diagnosis": _string(),
+    "drugs": {
+        "type": "array",
+        "items": _object({
+            "name": _string(),
+            "strength": _string(),
+            "frequency": _string(),
+            "duration": _string(),
+        }),
+    },
+    "instructions": _string(),
+    "tests": _strings(),
+    "follow_up": _string(),
+})
+
+VOICE_HISTORY_SCHEMA = _object({
+    "complaints": _strings(),
+    "past_history": _strings(),
+    "personal_history": _strings(),
+    "family_history": _strings(),
+    "allergies": _strings(),
+    "medication_history": _strings(),
+    "surgical_history": _strings(),
+    "hpi": _string(),
+    "vitals": _object({
+        "bp": _string(),
+        "pulse": _string(),
+        "temperature": _string(),
+        "spo2": _string(),
+        "height": _string(),
+        "weight": _string(),
+    }),
+})
+
+VOICE_PRESCRIPTION_SCHEMA = _object({
+    "patient_name": _string(),
+    "patient_age": _string(),
+    "patient_gender": _string(),
+    "patient_contact": _string(),
+    "complaints": _strings(),
+    "diagnosis": _string(),
+    "tests": _strings(),
+    "follow_up": _string(),
+    "vitals": _object({
+        "temperature": _string(),
+        "bp": _string(),
+        "pulse": _string(),
+        "bmi": _string(),
+    }),
+    "medicines": {
+        "type": "array",
+        "items": _object({
+            "medicine": _string(),
+            "dosage": _string(),
+            "unit": _string(),
+            "when": _string(),
+            "duration": _string(),
+            "notes": _string(),
+        }),
+    },
+})
+
+
+def empty_from_schema(schema: dict) -> Any:
+    """The empty value of a schema: "" for strings, [] for arrays, objects of empty values."""
+    kind = schema.get("type")
+    if kind == "object":
+        return {key: empty_from_schema(sub) for key, sub in schema["properties"].items()}
+    if kind == "array":
+        return []
+    return ""
+
+
+def coerce_to_schema(value: Any, schema: dict) -> Any:
+    """
+    Forces a parsed value into the schema's shape: unknown keys are dropped,
+    missing ones get empty values, scalars become strings, and a lone item
+    where a list is expected becomes a one-item list. A bare string in a list
+    of objects (e.g. "Amoxicillin 500mg TID" as a drug) fills the item's
+    first property.
+    """
+    kind = schema.get("type")
+    if kind == "object":
+        value = value if isinstance(value, dict) else {}
+        return {key: coerce_to_schema(value.get(key), sub) for key, sub in schema["properties"].items()}
+    if kind == "array":
+        if value is None or value == "":
+            return []
+        items = value if isinstance(value, list) else [value]
+        item_schema = schema["items"]
+        if item_schema.get("type") == "object":
+            first_key = next(iter(item_schema["properties"]))
+            items = [{first_key: item.strip()} if isinstance(item, str) and item.strip() else item for item in items]
+        return [coerce_to_schema(item, item_schema) for item in items if item is not None]
+    if value is None:
+        return ""
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return str(value)
+
+
+FENCE_RE = re.compile(r"```(?:json|JSON)?\s*(.*?)```", re.DOTALL)
+TRAILING_COMMA_RE = re.compile(r",\s*([}\]])")
+SMART_QUOTES = str.maketrans({"“": '"', "”": '"', "‘": "'", "’": "'"})
+
+
+def _close_truncated(text: str) -> str:
+    """Closes an unterminated string and any open brackets, e.g. after hitting max_tokens."""
+    stack = []
+    in_string = False
+    escaped = False
+    for char in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in "{[":
+            stack.append("}" if char == "{" else "]")
+        elif char in "}]" and stack:
+            stack.pop()
+    if in_string:
+        text += '"'
+    text = re.sub(r"[,:]\s*$", "", text.rstrip())
+    return text + "".join(reversed(stack))
+
+
+def parse_json_output(text: str) -> Tuple[dict, bool]:
+    """
+    Parses a model reply into a JSON object. Returns (data, repaired) where
+    repaired says whether any fix-up was needed. Raises StructuredOutputError
+    when nothing usable can be recovered.
+    """
+    if not text or not text.strip():
+        raise StructuredOutputError("Empty model output")
+    try:
+        data = json.loads(text)
+        if isinstance(data, dict):
+            return data, False
+    except ValueError:
+        pass
+
+    candidate = text.translate(SMART_QUOTES)
+    fenced = FENCE_RE.search(candidate)
+    if fenced:
+        candidate = fenced.group(1)
+    start = candidate.find("{")
+    if start == -1:
+        raise StructuredOutputError("No JSON object in model output")
+    end = candidate.rfind("}")
+    attempts = []
+    if end > start:
+        attempts.append(candidate[start:end + 1])
+    attempts.append(_close_truncated(candidate[start:]))
+
+    for attempt in attempts:
+        attempt = TRAILING_COMMA_RE.sub(r"\1", attempt)
+        try:
+            data = json.loads(attempt)
+        except ValueError:
+            try:
+                # Python-style dicts: single quotes, True/False/None
+                data = ast.literal_eval(attempt)
+            except (ValueError, SyntaxError, MemoryError, RecursionError):
+                continue
+        if isinstance(data, dict):
+            return data, True
+    raise StructuredOutputError("Model output is not valid JSON")
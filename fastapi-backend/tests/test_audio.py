@@ -0,0 +1,55 @@
+import subprocess
+
+import pytest
+
+import audio
+from audio import detect_silences, plan_segments
+
+
+def fake_run(stderr):
+    def run(args):
+        return subprocess.CompletedProcess(args, 0, stdout="", stderr=stderr)
+    return run
+
+
+def test_short_recording_is_one_segment():
+    assert plan_segments(30.0, [(10.0, 11.0)], target_seconds=60, max_seconds=90) == [(0.0, 30.0)]
+
+
+def test_cuts_land_in_silence_closest_to_target():
+    silences = [(20.0, 21.0), (58.0, 60.0), (80.0, 81.0), (119.0, 121.0)]
+    assert plan_segments(150.0, silences, target_seconds=60, max_seconds=90) == [
+        (0.0, 59.0), (59.0, 120.0), (120.0, 150.0),
+    ]
+
+
+def test_hard_cut_at_max_without_silence():
+    assert plan_segments(200.0, [], target_seconds=60, max_seconds=90) == [
+        (0.0, 90.0), (90.0, 180.0), (180.0, 200.0),
+    ]
+
+
+def test_segments_never_exceed_max():
+    silences = [(5.0, 6.0), (140.0, 141.0)]
+    segments = plan_segments(300.0, silences, target_seconds=60, max_seconds=90)
+    assert segments[0][0] == 0.0 and segments[-1][1] == 300.0
+    assert all(end - start <= 90 for start, end in segments)
+    assert all(a[1] == b[0] for a, b in zip(segments, segments[1:]))
+
+
+def test_detect_silences_parses_ffmpeg_log(monkeypatch):
+    stderr = "\n".join([
+        "[silencedetect @ 0x1] silence_start: -0.01",
+        "[silencedetect @ 0x1] silence_end: 1.5 | silence_duration: 1.51",
+        "size=N/A time=00:00:10.00",
+        "[silencedetect @ 0x1] silence_start: 4.25",
+        "[silencedetect @ 0x1] silence_end: 5 | silence_duration: 0.75",
+        "[silencedetect @ 0x1] silence_start: 9.5",
+    ])
+    monkeypatch.setattr(audio, "_run", fake_run(stderr))
+    assert detect_silences("in.wav") == [(0.0, 1.5), (4.25, 5.0)]
+
+
+def test_run_reports_missing_binary():
+    with pytest.raises(audio.AudioToolMissingError):
+        audio._run(["/nonexistent/ffmpeg", "-version"])
@@ -0,0 +1,25 @@
+from decimal import Decimal
+
+import pytest
+
+from pagination import decode_cursor, encode_cursor
+
+
+def test_round_trip():
+    cursor = encode_cursor(Decimal("0.812500"), 42)
+    assert decode_cursor(cursor) == (Decimal("0.812500"), 42)
+
+
+def test_zero_score_round_trip():
+    assert decode_cursor(encode_cursor(Decimal("0"), 7)) == (Decimal("0"), 7)
+
+
+def test_cursor_is_url_safe():
+    cursor = encode_cursor(Decimal("0.999999"), 123456789)
+    assert all(c.isalnum() or c in "-_=" for c in cursor)
+
+
+@pytest.mark.parametrize("cursor", ["", "not-base64!", encode_cursor("abc", 1)[:-2], "MTIz"])
+def test_invalid_cursor(cursor):
+    with pytest.raises(ValueError):
+        decode_cursor(cursor)
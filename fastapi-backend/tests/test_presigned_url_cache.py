@@ -0,0 +1,55 @@
+import storage
+from storage import PresignedUrlCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_cache(monkeypatch, max_entries=10, min_remaining=900):
+    clock = Clock()
+    monkeypatch.setattr(storage.time, "monotonic", clock)
+    return PresignedUrlCache(max_entries, min_remaining), clock
+
+
+def test_hit_until_close_to_expiry(monkeypatch):
+    cache, clock = make_cache(monkeypatch)
+    cache.put("a.pdf", "url-a", 3600)
+    clock.now += 3600 - 900
+    assert cache.get("a.pdf", 3600) == "url-a"
+    clock.now += 1
+    assert cache.get("a.pdf", 3600) is None
+    assert cache.get("a.pdf", 3600) is None
+
+
+def test_short_windows_keep_half_their_expiration(monkeypatch):
+    cache, clock = make_cache(monkeypatch)
+    cache.put("a.pdf", "url-a", 60)
+    clock.now += 30
+    assert cache.get("a.pdf", 60) == "url-a"
+    clock.now += 1
+    assert cache.get("a.pdf", 60) is None
+
+
+def test_entries_are_per_expiration(monkeypatch):
+    cache, _ = make_cache(monkeypatch)
+    cache.put("a.pdf", "url-short", 60)
+    assert cache.get("a.pdf", 3600) is None
+    cache.put("a.pdf", "url-long", 3600)
+    assert cache.get("a.pdf", 60) == "url-short"
+    assert cache.get("a.pdf", 3600) == "url-long"
+
+
+def test_evicts_least_recently_used(monkeypatch):
+    cache, _ = make_cache(monkeypatch, max_entries=2)
+    cache.put("a", "url-a", 3600)
+    cache.put("b", "url-b", 3600)
+    assert cache.get("a", 3600) == "url-a"
+    cache.put("c", "url-c", 3600)
+    assert cache.get("b", 3600) is None
+    assert cache.get("a", 3600) == "url-a"
+    assert cache.get("c", 3600) == "url-c"
@@ -0,0 +1,100 @@
+import copy
+import datetime
+from decimal import Decimal
+
+import receipts
+from receipts import receipt_content_version, render_clinic_receipt_html, render_pharmacy_receipt_html
+
+
+def clinic_bill():
+    return {
+        "id": 7,
+        "patient_name": "Asha <b>Rao</b>",
+        "patient_age": 34,
+        "patient_gender": "Female",
+        "patient_phone": "9876543210",
+        "bill_date": datetime.date(2024, 3, 5),
+        "payment_mode": "cash",
+        "payment_status": "paid",
+        "total_amount": Decimal("900.00"),
+        "items": [{
+            "id": 70,
+            "service": "Consultation",
+            "doctor": "Dr. Mehta",
+            "appointment_date": datetime.date(2024, 3, 5),
+            "appointment_time": datetime.time(10, 30),
+            "duration": 15,
+            "price": Decimal("1000.00"),
+            "discount": Decimal("10"),
+        }],
+    }
+
+
+def pharmacy_bill():
+    return {
+        "id": 9,
+        "patient_name": "Ravi",
+        "patient_age": None,
+        "patient_gender": None,
+        "patient_phone": "12345",
+        "bill_date": datetime.datetime(2024, 3, 5, 14, 45),
+        "payment_mode": "upi",
+        "payment_status": "paid",
+        "total_amount": 90.0,
+        "items": [{
+            "medicine_name": "Paracetamol 500",
+            "quantity": 10,
+            "price_per_unit": 10.0,
+            "discount_percentage": 10.0,
+            "item_total": 90.0,
+        }],
+    }
+
+
+def test_content_version_is_stable():
+    assert receipt_content_version("clinic", clinic_bill()) == receipt_content_version("clinic", clinic_bill())
+
+
+def test_content_version_ignores_fields_not_printed():
+    bill = clinic_bill()
+    changed = copy.deepcopy(bill)
+    changed["items"][0]["id"] = 999
+    changed["patient_id"] = 123
+    assert receipt_content_version("clinic", bill) == receipt_content_version("clinic", changed)
+
+
+def test_content_version_treats_equal_numbers_alike():
+    bill = clinic_bill()
+    as_float = copy.deepcopy(bill)
+    as_float["total_amount"] = 900.0
+    as_float["items"][0]["price"] = 1000
+    assert receipt_content_version("clinic", bill) == receipt_content_version("clinic", as_float)
+
+
+def test_content_version_changes_with_printed_content():
+    bill = clinic_bill()
+    changed = copy.deepcopy(bill)
+    changed["items"][0]["discount"] = Decimal("20")
+    assert receipt_content_version("clinic", bill) != receipt_content_version("clinic", changed)
+    assert receipt_content_version("clinic", bill) != receipt_content_version("pharmacy", {**bill, "items": []})
+
+
+def test_content_version_changes_with_template_version(monkeypatch):
+    before = receipt_content_version("pharmacy", pharmacy_bill())
+    monkeypatch.setattr(receipts, "RECEIPT_TEMPLATE_VERSION", "test")
+    assert receipt_content_version("pharmacy", pharmacy_bill()) != before
+
+
+def test_clinic_receipt_html_escapes_and_totals():
+    page = render_clinic_receipt_html(clinic_bill())
+    assert "Asha &lt;b&gt;Rao&lt;/b&gt;" in page
+    assert "<td>900.00</td>" in page
+    assert "10% (100.00)" in page
+    assert "05-03-2024" in page
+
+
+def test_pharmacy_receipt_html_defaults_missing_details():
+    page = render_pharmacy_receipt_html(pharmacy_bill())
+    assert "N/A" in page
+    assert "14:45" in page
+    assert "<td>Paracetamol 500</td>" in page
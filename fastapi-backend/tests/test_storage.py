@@ -0,0 +1,113 @@
+import io
+import time
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from storage import CachedStorageBackend, LocalStorageBackend, resolve_range
+
+
+@pytest.fixture
+def local(tmp_path):
+    return LocalStorageBackend(str(tmp_path / "store"), "http://api.test/", "secret")
+
+
+@pytest.mark.parametrize("byte_range, expected", [
+    (None, (0, 10)),
+    ((2, 5), (2, 6)),
+    ((4, None), (4, 10)),
+    ((8, 50), (8, 10)),
+    ((20, 30), (10, 10)),
+])
+def test_resolve_range(byte_range, expected):
+    assert resolve_range(byte_range, 10) == expected
+
+
+def test_put_head_and_ranged_reads(local):
+    info = local.put_bytes("a.pdf", b"0123456789", "application/pdf")
+    assert info["size"] == 10
+    assert local.head("a.pdf") == {
+        "etag": info["etag"], "size": 10, "content_type": "application/pdf", "metadata": {},
+    }
+    assert b"".join(local.iter_chunks("a.pdf", 3)) == b"0123456789"
+    assert list(local.iter_chunks("a.pdf", 3, (2, 6))) == [b"234", b"56"]
+    assert list(local.iter_chunks("a.pdf", 3, (8, None))) == [b"89"]
+
+
+def test_put_fileobj_keeps_metadata(local):
+    local.put_fileobj("b.jpg", io.BytesIO(b"x" * 10), "image/jpeg", {"patient": "1"}, etag="abc")
+    assert local.head("b.jpg")["metadata"] == {"patient": "1"}
+    assert local.head("b.jpg")["etag"] == "abc"
+
+
+def test_head_fingerprints_objects_without_sidecar(local):
+    with open(local.path_for("c.txt"), "wb") as f:
+        f.write(b"hello")
+    info = local.head("c.txt")
+    assert info["size"] == 5
+    assert info["etag"] == "5d41402abc4b2a76b9719d911017c592"
+
+
+def test_delete_removes_object_and_sidecar(local):
+    local.put_bytes("a.pdf", b"data", "application/pdf")
+    local.delete("a.pdf")
+    assert not local.exists("a.pdf")
+    local.delete("a.pdf")
+    with pytest.raises(FileNotFoundError):
+        local.head("a.pdf")
+
+
+@pytest.mark.parametrize("key", ["", "../x", "a/b", ".meta"])
+def test_rejects_unsafe_keys(local, key):
+    with pytest.raises(ValueError):
+        local.path_for(key)
+
+
+def test_presign_round_trip(local):
+    url = local.presign("a b.pdf", 60)
+    parsed = urlparse(url)
+    query = parse_qs(parsed.query)
+    key = local.key_from_url(url)
+    assert key == "a b.pdf"
+    expires = int(query["expires"][0])
+    assert local.verify(key, expires, query["signature"][0])
+    assert not local.verify("other.pdf", expires, query["signature"][0])
+    assert not local.verify(key, int(time.time()) - 1, local._signature(key, int(time.time()) - 1))
+
+
+@pytest.fixture
+def cached(tmp_path):
+    primary = LocalStorageBackend(str(tmp_path / "primary"), "http://primary.test", "secret")
+    cache = LocalStorageBackend(str(tmp_path / "cache"), "http://cache.test", "other")
+    return CachedStorageBackend(primary, cache, max_object_bytes=8, max_total_bytes=16)
+
+
+def test_cache_fills_on_read_and_keeps_primary_etag(cached):
+    info = cached.primary.put_bytes("a", b"1234", "text/plain", etag="primary-etag")
+    assert not cached.cache.exists("a")
+    assert cached.get_bytes("a") == b"1234"
+    assert cached.cache.head("a")["etag"] == info["etag"]
+    assert cached.url_for("a").startswith("http://primary.test/")
+
+
+def test_cache_bypasses_large_objects(cached):
+    cached.put_bytes("big", b"x" * 9, "text/plain")
+    assert not cached.cache.exists("big")
+    assert b"".join(cached.iter_chunks("big", 4)) == b"x" * 9
+    assert not cached.cache.exists("big")
+
+
+def test_cache_mirrors_writes_and_deletes(cached):
+    cached.put_fileobj("a", io.BytesIO(b"abc"), "text/plain")
+    assert cached.cache.get_bytes("a") == b"abc"
+    cached.delete("a")
+    assert not cached.primary.exists("a")
+    assert not cached.cache.exists("a")
+
+
+def test_cache_trims_to_total_size(cached):
+    for key in ("a", "b", "c"):
+        cached.put_bytes(key, b"x" * 8, "text/plain")
+    total = sum(cached.cache.head(k)["size"] for k in ("a", "b", "c") if cached.cache.exists(k))
+    assert total <= 16
+    assert cached.cache.exists("c")
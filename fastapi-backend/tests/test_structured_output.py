@@ -0,0 +1,67 @@
+import pytest
+
+from structured_output import (
+    PRESCRIPTION_SCHEMA,
+    VOICE_HISTORY_SCHEMA,
+    VOICE_PRESCRIPTION_SCHEMA,
+    StructuredOutputError,
+    coerce_to_schema,
+    empty_from_schema,
+    parse_json_output,
+)
+
+
+def test_parse_valid_json_is_not_repaired():
+    assert parse_json_output('{"a": 1}') == ({"a": 1}, False)
+
+
+@pytest.mark.parametrize("text, expected", [
+    ('```json\n{"a": 1}\n```', {"a": 1}),
+    ('Here you go: {"a": 1} Hope this helps.', {"a": 1}),
+    ('{"a": [1, 2,], "b": 3,}', {"a": [1, 2], "b": 3}),
+    ("{'a': True, 'b': None}", {"a": True, "b": None}),
+    ('{“a”: “x”}', {"a": "x"}),
+    ('{"a": "trunc', {"a": "trunc"}),
+    ('{"a": [{"b": 1}, {"b": 2', {"a": [{"b": 1}, {"b": 2}]}),
+])
+def test_parse_repairs_near_valid_json(text, expected):
+    assert parse_json_output(text) == (expected, True)
+
+
+@pytest.mark.parametrize("text", ["", "   ", "no json here", "[1, 2, 3]", "{not: valid: at all"])
+def test_parse_rejects_unrecoverable_output(text):
+    with pytest.raises(StructuredOutputError):
+        parse_json_output(text)
+
+
+def test_empty_from_schema():
+    empty = empty_from_schema(VOICE_HISTORY_SCHEMA)
+    assert empty["complaints"] == []
+    assert empty["hpi"] == ""
+    assert empty["vitals"] == {key: "" for key in ("bp", "pulse", "temperature", "spo2", "height", "weight")}
+
+
+def test_coerce_fills_missing_and_drops_unknown_keys():
+    result = coerce_to_schema({"diagnosis": "Flu", "extra": "x"}, PRESCRIPTION_SCHEMA)
+    assert result == {"diagnosis": "Flu", "drugs": [], "instructions": "", "tests": [], "follow_up": ""}
+
+
+def test_coerce_scalars_and_lone_items():
+    result = coerce_to_schema({"diagnosis": 42, "tests": "CBC", "follow_up": None}, PRESCRIPTION_SCHEMA)
+    assert result["diagnosis"] == "42"
+    assert result["tests"] == ["CBC"]
+    assert result["follow_up"] == ""
+
+
+def test_coerce_bare_string_list_items_fill_first_property():
+    result = coerce_to_schema({"drugs": ["Amoxicillin 500mg TID", {"name": "Paracetamol"}]}, PRESCRIPTION_SCHEMA)
+    assert result["drugs"] == [
+        {"name": "Amoxicillin 500mg TID", "strength": "", "frequency": "", "duration": ""},
+        {"name": "Paracetamol", "strength": "", "frequency": "", "duration": ""},
+    ]
+    medicines = coerce_to_schema({"medicines": "Cetirizine"}, VOICE_PRESCRIPTION_SCHEMA)["medicines"]
+    assert medicines[0]["medicine"] == "Cetirizine"
+
+
+def test_coerce_non_object_becomes_empty_object():
+    assert coerce_to_schema({"vitals": "BP 120/80"}, VOICE_HISTORY_SCHEMA)["vitals"]["bp"] == ""